@@ -0,0 +1,228 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COMPRESSION = 'zstd'
+ARCHIVE_COMPRESSION_LEVEL = 3
+ARCHIVE_PARTITIONS = ['sensor_index', 'month']
+ARCHIVE_KEYS = ['sensor_index', 'time_stamp']
+
+ARCHIVE_NAME = 'morpc-purpleair-sensor-data'
+ARCHIVE_SCHEMA = 'morpc-purpleair-sensor-data.schema.yaml'
+
+def archive_schema(columns):
+    """
+    Returns the pyarrow schema of the files in the archive for a list of dataframe columns.
+
+    Every file gets the same types regardless of the dtypes of the dataframe it was written from, so the
+    archive can be read as one dataset. The partition columns are not stored in the files.
+    """
+    import pyarrow as pa
+
+    fields = [pa.field('time_stamp', pa.timestamp('s', tz='UTC'))]
+    for x in columns:
+        if x in ARCHIVE_KEYS + ARCHIVE_PARTITIONS:
+            continue
+        fields.append(pa.field(x, pa.float32()))
+
+    return pa.schema(fields)
+
+def write_archive(df, archive_dir, resource_path=None, schema_path=None):
+    """
+    Appends sensor readings to a Parquet archive partitioned by sensor index and month.
+
+    Files are laid out as archive_dir/sensor_index=<sensor_index>/month=<YYYY-MM>/part-<time>-<id>.parquet and compressed with
+    ARCHIVE_COMPRESSION. Each file is written under a name starting with '.' and renamed into place once complete, so readers
+    never see a partial file. Readings are not de-duplicated against earlier appends, see read_archive.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Readings with sensor_index and time_stamp columns, ie. the return of purpleair.get_member_history or
+        get_members_history.
+
+    archive_dir : path_like
+        The root directory of the archive. Use one archive per average.
+
+    resource_path : path_like
+        Optional path of a frictionless resource descriptor to (re)write describing the archive. See write_resource.
+
+    schema_path : path_like
+        The path of the table schema referenced by the resource. Defaults to ARCHIVE_SCHEMA in the same directory as the resource.
+
+    Returns:
+    --------
+    list
+        The paths of the files written.
+    """
+    import os
+    import time
+    import uuid
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if len(df) == 0:
+        logger.info("No readings to archive.")
+        return []
+
+    df = df.copy()
+    df['time_stamp'] = pd.to_datetime(df['time_stamp'], utc=True)
+    df['month'] = df['time_stamp'].dt.strftime('%Y-%m')
+    schema = archive_schema(df.columns)
+
+    logger.info("Archiving %s readings for %s sensors to %s.", len(df), df['sensor_index'].nunique(), archive_dir)
+    written = []
+    for (sensor_index, month), partition in df.groupby(ARCHIVE_PARTITIONS, sort=True):
+        partition_dir = os.path.join(archive_dir, f"sensor_index={int(sensor_index)}", f"month={month}")
+        os.makedirs(partition_dir, exist_ok=True)
+
+        table = pa.Table.from_pandas(partition.sort_values('time_stamp')[schema.names], schema=schema, preserve_index=False)
+        # Names sort in write order so the last duplicate read is the most recently archived
+        name = f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(partition_dir, f".{name}.tmp")
+        path = os.path.join(partition_dir, name)
+        try:
+            pq.write_table(table, tmp_path, compression=ARCHIVE_COMPRESSION, compression_level=ARCHIVE_COMPRESSION_LEVEL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        written.append(path)
+
+    logger.debug("Wrote %s files to %s.", len(written), archive_dir)
+
+    if resource_path != None:
+        write_resource(archive_dir, resource_path, schema_path=schema_path)
+
+    return written
+
+def write_resource(archive_dir, resource_path, schema_path=None, title=None, description=None):
+    """
+    Writes a frictionless resource descriptor listing every file in the archive as parts of one resource.
+
+    Paths are written relative to the directory of the descriptor. The descriptor is replaced atomically.
+    """
+    import os
+    import glob
+    import yaml
+
+    resource_dir = os.path.dirname(os.path.abspath(resource_path))
+    if schema_path == None:
+        schema_path = os.path.join(resource_dir, ARCHIVE_SCHEMA)
+
+    paths = sorted(glob.glob(os.path.join(archive_dir, 'sensor_index=*', 'month=*', 'part-*.parquet')))
+    paths = [os.path.relpath(os.path.abspath(x), resource_dir).replace(os.sep, '/') for x in paths]
+
+    resource = {
+        'name': ARCHIVE_NAME,
+        'title': title if title != None else 'PurpleAir sensor readings',
+        'description': description if description != None else 'PurpleAir sensor readings partitioned by sensor_index and month.',
+        'profile': 'tabular-data-resource',
+        'scheme': 'file',
+        'format': 'parquet',
+        'path': paths,
+        'schema': os.path.relpath(os.path.abspath(schema_path), resource_dir).replace(os.sep, '/'),
+    }
+
+    logger.info("Writing resource for %s archive files to %s.", len(paths), resource_path)
+    tmp_path = f"{resource_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        yaml.safe_dump(resource, f, sort_keys=False)
+    os.replace(tmp_path, resource_path)
+
+    return resource
+
+def open_archive(archive_dir):
+    """
+    Returns the archive as a pyarrow dataset with the sensor_index and month partitions as columns.
+
+    The schema has every field of purpleair.DATA_FIELDS, not just those of the first file, since files written from a
+    field profile hold only some of them. Fields missing from a file are read as null.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import purpleair
+
+    partitions = pa.schema([('sensor_index', pa.int64()), ('month', pa.string())])
+    partitioning = ds.partitioning(partitions, flavor='hive')
+    dataset = ds.dataset(archive_dir, format='parquet', partitioning=partitioning)
+
+    # Other columns of the first file, ie. QA flags, are kept after the fields. Columns found in the files keep the
+    # types read from them, ie. time_stamp is stored in milliseconds.
+    columns = purpleair.DATA_FIELDS + [x for x in dataset.schema.names if x not in purpleair.DATA_FIELDS]
+    fields = [dataset.schema.field(x.name) if x.name in dataset.schema.names else x for x in archive_schema(columns)]
+    schema = pa.schema(fields + list(partitions))
+
+    return dataset.replace_schema(schema)
+
+def archive_filter(sensor_index=None, start=None, end=None):
+    """
+    Returns the pyarrow filter expression selecting sensors and an inclusive time range, None for no filter. The
+    partition columns are filtered too so only the matching directories are opened. See purpleair.to_timestamp.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import purpleair
+
+    filters = []
+    if sensor_index is not None:
+        filters.append(ds.field('sensor_index').isin([int(x) for x in sensor_index]))
+    if start != None:
+        start = pd.Timestamp(purpleair.to_timestamp(start, 'Start'), unit='s', tz='UTC')
+        filters.append(ds.field('month') >= start.strftime('%Y-%m'))
+        filters.append(ds.field('time_stamp') >= pa.scalar(start.to_pydatetime(), type=pa.timestamp('s', tz='UTC')))
+    if end != None:
+        end = pd.Timestamp(purpleair.to_timestamp(end, 'End'), unit='s', tz='UTC')
+        filters.append(ds.field('month') <= end.strftime('%Y-%m'))
+        filters.append(ds.field('time_stamp') <= pa.scalar(end.to_pydatetime(), type=pa.timestamp('s', tz='UTC')))
+
+    expression = None
+    for x in filters:
+        expression = x if expression is None else expression & x
+
+    return expression
+
+def read_archive(archive_dir, sensor_index=None, start=None, end=None, columns=None, deduplicate=True):
+    """
+    Reads readings from a Parquet archive, pushing sensor, time and column filters down to the files.
+
+    Only the partitions for the requested sensors and months are opened and only the requested columns are read.
+
+    Parameters:
+    -----------
+    archive_dir : path_like
+        The root directory of the archive. See write_archive.
+
+    sensor_index : list
+        The sensor indexes to read. Defaults to all sensors.
+
+    start, end : date-like
+        Optional bounds on time_stamp, inclusive. Naive values are treated as UTC.
+
+    columns : list
+        The reading fields to read. Defaults to all fields. sensor_index and time_stamp are always returned.
+
+    deduplicate : bool
+        If True, keeps only the last archived reading for each sensor_index and time_stamp.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Readings sorted by sensor_index and time_stamp.
+    """
+    dataset = open_archive(archive_dir)
+    expression = archive_filter(sensor_index=sensor_index, start=start, end=end)
+
+    if columns == None:
+        columns = [x for x in dataset.schema.names if x not in ARCHIVE_KEYS + ARCHIVE_PARTITIONS]
+    logger.info("Reading %s columns from archive %s with filter %s.", len(columns), archive_dir, expression)
+
+    df = dataset.to_table(columns=ARCHIVE_KEYS + list(columns), filter=expression).to_pandas()
+    if deduplicate:
+        df = df.drop_duplicates(subset=ARCHIVE_KEYS, keep='last')
+    df = df.sort_values(ARCHIVE_KEYS, ignore_index=True)
+
+    return df
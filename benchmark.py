@@ -0,0 +1,186 @@
+"""
+End-to-end throughput benchmarks for purpleair.py against the mock API in mockapi.py.
+
+Measures requests per second, rows per second and peak Python memory for group sync, live data, health and
+history backfill. Results can be saved and compared against a baseline to catch regressions:
+
+    python benchmark.py --members 100 --latency 0.05 --output bench.json
+    python benchmark.py --members 100 --latency 0.05 --baseline bench.json
+"""
+import json
+import logging
+import time
+import tracemalloc
+
+import metrics
+import mockapi
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+REGRESSION_THRESHOLD = 0.2 # Fraction slower than the baseline reported as a regression
+
+def measure(name, api, func):
+    """
+    Runs func once against the mock API and returns its throughput and peak memory.
+
+    func should return the number of rows it produced.
+    """
+    api.reset_stats()
+    metrics.reset()
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    rows = 0
+    try:
+        rows = func()
+    except Exception as e:
+        logger.error("Benchmark %s failed: %r", name, e)
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = api.stats
+
+    result = {
+        'name': name,
+        'seconds': seconds,
+        'requests': stats['requests'],
+        'errors': stats['errors'],
+        'bytes': stats['bytes'],
+        'rows': rows,
+        'requests_per_second': stats['requests'] / seconds if seconds > 0 else 0,
+        'rows_per_second': rows / seconds if seconds > 0 else 0,
+        'peak_memory_mb': peak / 2**20,
+        'error': error,
+        # Where the time went, ie. waiting for the rate limit, requests or building dataframes
+        'stages': {
+            'functions': metrics.summary('purpleair_function_seconds', by='function'),
+            'requests': metrics.summary('purpleair_request_seconds', by='endpoint'),
+            'rate_limit_wait': metrics.summary('purpleair_rate_limit_wait_seconds', by='priority'),
+            'json_decode': metrics.summary('purpleair_json_decode_seconds', by='endpoint'),
+            'dataframe_build': metrics.summary('purpleair_dataframe_build_seconds', by='function'),
+        },
+    }
+    logger.info("%s: %.2f s, %.1f requests/s, %.0f rows/s, %.1f MB peak", name, seconds, result['requests_per_second'], result['rows_per_second'], result['peak_memory_mb'])
+
+    return result
+
+def run(members=100, latency=0.05, error_rate=0.0, history_days=1, average=0, max_workers=8, rate=None):
+    """
+    Runs every benchmark against a fresh mock API in a separate process and returns a list of results.
+
+    Parameters:
+    -----------
+    members : int
+        The number of sensors in the mock group.
+
+    latency : float
+        Seconds the mock API waits before answering each request.
+
+    error_rate : float
+        The fraction of requests the mock API answers with a 503.
+
+    history_days : int
+        The length of the history backfill.
+
+    average : int
+        The average of the history backfill. See purpleair.AVERAGE_LIMITS.
+
+    max_workers : int
+        Passed to purpleair.get_members_history.
+
+    rate : float
+        Requests per second allowed by the client rate limit. Defaults to purpleair.RATE_LIMIT.
+    """
+    import pandas as pd
+
+    results = []
+    with mockapi.MockPurpleAirProcess(members=members, latency=latency, error_rate=error_rate, retry_after=0) as api:
+        purpleair.set_api_url(api.url)
+        purpleair.set_scheduler(purpleair.PointsScheduler(rate=rate, burst=max(int(rate), 1)) if rate != None else None)
+        group_id = api.group_id
+        sensors = api.sensors
+
+        def group_sync():
+            # Rotate a tenth of the sensors out of the group and new ones in
+            rotated = max(len(sensors) // 10, 1)
+            target = sensors[rotated:] + [mockapi.SENSOR_INDEX_START + len(sensors) + i for i in range(rotated)]
+            update = purpleair.check_group_members(sensor_index=target, group_id=group_id)
+            purpleair.update_group_members(update=update, group_id=group_id, max_workers=max_workers)
+            return len(update['to_add']) + len(update['to_remove'])
+
+        def live_data():
+            return len(purpleair.get_members_data(group_id))
+
+        def health():
+            return len(purpleair.get_members_health(group_id))
+
+        def history_backfill():
+            end = pd.Timestamp.now().floor('D')
+            start = end - pd.Timedelta(days=history_days)
+            df = purpleair.get_members_history(group_id, start=start, end=end, average=average, max_workers=max_workers)
+            return len(df)
+
+        for name, func in [('group_sync', group_sync), ('live_data', live_data), ('health', health), ('history_backfill', history_backfill)]:
+            results.append(measure(name, api, func))
+
+        purpleair.close_session()
+        purpleair.set_scheduler(None)
+        purpleair.set_api_url(purpleair.DEFAULT_API_URL)
+
+    return results
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns a list of messages for each benchmark whose rows or requests per second fell more than threshold below the baseline.
+    """
+    baseline = {x['name']: x for x in baseline}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before == None:
+            continue
+        for metric in ['rows_per_second', 'requests_per_second']:
+            if before[metric] > 0 and result[metric] < before[metric] * (1 - threshold):
+                regressions.append(f"{result['name']} {metric} fell from {before[metric]:.1f} to {result[metric]:.1f}")
+
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Benchmark purpleair.py against the mock PurpleAir API.')
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--history-days', type=int, default=1)
+    parser.add_argument('--average', type=int, default=0)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, help='Client rate limit in requests per second. Defaults to purpleair.RATE_LIMIT.')
+    parser.add_argument('--output', help='Write results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare results to this JSON file and exit 1 on regression.')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s | %(levelname)s | %(name)s : %(message)s')
+    logger.setLevel(logging.INFO)
+
+    results = run(members=args.members, latency=args.latency, error_rate=args.error_rate, history_days=args.history_days, average=args.average, max_workers=args.max_workers, rate=args.rate)
+
+    print(f"{'benchmark':<18}{'seconds':>10}{'requests':>10}{'req/s':>10}{'rows':>10}{'rows/s':>12}{'peak MB':>10}")
+    for x in results:
+        print(f"{x['name']:<18}{x['seconds']:>10.2f}{x['requests']:>10}{x['requests_per_second']:>10.1f}{x['rows']:>10}{x['rows_per_second']:>12.0f}{x['peak_memory_mb']:>10.1f}{'  ' + x['error'] if x['error'] else ''}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), threshold=args.threshold)
+        for x in regressions:
+            print(f"REGRESSION: {x}")
+        if len(regressions) > 0:
+            sys.exit(1)
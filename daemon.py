@@ -0,0 +1,248 @@
+"""
+Long-running poller that fetches live data, health and metadata for the members of a group on a schedule.
+
+Each poll runs on its own interval in one asyncio event loop. API calls run on worker threads and share the
+connection pool of purpleair.get_session(), and results are written to storage as each poll finishes. A poll that is
+still running when its next turn comes is not started twice, see Daemon. SIGTERM and SIGINT stop the loop after the
+running polls finish. Metrics are flushed to the sink set by PURPLEAIR_METRICS after every poll, see metrics.py.
+
+    python daemon.py --group-id 1234 --data-interval 120 --health-interval 600 --metadata-interval 86400
+"""
+import asyncio
+import logging
+import signal
+import time
+
+import metrics
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+DATA_INTERVAL = 120 # Seconds between live data polls, sensors report every 2 minutes
+HEALTH_INTERVAL = 600 # Seconds between health polls
+METADATA_INTERVAL = 86400 # Seconds between metadata polls
+SHUTDOWN_TIMEOUT = 60 # Seconds to wait for running polls to finish when stopping
+
+def store_data(df):
+    """
+    Loads live readings into the readings table and refreshes the rollups they touch. See model.load_readings and
+    rollup.refresh_rollups.
+    """
+    import model
+    import rollup
+
+    rows = model.load_readings(df, average=0)
+    rollup.refresh_rollups()
+
+    return rows
+
+def store_health(df):
+    """
+    Adds scored health checks to the sensor_health table. See model.load_health.
+    """
+    import model
+
+    return model.load_health(df)
+
+def store_metadata(df):
+    """
+    Replaces the stored metadata of the sensors in sensor_metadata, whose coordinates spatial queries use. See
+    model.load_metadata. The locations table is not changed, it holds the locations of the Deployment Log.
+    """
+    import model
+
+    return model.load_metadata(df)
+
+class Poll:
+    """
+    One scheduled fetch and store, ie. live data every DATA_INTERVAL seconds.
+
+    Parameters:
+    -----------
+    name : str
+        The name used in logs and stats.
+
+    fetch : callable
+        Called with the group id, returns a pandas.DataFrame.
+
+    store : callable
+        Called with the result of fetch, returns the number of rows stored.
+
+    interval : float
+        Seconds between the starts of consecutive polls.
+    """
+    def __init__(self, name, fetch, store, interval):
+        self.name = name
+        self.fetch = fetch
+        self.store = store
+        self.interval = interval
+        self.task = None
+        self.pending = False
+        self.stats = {'runs': 0, 'failures': 0, 'skipped': 0, 'coalesced': 0, 'rows': 0, 'last_run': None, 'last_seconds': None}
+
+    @property
+    def running(self):
+        return self.task != None and not self.task.done()
+
+class Daemon:
+    """
+    Polls a group on a schedule until stopped.
+
+    Polls start on a fixed schedule, interval seconds apart, regardless of how long each one takes. If a poll is
+    still running when its next turn comes, it is not started again. With coalesce, all the turns missed while it
+    was running are merged into one poll that starts as soon as it finishes. Without coalesce, they are skipped.
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See purpleair.get_groups().
+
+    data_interval, health_interval, metadata_interval : float
+        Seconds between polls of purpleair.get_members_data, get_members_health and get_members_metadata. None disables a poll.
+
+    coalesce : bool
+        If True, a poll that was due while the previous one was running runs once right after it. If False, it is skipped.
+    """
+    def __init__(self, group_id, data_interval=DATA_INTERVAL, health_interval=HEALTH_INTERVAL, metadata_interval=METADATA_INTERVAL, coalesce=True):
+        self.group_id = group_id
+        self.coalesce = coalesce
+        self.polls = []
+        if data_interval != None:
+            self.polls.append(Poll('data', purpleair.get_members_data, store_data, data_interval))
+        if health_interval != None:
+            self.polls.append(Poll('health', self._fetch_health, store_health, health_interval))
+        if metadata_interval != None:
+            self.polls.append(Poll('metadata', purpleair.get_members_metadata, store_metadata, metadata_interval))
+        self._latest = {}
+        self._stopping = None
+        self._fetch_executor = None
+        self._store_executor = None
+
+    @property
+    def stats(self):
+        return {x.name: dict(x.stats) for x in self.polls}
+
+    def stop(self):
+        """
+        Asks a running daemon to finish its running polls and return. Safe to call from a signal handler.
+        """
+        if self._stopping != None and not self._stopping.is_set():
+            logger.info("Stopping daemon for group %s.", self.group_id)
+            self._stopping.set()
+
+    def _fetch_health(self, group_id):
+        # Score against the previous check to catch restarts and the latest readings to check A/B agreement
+        return purpleair.get_members_health(group_id, previous=self._latest.get('health'), readings=self._latest.get('data'))
+
+    async def _execute(self, poll):
+        loop = asyncio.get_running_loop()
+        while True:
+            poll.pending = False
+            start = time.perf_counter()
+            poll.stats['last_run'] = time.time()
+            try:
+                df = await loop.run_in_executor(self._fetch_executor, poll.fetch, self.group_id)
+                self._latest[poll.name] = df
+                # Writes are serialized on one thread so SQLite only ever has one writer
+                rows = await loop.run_in_executor(self._store_executor, poll.store, df)
+                poll.stats['rows'] += rows
+                logger.info("Poll %s stored %s rows in %.2f s.", poll.name, rows, time.perf_counter() - start)
+            except Exception as e:
+                poll.stats['failures'] += 1
+                logger.error("Poll %s failed for group %s: %r", poll.name, self.group_id, e)
+            poll.stats['runs'] += 1
+            poll.stats['last_seconds'] = time.perf_counter() - start
+            # Export the request and decode metrics of the poll, ie. rewrite the Prometheus textfile
+            metrics.flush()
+
+            if not poll.pending or self._stopping.is_set():
+                return
+            logger.info("Running coalesced poll %s.", poll.name)
+
+    async def _schedule(self, poll):
+        loop = asyncio.get_running_loop()
+        first = loop.time()
+        turn = 0
+        while not self._stopping.is_set():
+            if poll.running:
+                if self.coalesce:
+                    if poll.pending:
+                        poll.stats['coalesced'] += 1
+                    poll.pending = True
+                    logger.warning("Poll %s is still running, running again when it finishes.", poll.name)
+                else:
+                    poll.stats['skipped'] += 1
+                    logger.warning("Poll %s is still running, skipping this turn.", poll.name)
+            else:
+                poll.task = asyncio.create_task(self._execute(poll))
+
+            # Keep to the schedule rather than drifting by the time each poll takes, skipping turns already past
+            turn = max(turn + 1, int((loop.time() - first) // poll.interval) + 1)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=max(first + turn * poll.interval - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """
+        Runs the polls until stop() is called or the process receives SIGTERM or SIGINT.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._fetch_executor = ThreadPoolExecutor(max_workers=max(len(self.polls), 1), thread_name_prefix='poll')
+        self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+
+        handled = []
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            try:
+                loop.add_signal_handler(sig, self.stop)
+                handled.append(sig)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not supported on Windows or outside the main thread
+                pass
+
+        logger.info("Polling group %s every %s seconds.", self.group_id, {x.name: x.interval for x in self.polls})
+        schedules = [asyncio.create_task(self._schedule(x)) for x in self.polls]
+        try:
+            await self._stopping.wait()
+        finally:
+            self._stopping.set()
+            await asyncio.gather(*schedules, return_exceptions=True)
+            running = [x.task for x in self.polls if x.running]
+            if len(running) > 0:
+                logger.info("Waiting up to %s s for %s running polls.", SHUTDOWN_TIMEOUT, len(running))
+                done, not_done = await asyncio.wait(running, timeout=SHUTDOWN_TIMEOUT)
+                if len(not_done) > 0:
+                    logger.warning("%s polls did not finish before shutdown.", len(not_done))
+            for sig in handled:
+                loop.remove_signal_handler(sig)
+            self._fetch_executor.shutdown(wait=False, cancel_futures=True)
+            self._store_executor.shutdown(wait=True)
+            purpleair.close_session()
+            logger.info("Daemon for group %s stopped. %s", self.group_id, self.stats)
+
+        return self.stats
+
+def run(group_id, **kwargs):
+    """
+    Runs a Daemon for a group until the process receives SIGTERM or SIGINT. kwargs are passed to Daemon.
+    """
+    return asyncio.run(Daemon(group_id, **kwargs).run())
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Poll the members of a PurpleAir group on a schedule.')
+    parser.add_argument('--group-id', required=True)
+    parser.add_argument('--data-interval', type=float, default=DATA_INTERVAL)
+    parser.add_argument('--health-interval', type=float, default=HEALTH_INTERVAL)
+    parser.add_argument('--metadata-interval', type=float, default=METADATA_INTERVAL)
+    parser.add_argument('--skip-overlapping', action='store_true', help='Skip polls that are due while the previous one is running instead of running them once it finishes.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(name)s : %(message)s')
+
+    run(args.group_id, data_interval=args.data_interval, health_interval=args.health_interval, metadata_interval=args.metadata_interval,
+        coalesce=not args.skip_overlapping)
@@ -0,0 +1,259 @@
+"""
+Finds missing stretches in the stored readings and plans the history requests that fill only those.
+
+A gap is any stretch of a sensor's deployment with no reading for more than GAP_FACTOR times the cadence of the
+average, ie. 2 minutes for real-time readings. Time a sensor was not deployed is not a gap. Gaps are merged into as
+few history requests as possible, each within purpleair.AVERAGE_LIMITS:
+
+    deployments = purpleair.read_deployment_log(log_path)
+    found = gaps.find_gaps(start='2025-06-01', end='2025-07-01', deployments=deployments)
+    plan = gaps.plan_refetch(found)
+    result = gaps.refetch(plan, group_id)
+"""
+import logging
+
+import model
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+GAP_FACTOR = 1.5 # Cadences without a reading before a stretch counts as a gap, sensors do not report exactly on time
+MERGE_WITHIN = 3600 # Seconds between gaps of a sensor below which they are fetched in one request
+
+def deployment_windows(deployments, start, end):
+    """
+    Returns the times each sensor was deployed between start and end, merging overlapping deployments.
+
+    Parameters:
+    -----------
+    deployments : pandas.DataFrame
+        The return of purpleair.read_deployment_log(). Dates are in purpleair.DEPLOYMENT_TZ.
+
+    start, end : int
+        The bounds of the period as UNIX time stamps.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, start and end as UNIX time stamps, sorted by sensor_index and start.
+    """
+    import pandas as pd
+
+    df = deployments[[purpleair.DEPLOYMENT_SENSOR_COL, purpleair.DEPLOYMENT_START_COL, purpleair.DEPLOYMENT_END_COL]].dropna(
+        subset=[purpleair.DEPLOYMENT_SENSOR_COL, purpleair.DEPLOYMENT_START_COL])
+    windows = pd.DataFrame({'sensor_index': df[purpleair.DEPLOYMENT_SENSOR_COL].astype('int64').to_numpy()})
+    for x, column in [('start', purpleair.DEPLOYMENT_START_COL), ('end', purpleair.DEPLOYMENT_END_COL)]:
+        times = pd.to_datetime(df[column])
+        if times.dt.tz == None:
+            times = times.dt.tz_localize(purpleair.DEPLOYMENT_TZ, nonexistent='shift_forward', ambiguous='NaT')
+        # Still deployed, the end is missing
+        windows[x] = model.to_unix(times).fillna(end).astype('int64').to_numpy()
+    windows['start'] = windows['start'].clip(lower=start)
+    windows['end'] = windows['end'].clip(upper=end)
+    windows = windows.loc[windows['end'] > windows['start']]
+
+    return _merge(windows, 0)
+
+def _merge(intervals, within):
+    """
+    Merges the intervals of each sensor that overlap or are less than within seconds apart.
+    """
+    import pandas as pd
+
+    if len(intervals) == 0:
+        return pd.DataFrame({'sensor_index': pd.Series(dtype='int64'), 'start': pd.Series(dtype='int64'), 'end': pd.Series(dtype='int64')})
+
+    df = intervals[['sensor_index', 'start', 'end']].sort_values(['sensor_index', 'start'], ignore_index=True)
+    # An interval starts a new group if it is a new sensor or starts after every earlier interval of the sensor ended
+    reach = df.groupby('sensor_index')['end'].cummax().groupby(df['sensor_index']).shift()
+    new = reach.isna() | (df['start'] > reach + within)
+    group = new.cumsum()
+
+    return df.groupby(group).agg(sensor_index=('sensor_index', 'first'), start=('start', 'min'), end=('end', 'max')).reset_index(drop=True)
+
+def find_gaps(start, end=None, average=0, sensor_index=None, deployments=None, factor=GAP_FACTOR):
+    """
+    Scans the stored readings of each sensor for stretches without readings.
+
+    Parameters:
+    -----------
+    start, end : date-like
+        The period to scan. Naive values are treated as UTC, see purpleair.to_timestamp. end defaults to now.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+
+    sensor_index : list
+        The sensors to scan. Defaults to every sensor in deployments. Required without deployments.
+
+    deployments : pandas.DataFrame
+        The return of purpleair.read_deployment_log(). Only the times a sensor was deployed are scanned. Without it,
+        each sensor is expected to report for the whole period.
+
+    factor : float
+        The number of cadences without a reading before a stretch counts as a gap.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per gap with sensor_index, start and end (UTC datetimes of the readings on either side, or of the
+        bounds of the deployment) and missing, the estimated number of readings missing.
+    """
+    import time
+    import numpy as np
+    import pandas as pd
+
+    cadence = purpleair.cadence(average)
+    start = purpleair.to_timestamp(start, 'Start')
+    end = int(time.time()) if end == None else purpleair.to_timestamp(end, 'End')
+
+    if deployments is not None:
+        windows = deployment_windows(deployments, start, end)
+        if sensor_index is not None:
+            windows = windows.loc[windows['sensor_index'].isin([int(x) for x in sensor_index])].reset_index(drop=True)
+    elif sensor_index is not None:
+        windows = pd.DataFrame({'sensor_index': [int(x) for x in sensor_index], 'start': start, 'end': end})
+    else:
+        raise ValueError("Either sensor_index or deployments must be given.")
+
+    readings = model.read_readings(sensor_index=windows['sensor_index'].unique().tolist(), start=pd.Timestamp(start, unit='s'),
+        end=pd.Timestamp(end, unit='s'), average=average, columns=[])
+    sensors = readings['sensor_index'].to_numpy()
+    times = model.to_unix(readings['time_stamp']).astype('int64').to_numpy()
+
+    gaps = []
+    for sensor, first, last in windows[['sensor_index', 'start', 'end']].itertuples(index=False):
+        # Readings are sorted by sensor_index and time_stamp, find this window's slice
+        lo = np.searchsorted(sensors, sensor, side='left')
+        hi = np.searchsorted(sensors, sensor, side='right')
+        t = times[lo:hi]
+        t = t[np.searchsorted(t, first, side='left'):np.searchsorted(t, last, side='right')]
+
+        # The window bounds act as readings so missing stretches at either end are found the same way
+        bounds = np.concatenate([[first], t, [last]])
+        missing = np.flatnonzero(np.diff(bounds) > factor * cadence)
+        for i in missing:
+            gaps.append((sensor, bounds[i], bounds[i + 1]))
+
+    df = pd.DataFrame(gaps, columns=['sensor_index', 'start', 'end']).astype('int64')
+    df['missing'] = np.maximum((df['end'] - df['start']) // cadence - 1, 1)
+    for x in ['start', 'end']:
+        df[x] = pd.to_datetime(df[x], unit='s', utc=True).astype('datetime64[s, UTC]')
+
+    logger.info("Found %s gaps, about %s missing readings, in %s deployment windows of %s sensors.", len(df), df['missing'].sum(), len(windows), windows['sensor_index'].nunique())
+
+    return df
+
+def plan_refetch(gaps, average=0, merge_within=MERGE_WITHIN):
+    """
+    Merges gaps into the fewest history requests that cover them, each within the API limit for the average.
+
+    Gaps of a sensor that overlap or are less than merge_within seconds apart are fetched in one request, refetching
+    the few readings between them to make fewer requests against the rate limit. Set merge_within to 0 to fetch only
+    missing readings. Merged gaps longer than the limit in purpleair.AVERAGE_LIMITS are split.
+
+    Parameters:
+    -----------
+    gaps : pandas.DataFrame
+        The return of find_gaps().
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+
+    merge_within : int
+        Seconds between gaps below which they are merged.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per request with sensor_index, start, end, average, rows and points, the estimated number of readings
+        and API points. See purpleair.estimate_points.
+    """
+    import pandas as pd
+
+    intervals = pd.DataFrame({
+        'sensor_index': gaps['sensor_index'].astype('int64'),
+        'start': model.to_unix(gaps['start']).astype('int64'),
+        'end': model.to_unix(gaps['end']).astype('int64'),
+    })
+    merged = _merge(intervals, merge_within)
+
+    freq = purpleair.limit_offset(average)
+    requests = []
+    for sensor, first, last in merged.itertuples(index=False):
+        interval = pd.Interval(pd.Timestamp(first, unit='s', tz='UTC'), pd.Timestamp(last, unit='s', tz='UTC'))
+        chunks = purpleair.split_interval(interval, freq) if interval.left + freq < interval.right else [interval]
+        requests += [(sensor, int(x.left.timestamp()), int(x.right.timestamp())) for x in chunks]
+
+    plan = pd.DataFrame(requests, columns=['sensor_index', 'start', 'end']).astype('int64')
+    plan['average'] = average
+    plan['rows'] = [purpleair.estimate_history_rows(x, y, average) for x, y in zip(plan['start'], plan['end'])]
+    plan['points'] = [purpleair.estimate_points(purpleair.DATA_FIELDS_QUERY, rows=x) for x in plan['rows']]
+    for x in ['start', 'end']:
+        plan[x] = pd.to_datetime(plan[x], unit='s', utc=True).astype('datetime64[s, UTC]')
+
+    logger.info("Planned %s requests for %s gaps of %s sensors, about %s points.", len(plan), len(gaps), plan['sensor_index'].nunique(), plan['points'].sum())
+
+    return plan
+
+def refetch(plan, group_id, max_workers=8, store=True):
+    """
+    Runs the requests of a plan and stores the readings.
+
+    Parameters:
+    -----------
+    plan : pandas.DataFrame
+        The return of plan_refetch().
+
+    group_id : str
+        The id number of a group the sensors are members of. Sensors that are not members are skipped.
+
+    max_workers : int
+        The maximum number of requests to make at the same time.
+
+    store : bool
+        If True, loads the readings with model.load_readings and refreshes the rollups of real-time readings.
+
+    Returns:
+    --------
+    dict
+        'requests', the number of requests made, 'rows', the number of readings fetched, 'skipped', the sensors that
+        are not members of the group, and 'failed', a list of (sensor_index, start, end, exception) for each request
+        that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    sensor_map = purpleair.get_sensor_map(group_id)
+    skipped = sorted(set(int(x) for x in plan['sensor_index']) - set(sensor_map))
+    if len(skipped) > 0:
+        logger.warning("%s sensors are not members of group %s and are skipped: %s", len(skipped), group_id, skipped)
+    todo = plan.loc[plan['sensor_index'].isin(sensor_map.keys())]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            (x.sensor_index, x.start, x.end, x.average, pool.submit(purpleair.get_history_chunk, group_id, sensor_map[x.sensor_index],
+                start=x.start, end=x.end, average=x.average))
+            for x in todo.itertuples(index=False)
+        ]
+
+    rows = 0
+    failed = []
+    for sensor, first, last, average, future in futures:
+        try:
+            df = future.result()
+        except Exception as e:
+            logger.error("Refetch of sensor %s from %s to %s failed: %r", sensor, first, last, e)
+            failed.append((sensor, first, last, e))
+            continue
+        df['sensor_index'] = sensor
+        rows += len(df)
+        if store:
+            model.load_readings(df, average=average)
+
+    if store and rows > 0 and (todo['average'] == 0).any():
+        import rollup
+        rollup.refresh_rollups()
+
+    logger.info("Refetched %s readings in %s requests, %s failed.", rows, len(futures), len(failed))
+
+    return {'requests': len(futures), 'rows': rows, 'skipped': skipped, 'failed': failed}
@@ -0,0 +1,452 @@
+"""
+Loads readings from every source into the readings table in one normalized format.
+
+Each source is an adapter that lists its units of work (files, or group members for the API) and reads each one in
+chunks. Every chunk is normalized to the columns of output_data/morpc-purpleair-sensor-data.schema.yaml: sensor_index
+(int64), time_stamp (UTC datetime) and the DATA_FIELDS present in the source as float32. Files are read in parallel on a
+process pool and loaded by this process, since SQLite has one writer. The same reading from several sources is stored
+once, from the source with the highest priority, see model.SOURCE_PRIORITIES:
+
+    sources = [
+        ingest.DownloadToolSource('./input_data/download_tool/**/*.csv'),
+        ingest.SharePointSource('~/MORPC/Air Quality - PurpleAir'),
+        ingest.RambollSource('./input_data/ramboll_export.csv'),
+        ingest.ApiSource(group_id, start='2025-06-01', end='2025-07-01'),
+    ]
+    result = ingest.ingest(sources, max_workers=8)
+
+or from the command line:
+
+    python ingest.py download_tool "./input_data/download_tool/**/*.csv" --workers 8
+
+On platforms that start processes by spawning, ie. Windows, call ingest from under if __name__ == '__main__'.
+"""
+import abc
+import logging
+import os
+
+import model
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+INGEST_CHUNKSIZE = 100000 # Rows read from a file at a time
+INGEST_WORKERS = None # Processes reading files, None for the number of CPUs
+INFLIGHT_PER_WORKER = 2 # Chunks queued per worker, bounds the memory held by read but not yet loaded chunks
+QUEUE_POLL = 0.1 # Seconds between checks for finished reads while waiting for chunks
+
+# Column names used by exports for the keys of a reading, matched case-insensitively. Fields match DATA_FIELDS.
+COLUMN_ALIASES = {
+    'time_stamp': 'time_stamp',
+    'timestamp': 'time_stamp',
+    'time_stamp_utc': 'time_stamp',
+    'datetime': 'time_stamp',
+    'date_time': 'time_stamp',
+    'created_at': 'time_stamp',
+    'sensor_index': 'sensor_index',
+    'sensorindex': 'sensor_index',
+    'sensor_id': 'sensor_index',
+    'sensorid': 'sensor_index',
+}
+SENSOR_PATTERN = r'(?<![\d-])(\d{3,})(?![\d-])' # Sensor index in the file name of a file without a sensor index column, a number that is not part of a date
+
+def match_columns(names, columns=None):
+    """
+    Returns the map of column names to the normalized names they match, after the renames in columns, ie.
+    {'Timestamp': 'time_stamp', 'PM2.5_ATM_A': 'pm2.5_atm_a'}. Names that match nothing are left out.
+    """
+    fields = {x.lower(): x for x in purpleair.DATA_FIELDS}
+    renames = {}
+    for x in names:
+        key = str(columns.get(x, x) if columns != None else x).strip().lower()
+        name = COLUMN_ALIASES.get(key, fields.get(key))
+        if name != None and name not in renames.values():
+            renames[x] = name
+
+    return renames
+
+def normalize(df, columns=None, tz='UTC', sensor_index=None):
+    """
+    Converts a frame read from any source to the normalized reading format.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Raw readings.
+
+    columns : dict
+        Renames applied before COLUMN_ALIASES, ie. {'PM2.5 A': 'pm2.5_atm_a'}.
+
+    tz : str
+        The time zone of time stamps without one. Numeric time stamps are UNIX time stamps.
+
+    sensor_index : int
+        The sensor of every row, for files without a sensor index column.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, time_stamp and the fields of DATA_FIELDS present in df in DATA_FIELDS order. Rows without a
+        sensor index or time stamp are dropped.
+    """
+    import pandas as pd
+
+    if columns != None:
+        df = df.rename(columns=columns)
+    renames = match_columns(df.columns)
+    df = df[list(renames)].rename(columns=renames)
+
+    if 'time_stamp' not in df.columns:
+        raise KeyError("No time stamp column found. Map it with columns.")
+    if 'sensor_index' not in df.columns:
+        if sensor_index == None:
+            raise KeyError("No sensor index column found. Map it with columns or pass sensor_index.")
+        df['sensor_index'] = sensor_index
+
+    time_stamp = df['time_stamp']
+    if pd.api.types.is_numeric_dtype(time_stamp):
+        time_stamp = pd.to_datetime(time_stamp, unit='s', utc=True)
+    else:
+        try:
+            time_stamp = pd.to_datetime(time_stamp, errors='coerce')
+        except ValueError:
+            # Offsets differ between rows
+            time_stamp = pd.to_datetime(time_stamp, errors='coerce', utc=True)
+        if time_stamp.dt.tz == None:
+            time_stamp = time_stamp.dt.tz_localize(tz, nonexistent='NaT', ambiguous='NaT')
+        time_stamp = time_stamp.dt.tz_convert('UTC')
+
+    out = pd.DataFrame({
+        'sensor_index': pd.to_numeric(df['sensor_index'], errors='coerce'),
+        'time_stamp': time_stamp.astype('datetime64[s, UTC]'),
+    })
+    for x in purpleair.DATA_FIELDS:
+        if x in df.columns:
+            out[x] = pd.to_numeric(df[x], errors='coerce').astype('float32')
+    out = out.dropna(subset=['sensor_index', 'time_stamp'])
+    out['sensor_index'] = out['sensor_index'].astype('int64')
+
+    return out.reset_index(drop=True)
+
+class Source(abc.ABC):
+    """
+    An adapter for one source of readings.
+
+    Subclasses set name and implement units and read. Sources with parallel set are read on a process pool, so they
+    must be picklable.
+
+    Parameters:
+    -----------
+    priority : int
+        Readings of this source replace stored readings of sources with the same or lower priority. Defaults to
+        model.SOURCE_PRIORITIES for name.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+    """
+    name = None
+    parallel = True
+
+    def __init__(self, priority=None, average=0):
+        self.priority = model.SOURCE_PRIORITIES.get(self.name, model.DEFAULT_SOURCE_PRIORITY) if priority == None else priority
+        self.average = average
+
+    @abc.abstractmethod
+    def units(self):
+        """
+        Returns the units of work, ie. file paths.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, unit, chunksize=INGEST_CHUNKSIZE):
+        """
+        Yields normalized frames of at most about chunksize rows from one unit. See normalize.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(name={self.name!r}, priority={self.priority})"
+
+class CsvSource(Source):
+    """
+    CSV files of readings, read in chunks so any size of file fits in memory.
+
+    Parameters:
+    -----------
+    paths : str or list
+        Files, directories (every *.csv below them) or glob patterns. ~ is expanded.
+
+    columns : dict
+        Renames applied to the columns before matching them, see normalize.
+
+    tz : str
+        The time zone of time stamps without one.
+
+    sensor_pattern : str
+        A regular expression whose first group is the sensor index in the file name, used when a file has no sensor
+        index column. A file whose name has no match or several different matches fails.
+
+    read_csv : dict
+        Extra arguments for pandas.read_csv, ie. {'sep': ';'}.
+
+    priority, average :
+        See Source.
+    """
+    name = 'csv'
+
+    def __init__(self, paths, columns=None, tz='UTC', sensor_pattern=SENSOR_PATTERN, read_csv=None, priority=None, average=0):
+        super().__init__(priority=priority, average=average)
+        self.paths = [paths] if isinstance(paths, (str, os.PathLike)) else list(paths)
+        self.columns = columns
+        self.tz = tz
+        self.sensor_pattern = sensor_pattern
+        self.read_csv = {} if read_csv == None else read_csv
+
+    def units(self):
+        import glob
+
+        files = set()
+        for x in self.paths:
+            x = os.path.expanduser(str(x))
+            if os.path.isdir(x):
+                files.update(glob.glob(os.path.join(x, '**', '*.csv'), recursive=True))
+            else:
+                files.update(glob.glob(x, recursive=True))
+
+        return sorted(files)
+
+    def _sensor_index(self, path):
+        """
+        Returns the sensor index in the file name. Raises KeyError if there is none and ValueError if several numbers
+        match sensor_pattern, ie. a date without dashes.
+        """
+        import re
+
+        matches = sorted(set(int(x) for x in re.findall(self.sensor_pattern, os.path.basename(path)))) if self.sensor_pattern != None else []
+        if len(matches) == 0:
+            raise KeyError(f"No sensor index column in {path} and no sensor index in its name. Map it with columns.")
+        if len(matches) > 1:
+            raise ValueError(f"No sensor index column in {path} and its name has several sensor indexes {matches}. Set sensor_pattern or map it with columns.")
+
+        return matches[0]
+
+    def read(self, unit, chunksize=INGEST_CHUNKSIZE):
+        import pandas as pd
+
+        sensor_index = None
+        with pd.read_csv(unit, chunksize=chunksize, **self.read_csv) as chunks:
+            for i, chunk in enumerate(chunks):
+                # The file name is only used for files without a sensor index column
+                if i == 0 and 'sensor_index' not in match_columns(chunk.columns, self.columns).values():
+                    sensor_index = self._sensor_index(unit)
+                yield normalize(chunk, columns=self.columns, tz=self.tz, sensor_index=sensor_index)
+
+class DownloadToolSource(CsvSource):
+    """
+    CSVs written by the PurpleAir Data Download Tool, which uses the API's field names. See CsvSource.
+    """
+    name = 'download_tool'
+
+class SharePointSource(CsvSource):
+    """
+    Historical CSVs from MORPC SharePoint, read from a synced or downloaded copy of the document library. See CsvSource.
+    """
+    name = 'sharepoint'
+
+class RambollSource(CsvSource):
+    """
+    Ramboll database exports as CSV. Map export column names that differ from the API's with columns, ie.
+    {'SensorID': 'sensor_index', 'Timestamp_UTC': 'time_stamp'}. See CsvSource.
+    """
+    name = 'ramboll'
+
+class ApiSource(Source):
+    """
+    History of the members of a group from the API, streamed with purpleair.iter_member_history.
+
+    Requests are rate limited by this process's purpleair.PointsScheduler, so members are read one after another in
+    this process rather than on the process pool.
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See purpleair.get_groups().
+
+    start, end, fields, precision :
+        See purpleair.get_member_history().
+
+    priority, average :
+        See Source.
+    """
+    name = 'api'
+    parallel = False
+
+    def __init__(self, group_id, start=None, end=None, fields=None, precision=None, priority=None, average=0):
+        super().__init__(priority=priority, average=average)
+        self.group_id = group_id
+        self.start = start
+        self.end = end
+        self.fields = fields
+        self.precision = precision
+
+    def units(self):
+        return list(purpleair.get_member_map(self.group_id))
+
+    def read(self, unit, chunksize=INGEST_CHUNKSIZE):
+        return purpleair.iter_member_history(self.group_id, unit, start=self.start, end=self.end, average=self.average,
+            batch_size=chunksize, fields=self.fields, precision=self.precision)
+
+_chunks = None
+
+def _init_worker(chunks):
+    # Runs once in each process of the pool
+    global _chunks
+    _chunks = chunks
+
+def _read_unit(source, unit, chunksize):
+    """
+    Runs on the process pool. Sends each normalized chunk of a unit to the loading process as soon as it is read, so a
+    worker holds one chunk at a time, and returns the number of chunks sent and the exception that stopped the read.
+    """
+    sent = 0
+    try:
+        for df in source.read(unit, chunksize=chunksize):
+            # Blocks while the queue is full, until the loading process catches up
+            _chunks.put((unit, df))
+            sent += 1
+    except Exception as e:
+        return sent, e
+    return sent, None
+
+def _load(source, chunks):
+    rows = 0
+    for df in chunks:
+        rows += model.load_readings(df, average=source.average, source=source.name, priority=source.priority)
+    return rows
+
+def ingest(sources, max_workers=INGEST_WORKERS, chunksize=INGEST_CHUNKSIZE):
+    """
+    Loads every unit of every source into the readings table and refreshes the rollups.
+
+    Parameters:
+    -----------
+    sources : list
+        Source adapters, ie. DownloadToolSource or ApiSource.
+
+    max_workers : int
+        Processes reading files at the same time. 1 reads and loads one chunk at a time in this process, which uses the
+        least memory. Defaults to the number of CPUs.
+
+    chunksize : int
+        Rows read and normalized at a time.
+
+    Returns:
+    --------
+    dict
+        For each source name, 'units', the number of units read, 'rows', the number of rows loaded, and 'failed', a
+        list of (unit, exception) for each unit that could not be read.
+    """
+    import multiprocessing
+    import queue
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    result = {}
+    start = time.perf_counter()
+    max_workers = os.cpu_count() if max_workers == None else max_workers
+    for source in sources:
+        units = source.units()
+        report = result.setdefault(source.name, {'units': 0, 'rows': 0, 'failed': []})
+        logger.info("Ingesting %s units from %r.", len(units), source)
+
+        if not source.parallel or max_workers <= 1 or len(units) <= 1:
+            for unit in units:
+                try:
+                    report['rows'] += _load(source, source.read(unit, chunksize=chunksize))
+                    report['units'] += 1
+                except Exception as e:
+                    logger.error("Failed to ingest %s from %s: %r", unit, source.name, e)
+                    report['failed'].append((unit, e))
+            continue
+
+        # Workers put chunks on a bounded queue and this process loads them, so memory does not grow with the size or
+        # number of files. A unit is done once its read has finished and every chunk it sent is loaded.
+        context = multiprocessing.get_context()
+        chunks = context.Queue(maxsize=max_workers * INFLIGHT_PER_WORKER)
+        finished = queue.SimpleQueue()
+        sent = {}
+        loaded = dict.fromkeys(units, 0)
+        errors = {}
+        remaining = set(units)
+
+        def settle(unit):
+            if unit in remaining and unit in sent and loaded[unit] >= sent[unit]:
+                remaining.discard(unit)
+                if unit in errors:
+                    logger.error("Failed to ingest %s from %s: %r", unit, source.name, errors[unit])
+                    report['failed'].append((unit, errors[unit]))
+                else:
+                    report['units'] += 1
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker, initargs=(chunks,)) as pool:
+            futures = {}
+            for unit in units:
+                future = pool.submit(_read_unit, source, unit, chunksize)
+                futures[future] = unit
+                future.add_done_callback(finished.put)
+
+            while len(remaining) > 0:
+                try:
+                    unit, df = chunks.get(timeout=QUEUE_POLL)
+                except queue.Empty:
+                    pass
+                else:
+                    try:
+                        report['rows'] += _load(source, [df])
+                    except Exception as e:
+                        errors.setdefault(unit, e)
+                    loaded[unit] += 1
+                    settle(unit)
+
+                while not finished.empty():
+                    future = finished.get()
+                    unit = futures.pop(future)
+                    try:
+                        sent[unit], error = future.result()
+                    except Exception as e:
+                        # The worker died, chunks it sent are still loaded if they arrive first
+                        sent[unit], error = loaded[unit], e
+                    if error != None:
+                        errors.setdefault(unit, error)
+                    settle(unit)
+
+    if any(x.average == 0 for x in sources):
+        import rollup
+        rollup.refresh_rollups()
+
+    logger.info("Ingested %s rows from %s sources in %.1f s.", sum(x['rows'] for x in result.values()), len(sources), time.perf_counter() - start)
+
+    return result
+
+SOURCES = {x.name: x for x in [DownloadToolSource, SharePointSource, RambollSource, CsvSource]} # File sources by name for the command line
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load CSV readings into the readings table.')
+    parser.add_argument('source', choices=list(SOURCES))
+    parser.add_argument('paths', nargs='+', help='Files, directories or glob patterns.')
+    parser.add_argument('--average', type=int, default=0)
+    parser.add_argument('--priority', type=int, help='Defaults to model.SOURCE_PRIORITIES.')
+    parser.add_argument('--tz', default='UTC', help='Time zone of time stamps without one.')
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+    parser.add_argument('--chunksize', type=int, default=INGEST_CHUNKSIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(name)s : %(message)s')
+
+    source = SOURCES[args.source](args.paths, tz=args.tz, priority=args.priority, average=args.average)
+    result = ingest([source], max_workers=args.workers, chunksize=args.chunksize)
+    for name, x in result.items():
+        print(f"{name}: {x['units']} units, {x['rows']} rows, {len(x['failed'])} failed")
@@ -0,0 +1,338 @@
+"""
+In-process metrics for the fetch pipeline and sinks to export them.
+
+purpleair.py records, for every request and every get_* function:
+
+    purpleair_request_seconds          histogram  endpoint, method, status   Time to send a request and download the body
+    purpleair_requests_total           counter    endpoint, method, status
+    purpleair_retries_total            counter    endpoint, reason           Retries after a retryable status or error
+    purpleair_points_total             counter    endpoint                   Estimated API points charged
+    purpleair_rate_limit_wait_seconds  histogram  priority                   Time waiting for PointsScheduler
+    purpleair_response_bytes_total     counter    endpoint
+    purpleair_json_decode_seconds      histogram  endpoint
+    purpleair_rows_decoded_total       counter    function
+    purpleair_dataframe_build_seconds  histogram  function                   Time spent in decode_data
+    purpleair_function_seconds         histogram  function, status           Total time of each get_* call
+
+Metrics are always aggregated in memory, see snapshot(). A sink also receives each observation as it is made and the
+aggregates when flush() is called. The sink is chosen with set_sink() or the PURPLEAIR_METRICS environment variable:
+
+    PURPLEAIR_METRICS=prometheus:/var/lib/node_exporter/purpleair.prom  # Textfile for the node_exporter textfile collector
+    PURPLEAIR_METRICS=jsonl:./metrics.jsonl                             # One JSON object per observation
+
+Without either, NullSink discards observations and only the in-memory aggregates are kept.
+"""
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300] # Upper bounds of histogram buckets
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+_sink = None
+_sink_lock = threading.Lock()
+
+_function = contextvars.ContextVar('metrics_function', default='')
+
+class Sink:
+    """
+    Receives metrics. Subclasses override observe, flush or both.
+    """
+    def observe(self, kind, name, value, labels):
+        """
+        Called with every counter increment and histogram observation. kind is 'counter' or 'histogram'.
+        """
+        pass
+
+    def flush(self, snapshot):
+        """
+        Called by metrics.flush() with the aggregates, see snapshot().
+        """
+        pass
+
+    def close(self):
+        pass
+
+class NullSink(Sink):
+    """
+    Discards every observation.
+    """
+    pass
+
+class JsonLinesSink(Sink):
+    """
+    Appends one JSON object per observation to a file, ie. to find the slowest requests of a night's run.
+
+    Each line has time (UNIX seconds), kind, metric, value and the labels.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def observe(self, kind, name, value, labels):
+        import json
+
+        line = json.dumps({'time': time.time(), 'kind': kind, 'metric': name, 'value': value, **labels})
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def flush(self, snapshot):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class PrometheusTextfileSink(Sink):
+    """
+    Replaces a file in the Prometheus text exposition format with the aggregates on every flush.
+
+    The file is written to a temporary file and renamed, so the node_exporter textfile collector never reads a partial file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def flush(self, snapshot):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(to_prometheus(snapshot))
+        os.replace(tmp_path, self.path)
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def increment(name, value=1, **labels):
+    """
+    Adds value to a counter.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    get_sink().observe('counter', name, value, labels)
+
+def observe(name, value, **labels):
+    """
+    Records one observation in a histogram with SECONDS_BUCKETS.
+    """
+    key = _key(name, labels)
+    i = bisect.bisect_left(SECONDS_BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * (len(SECONDS_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+    get_sink().observe('histogram', name, value, labels)
+
+def current_function():
+    """
+    Returns the name of the innermost instrumented function running in this context, see instrument.
+    """
+    return _function.get()
+
+def instrument(name):
+    """
+    Decorator recording purpleair_function_seconds for each call of a function, labelled with name and whether it raised.
+
+    While the function runs, current_function() returns name so nested metrics such as rows decoded can be labelled
+    with it. For generator functions only the time spent producing items is counted, not the time the caller spends
+    on each item.
+    """
+    import inspect
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator(*args, **kwargs):
+                elapsed = 0
+                status = 'ok'
+                items = func(*args, **kwargs)
+                try:
+                    while True:
+                        token = _function.set(name)
+                        start = time.perf_counter()
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                            _function.reset(token)
+                        yield item
+                except GeneratorExit:
+                    raise
+                except BaseException:
+                    status = 'error'
+                    raise
+                finally:
+                    items.close()
+                    observe('purpleair_function_seconds', elapsed, function=name, status=status)
+            return generator
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _function.set(name)
+            start = time.perf_counter()
+            status = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                status = 'error'
+                raise
+            finally:
+                observe('purpleair_function_seconds', time.perf_counter() - start, function=name, status=status)
+                _function.reset(token)
+        return wrapper
+
+    return decorator
+
+def snapshot():
+    """
+    Returns a copy of the aggregates.
+
+    Returns:
+    --------
+    dict
+        'counters', a list of dicts with metric, labels and value, and 'histograms', a list of dicts with metric, labels,
+        buckets (cumulative counts for each of SECONDS_BUCKETS and +Inf), sum and count.
+    """
+    with _lock:
+        counters = [{'metric': name, 'labels': dict(labels), 'value': value} for (name, labels), value in _counters.items()]
+        histograms = []
+        for (name, labels), x in _histograms.items():
+            cumulative = []
+            total = 0
+            for n in x['buckets']:
+                total += n
+                cumulative.append(total)
+            histograms.append({'metric': name, 'labels': dict(labels), 'buckets': cumulative, 'sum': x['sum'], 'count': x['count']})
+
+    return {'counters': counters, 'histograms': histograms}
+
+def summary(metric='purpleair_function_seconds', by='function'):
+    """
+    Returns the count, total and mean seconds of a histogram grouped by one label, slowest total first.
+
+    Returns:
+    --------
+    dict
+        Map of label value to a dict with count, seconds and mean.
+    """
+    result = {}
+    for x in snapshot()['histograms']:
+        if x['metric'] != metric:
+            continue
+        group = result.setdefault(x['labels'].get(by, ''), {'count': 0, 'seconds': 0.0})
+        group['count'] += x['count']
+        group['seconds'] += x['sum']
+    for x in result.values():
+        x['mean'] = x['seconds'] / x['count'] if x['count'] > 0 else 0
+
+    return dict(sorted(result.items(), key=lambda x: -x[1]['seconds']))
+
+def to_prometheus(snapshot):
+    """
+    Formats a snapshot in the Prometheus text exposition format.
+    """
+    def labels(x, extra=None):
+        x = dict(x, **(extra or {}))
+        if len(x) == 0:
+            return ''
+        values = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in x.items())
+        return "{" + values + "}"
+
+    lines = []
+    typed = set()
+    for x in sorted(snapshot['counters'], key=lambda x: x['metric']):
+        if x['metric'] not in typed:
+            lines.append(f"# TYPE {x['metric']} counter")
+            typed.add(x['metric'])
+        lines.append(f"{x['metric']}{labels(x['labels'])} {x['value']}")
+    for x in sorted(snapshot['histograms'], key=lambda x: x['metric']):
+        if x['metric'] not in typed:
+            lines.append(f"# TYPE {x['metric']} histogram")
+            typed.add(x['metric'])
+        for bound, n in zip([str(b) for b in SECONDS_BUCKETS] + ['+Inf'], x['buckets']):
+            lines.append(f"{x['metric']}_bucket{labels(x['labels'], {'le': bound})} {n}")
+        lines.append(f"{x['metric']}_sum{labels(x['labels'])} {x['sum']}")
+        lines.append(f"{x['metric']}_count{labels(x['labels'])} {x['count']}")
+
+    return "\n".join(lines) + "\n"
+
+def sink_from_env(value=None):
+    """
+    Returns the sink described by value or the PURPLEAIR_METRICS environment variable, ie. 'prometheus:<path>' or 'jsonl:<path>'.
+    """
+    value = os.environ.get('PURPLEAIR_METRICS', '') if value == None else value
+    if value == '':
+        return NullSink()
+    kind, _, path = value.partition(':')
+    if kind == 'prometheus':
+        return PrometheusTextfileSink(path)
+    if kind == 'jsonl':
+        return JsonLinesSink(path)
+    raise ValueError(f"Unknown metrics sink {value}. Use prometheus:<path> or jsonl:<path>.")
+
+def get_sink():
+    """
+    Returns the sink observations are sent to, creating it from PURPLEAIR_METRICS on first use.
+    """
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = sink_from_env()
+                if not isinstance(_sink, NullSink):
+                    import atexit
+                    atexit.register(flush)
+                    logger.info("Sending metrics to %s.", type(_sink).__name__)
+    return _sink
+
+def set_sink(sink):
+    """
+    Replaces the sink, closing the previous one. None goes back to PURPLEAIR_METRICS.
+    """
+    global _sink
+    with _sink_lock:
+        previous = _sink
+        _sink = sink
+    if previous is not None:
+        previous.close()
+
+def flush():
+    """
+    Sends the aggregates to the sink, ie. rewrites the Prometheus textfile.
+    """
+    try:
+        get_sink().flush(snapshot())
+    except Exception as e:
+        logger.error("Failed to flush metrics: %r", e)
+
+def reset():
+    """
+    Clears the aggregates.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def endpoint(url):
+    """
+    Returns the endpoint of an API url as a metric label, with ids replaced, ie. groups/:id/members/:id/history.
+    """
+    path = url.split('?', 1)[0]
+    i = path.find('/v1/')
+    path = path[i + 4:] if i >= 0 else path.split('://', 1)[-1].partition('/')[2]
+    return "/".join(':id' if x.isdigit() else x for x in path.strip('/').split('/'))
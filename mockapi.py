@@ -0,0 +1,448 @@
+"""
+A local stand-in for the PurpleAir API for testing and benchmarking without API keys or points.
+
+Serves the /v1/organization, /v1/groups and /v1/groups/{group_id}/members endpoints used by purpleair.py with
+synthetic sensor data. Scale, latency and error rates are configurable. Run from the command line or use
+MockPurpleAir in a script:
+
+    with MockPurpleAir(members=100, latency=0.2) as api:
+        purpleair.set_api_url(api.url)
+        purpleair.get_members_data(api.group_id)
+"""
+import json
+import logging
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+SENSOR_INDEX_START = 100000 # First synthetic sensor index
+MEMBER_ID_START = 500000 # First synthetic member id
+REALTIME_INTERVAL = 120 # Seconds between real-time history readings
+
+# Range of synthetic values for each field
+FIELD_RANGES = {
+    'humidity': (20, 90),
+    'temperature': (20, 95),
+    'pressure': (970, 1010),
+    'pm1.0': (0, 25),
+    'pm2.5': (0, 40),
+    'pm10.0': (0, 60),
+    '0.3_um_count': (100, 3000),
+    '0.5_um_count': (50, 1000),
+    '1.0_um_count': (10, 300),
+    '2.5_um_count': (0, 50),
+    '5.0_um_count': (0, 10),
+    '10.0_um_count': (0, 5),
+}
+
+class MockPurpleAir:
+    """
+    Synthetic PurpleAir API served on a local thread per request.
+
+    Parameters:
+    -----------
+    members : int
+        The number of sensors in the initial group.
+
+    latency : float
+        Seconds to wait before answering each request.
+
+    error_rate : float
+        The fraction of requests answered with a 503 (or 429 for rate_limit_rate) instead of data.
+
+    rate_limit_rate : float
+        The fraction of requests answered with a 429 and a Retry-After header.
+
+    retry_after : int
+        The Retry-After seconds sent with 429 and 503 responses.
+
+    max_rows : int
+        Optional limit on the number of rows returned by a history request.
+
+    seed : int
+        Seed for the synthetic data and error injection.
+
+    host, port :
+        The address to listen on. Port 0 picks a free port.
+    """
+    def __init__(self, members=100, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=0, max_rows=None, seed=0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.max_rows = max_rows
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'rows': 0, 'bytes': 0}
+
+        self.groups = {}
+        self.next_group_id = 1000
+        self.next_member_id = MEMBER_ID_START
+        self.group_id = self.add_group('mock')
+        for i in range(members):
+            self.add_member(self.group_id, SENSOR_INDEX_START + i)
+
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        logger.info("Starting mock PurpleAir API at %s", self.url)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        logger.info("Stopping mock PurpleAir API at %s", self.url)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def sensors(self):
+        with self.lock:
+            return [x['sensor_index'] for x in self.groups[self.group_id]['members'].values()]
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {x: 0 for x in self.stats}
+
+    def add_group(self, name):
+        with self.lock:
+            group_id = self.next_group_id
+            self.next_group_id += 1
+            self.groups[group_id] = {'name': name, 'created': int(time.time()), 'members': {}}
+        return group_id
+
+    def add_member(self, group_id, sensor_index):
+        with self.lock:
+            members = self.groups[group_id]['members']
+            for member_id, member in members.items():
+                if member['sensor_index'] == sensor_index:
+                    return member_id
+            member_id = self.next_member_id
+            self.next_member_id += 1
+            members[member_id] = {'id': member_id, 'sensor_index': sensor_index, 'created': int(time.time())}
+        return member_id
+
+    def value(self, sensor_index, field, t):
+        """
+        Returns a deterministic synthetic value for a sensor, field and UNIX time stamp. t may be a numpy array.
+        """
+        import numpy as np
+
+        field = field.split('|')[0]
+        key = field if field in FIELD_RANGES else '.'.join(field.split('_')[0].split('.')[:2])
+        low, high = FIELD_RANGES.get(key, (0, 100))
+        t = np.asarray(t, dtype='int64')
+        phase = (sensor_index % 97) / 97 * 2 * math.pi
+        daily = (1 + np.sin(2 * math.pi * t / 86400 + phase)) / 2
+        noise = ((sensor_index * 7919 + t * 104729 + len(field) * 31) % 1000) / 1000
+        value = low + (high - low) * (0.8 * daily + 0.2 * noise)
+        if field.endswith('_b'):
+            value = value * 1.02
+        return value
+
+    def field_value(self, sensor_index, field, t, member):
+        name, _, precision = field.partition('|')
+        if name == 'sensor_index':
+            return sensor_index
+        if name in ['last_seen', 'time_stamp']:
+            return int(t)
+        if name == 'name':
+            return f"MORPC-MOCK-{sensor_index}"
+        if name == 'model':
+            return 'PA-II'
+        if name == 'hardware':
+            return '2.0+BME280+PMSX003-B+PMSX003-A'
+        if name in ['date_created', 'last_modified']:
+            return member['created']
+        if name == 'location_type':
+            return 0
+        if name == 'latitude':
+            return round(39.96 + ((sensor_index * 37) % 600 - 300) / 1000, 6)
+        if name == 'longitude':
+            return round(-83.0 + ((sensor_index * 53) % 600 - 300) / 1000, 6)
+        if name == 'altitude':
+            return 800 + sensor_index % 100
+        if name == 'firmware_version':
+            return '7.04'
+        if name == 'firmware_upgrade':
+            return None
+        if name == 'rssi':
+            return -40 - (sensor_index + int(t) // 3600) % 50
+        if name == 'uptime':
+            return (int(t) // 60 + sensor_index) % 40000
+        if name == 'pa_latency':
+            return 200 + (sensor_index * 13 + int(t)) % 800
+        if name == 'memory':
+            return 15000 + sensor_index % 5000
+        if name == 'channel_state':
+            return 3
+        value = float(self.value(sensor_index, name, t))
+        if precision.startswith('d'):
+            return round(value, int(precision[1:]))
+        return value
+
+    def members_payload(self, group_id, fields):
+        now = int(time.time())
+        members = list(self.groups[group_id]['members'].values())
+        fields = ['sensor_index'] + [x for x in fields if x.split('|')[0] != 'sensor_index']
+        data = [[self.field_value(x['sensor_index'], f, now - x['sensor_index'] % 120, x) for f in fields] for x in members]
+        return {
+            'api_version': 'mock',
+            'time_stamp': now,
+            'data_time_stamp': now,
+            'group_id': group_id,
+            'max_age': 604800,
+            'firmware_default_version': '7.04',
+            'fields': fields,
+            'data': data,
+        }
+
+    def history_payload(self, group_id, member_id, fields, average, start, end):
+        member = self.groups[group_id]['members'][member_id]
+        sensor_index = member['sensor_index']
+        interval = REALTIME_INTERVAL if average == 0 else average * 60
+        first = start - start % interval + (interval if start % interval else 0)
+        times = range(first, end + 1, interval)
+        if self.max_rows != None:
+            times = list(times)[-self.max_rows:]
+        fields = ['time_stamp'] + [x for x in fields if x.split('|')[0] != 'time_stamp']
+        columns = [list(times)]
+        for f in fields[1:]:
+            name, _, precision = f.partition('|')
+            if name.startswith('pm') or name.endswith('_count') or name in ['humidity', 'temperature', 'pressure']:
+                values = self.value(sensor_index, name, columns[0])
+                if precision.startswith('d'):
+                    values = values.round(int(precision[1:]))
+                columns.append(values.tolist())
+            else:
+                columns.append([self.field_value(sensor_index, f, t, member) for t in columns[0]])
+        data = [list(x) for x in zip(*columns)]
+        return {
+            'api_version': 'mock',
+            'time_stamp': int(time.time()),
+            'data_time_stamp': int(time.time()),
+            'sensor_index': sensor_index,
+            'start_timestamp': start,
+            'end_timestamp': end,
+            'average': average,
+            'fields': fields,
+            'data': data,
+        }
+
+def _serve(kwargs, ready):
+    api = MockPurpleAir(**kwargs)
+    ready.put(api.url)
+    api.server.serve_forever()
+
+class MockPurpleAirProcess:
+    """
+    Runs MockPurpleAir in a separate process so the synthetic data generation does not compete with the client for
+    the GIL or show up in its memory. Takes the same arguments as MockPurpleAir and exposes url, group_id, sensors,
+    stats and reset_stats().
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.process = None
+        self.url = None
+
+    def start(self):
+        import multiprocessing
+
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_serve, args=(self.kwargs, ready), daemon=True)
+        self.process.start()
+        self.url = ready.get(timeout=60)
+        logger.info("Started mock PurpleAir API process at %s", self.url)
+        return self
+
+    def stop(self):
+        logger.info("Stopping mock PurpleAir API process at %s", self.url)
+        self.process.terminate()
+        self.process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _state(self, method='GET'):
+        import urllib.request
+
+        request = urllib.request.Request(f"{self.url}/_mock", method=method)
+        with urllib.request.urlopen(request) as r:
+            return json.loads(r.read())
+
+    @property
+    def group_id(self):
+        return self._state()['group_id']
+
+    @property
+    def sensors(self):
+        return self._state()['sensors']
+
+    @property
+    def stats(self):
+        return self._state()['stats']
+
+    def reset_stats(self):
+        self._state('DELETE')
+
+def _handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def send(self, status, body=None, headers=None, count=True):
+            payload = b'' if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, str(v))
+            self.end_headers()
+            self.wfile.write(payload)
+            if count:
+                with api.lock:
+                    api.stats['bytes'] += len(payload)
+                    if body is not None and 'data' in body:
+                        api.stats['rows'] += len(body['data'])
+
+        def error(self, status, error, description):
+            self.send(status, {'api_version': 'mock', 'error': error, 'description': description})
+
+        def route(self, method):
+            if api.latency > 0:
+                time.sleep(api.latency)
+
+            with api.lock:
+                if not self.path.endswith('/_mock'):
+                    api.stats['requests'] += 1
+                roll = api.random.random() if not self.path.endswith('/_mock') else 1
+            if roll < api.rate_limit_rate:
+                with api.lock:
+                    api.stats['errors'] += 1
+                return self.send(429, {'error': 'RateLimitExceededError'}, headers={'Retry-After': api.retry_after})
+            if roll < api.rate_limit_rate + api.error_rate:
+                with api.lock:
+                    api.stats['errors'] += 1
+                return self.send(503, {'error': 'ServiceUnavailableError'}, headers={'Retry-After': api.retry_after})
+
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            parts = [x for x in url.path.split('/') if x != ''][1:]
+
+            if parts == ['_mock']:
+                # Not part of the PurpleAir API. Lets a client in another process read the mock's state.
+                with api.lock:
+                    if method == 'DELETE':
+                        api.stats = {x: 0 for x in api.stats}
+                    stats = dict(api.stats)
+                    sensors = [x['sensor_index'] for x in api.groups.get(api.group_id, {'members': {}})['members'].values()]
+                return self.send(200, {'group_id': api.group_id, 'sensors': sensors, 'stats': stats}, count=False)
+            fields = query['fields'].split(',') if 'fields' in query else []
+
+            try:
+                if parts == ['organization'] and method == 'GET':
+                    return self.send(200, {'api_version': 'mock', 'organization_id': 'mock', 'organization_name': 'Mock', 'remaining_points': 10**9, 'consumption_rate': 0})
+
+                if parts == ['groups'] and method == 'GET':
+                    groups = [{'id': k, 'name': v['name'], 'created': v['created']} for k, v in api.groups.items()]
+                    return self.send(200, {'api_version': 'mock', 'groups': groups})
+
+                if parts == ['groups'] and method == 'POST':
+                    group_id = api.add_group(query.get('name', 'mock'))
+                    return self.send(201, {'api_version': 'mock', 'group_id': group_id})
+
+                group_id = int(parts[1])
+                if group_id not in api.groups:
+                    return self.error(404, 'NotFoundError', f"Group {group_id} does not exist.")
+                group = api.groups[group_id]
+
+                if len(parts) == 2 and method == 'GET':
+                    return self.send(200, {'api_version': 'mock', 'group_id': group_id, 'members': list(group['members'].values())})
+
+                if len(parts) == 2 and method == 'DELETE':
+                    with api.lock:
+                        del api.groups[group_id]
+                    return self.send(204)
+
+                if len(parts) == 3 and method == 'GET':
+                    return self.send(200, api.members_payload(group_id, fields))
+
+                if len(parts) == 3 and method == 'POST':
+                    member_id = api.add_member(group_id, int(query['sensor_index']))
+                    return self.send(201, {'api_version': 'mock', 'group_id': group_id, 'member_id': member_id})
+
+                member_id = int(parts[3])
+                if member_id not in group['members']:
+                    return self.error(404, 'NotFoundError', f"Member {member_id} does not exist in group {group_id}.")
+
+                if len(parts) == 4 and method == 'DELETE':
+                    with api.lock:
+                        del group['members'][member_id]
+                    return self.send(204)
+
+                if len(parts) == 5 and parts[4] == 'history' and method == 'GET':
+                    now = int(time.time())
+                    end = int(query.get('end_timestamp', now))
+                    start = int(query.get('start_timestamp', end - 86400))
+                    return self.send(200, api.history_payload(group_id, member_id, fields, int(query.get('average', 0)), start, end))
+
+            except (KeyError, ValueError, IndexError) as e:
+                return self.error(400, 'InvalidRequestError', repr(e))
+
+            return self.error(404, 'NotFoundError', f"{method} {url.path} is not supported by the mock API.")
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_POST(self):
+            self.route('POST')
+
+        def do_DELETE(self):
+            self.route('DELETE')
+
+    return Handler
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a mock PurpleAir API with synthetic data.')
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api = MockPurpleAir(members=args.members, latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed, host=args.host, port=args.port)
+    print(f"Mock PurpleAir API for group {api.group_id} at {api.url}. Set PURPLEAIR_API_URL to use it.")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.server.server_close()
@@ -1,13 +1,108 @@
-from calendar import firstweekday
-from re import L
-from sqlalchemy import Boolean, Column, Date, Float, ForeignKey, String, Integer, create_engine
-from sqlalchemy.orm import relationship, sessionmaker, declarative_base, column_property
+import logging
+import os
+import threading
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, ForeignKey, String, Integer, Table
+from sqlalchemy.orm import relationship, declarative_base, column_property
 
-DB_URL = 'sqlite:///./test.db'
+logger = logging.getLogger(__name__)
 
-engine = create_engine(DB_URL)
+DB_URL = 'sqlite:///./test.db' # Default database, overridden by the PURPLEAIR_DB_URL environment variable
 
-SessionLocal = sessionmaker(bind=engine)
+# Pragmas applied to every new SQLite connection. WAL lets readers continue while a bulk load is writing.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -64000, # Negative values are KiB, ie. 64 MB
+    'mmap_size': 268435456,
+}
+
+SPATIALITE = 'mod_spatialite' # SQLite extension loaded on each connection if available, None to never load it. See spatial.py
+
+LOAD_CHUNKSIZE = 50000 # Rows per executemany batch in load_readings
+LOAD_PRECISION = 3 # Decimals kept when loading float32 readings, see purpleair.DATA_FIELDS_QUERY
+
+# Priority of each source of readings. A stored reading is only replaced by one from a source of the same or higher
+# priority, see load_readings. Readings stored before sources were recorded have none and are always replaced.
+SOURCE_PRIORITIES = {
+    'api': 30,
+    'download_tool': 20, # PurpleAir Data Download Tool CSVs
+    'sharepoint': 20, # Historical CSVs kept on MORPC SharePoint
+    'ramboll': 10, # Ramboll database exports
+}
+DEFAULT_SOURCE_PRIORITY = 0 # Priority of sources not in SOURCE_PRIORITIES
+
+_db_url = None
+_engine = None
+_sessionmaker = None
+_engine_lock = threading.RLock()
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for k, v in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {k}={v}")
+    cursor.close()
+
+def get_engine():
+    """
+    Returns the database engine, creating it and any missing tables and columns on first use.
+
+    Connects to the url passed to set_db_url(), else the PURPLEAIR_DB_URL environment variable, else DB_URL. Importing
+    this module does not touch the database.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                from sqlalchemy import create_engine, event
+
+                url = _db_url if _db_url != None else os.environ.get('PURPLEAIR_DB_URL', DB_URL)
+                logger.debug("Connecting to database %s", url)
+                engine = create_engine(url)
+                if engine.dialect.name == 'sqlite':
+                    import spatial
+                    event.listen(engine, 'connect', _set_sqlite_pragmas)
+                    event.listen(engine, 'connect', spatial.load_spatialite)
+                Base.metadata.create_all(bind=engine)
+                _add_missing_columns(engine)
+                if engine.dialect.name == 'sqlite':
+                    spatial.init_spatial(engine)
+                _engine = engine
+    return _engine
+
+def set_db_url(url):
+    """
+    Points get_engine() at a different database. The current engine, if any, is disposed.
+    """
+    global _db_url, _engine, _sessionmaker
+
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        logger.info("Using database %s", url)
+        _db_url = url
+        _engine = None
+        _sessionmaker = None
+
+def get_sessionmaker():
+    """
+    Returns a sessionmaker bound to get_engine(), creating it on first use.
+    """
+    global _sessionmaker
+    if _sessionmaker is None:
+        with _engine_lock:
+            if _sessionmaker is None:
+                from sqlalchemy.orm import sessionmaker
+                _sessionmaker = sessionmaker(bind=get_engine())
+    return _sessionmaker
+
+def __getattr__(name):
+    # engine and SessionLocal used to be created at import, keep them available as attributes
+    if name == 'engine':
+        return get_engine()
+    if name == 'SessionLocal':
+        return get_sessionmaker()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 Base = declarative_base()
 
@@ -45,8 +140,12 @@ class Deployment(Base):
     # "Location Name" when registering on Purple Air
     name = relationship('Registration', back_populates='deployment_name') 
     index = Column(Integer)
+    deployment_id = Column(String) # "Sensor ID Deployment" in the Deployment Log
     start_date = Column(Date)
     end_date = Column(Date)
+    # The start and end with the time of day, as in the Deployment Log (purpleair.DEPLOYMENT_TZ)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
 
     # Deployments of a many to one relationships with locations, hotspots, contacts
     location_id = Column(Integer, ForeignKey('locations.id'))
@@ -57,15 +156,18 @@ class Deployment(Base):
 
 
     contact_id = Column(Integer, ForeignKey('contacts.id'))
-    contact_fullname = relationship('Contacts', back_populates='deployments')
+    contact_fullname = relationship('Contact', back_populates='deployments')
 
-    def __init__(self, id, registration_id, name, index, start_date, end_date, location, hotspot, contact_fullname):
+    def __init__(self, id, registration_id, name, index, start_date, end_date, location, hotspot, contact_fullname, deployment_id=None, start_time=None, end_time=None):
         self.id = id
+        self.deployment_id = deployment_id
         self.registration_id = registration_id
         self.name = name
         self.index = index
         self.start_date = start_date
         self.end_date = end_date
+        self.start_time = start_time
+        self.end_time = end_time
         self.location = location
         self.hotspot = hotspot
         self.contact_fullname = contact_fullname
@@ -107,7 +209,7 @@ class Hotspot(Base):
     pwd = Column(String)
 
     def __init__(self, id, deployments, serial, mac_addr, ssid, pwd):
-        self.id = id, 
+        self.id = id
         self.deployments = deployments
         self.serial = serial
         self.mac_addr = mac_addr
@@ -117,11 +219,176 @@ class Hotspot(Base):
     def __rep__(self):
         return f"hotspot {self.id}: {self.mac_addr}, {self.serial}"
 
+class DeploymentLogSource(Base):
+    __tablename__ = 'deployment_log_source'
+
+    # The Deployment Log workbook currently loaded into the deployments and locations tables.
+    # The workbook is parsed again only when its modification time or size change and its content hash differs.
+    path = Column(String, primary_key=True)
+    sheet_name = Column(String, primary_key=True)
+    mtime = Column(Float)
+    size = Column(Integer)
+    sha256 = Column(String)
+    loaded = Column(Integer)
+
+    def __init__(self, path, sheet_name, mtime, size, sha256, loaded):
+        self.path = path
+        self.sheet_name = sheet_name
+        self.mtime = mtime
+        self.size = size
+        self.sha256 = sha256
+        self.loaded = loaded
+
+    def __rep__(self):
+        return f"deployment log {self.path}, sheet {self.sheet_name}: {self.sha256}"
+
+class FetchState(Base):
+    __tablename__ = 'fetch_state'
+
+    # High-water mark of history ingested from the API, one row per sensor and average.
+    # Time stamps are stored as UNIX time stamps (UTC).
+    sensor_index = Column(Integer, primary_key=True)
+    average = Column(Integer, primary_key=True)
+    last_time_stamp = Column(Integer)
+    updated = Column(Integer)
+
+    def __init__(self, sensor_index, average, last_time_stamp, updated):
+        self.sensor_index = sensor_index
+        self.average = average
+        self.last_time_stamp = last_time_stamp
+        self.updated = updated
+
+    def __rep__(self):
+        return f"fetch state {self.sensor_index}, average {self.average}: {self.last_time_stamp}"
+
+class Reading(Base):
+    __tablename__ = 'readings'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # Sensor readings as returned by purpleair.get_member_history and get_members_data.
+    # See output_data/morpc-purpleair-sensor-data.schema.yaml. time_stamp is stored as a UNIX time stamp (UTC)
+    # so range scans on the primary key stay integer comparisons.
+    sensor_index = Column(Integer, primary_key=True)
+    time_stamp = Column(Integer, primary_key=True)
+    average = Column(Integer, primary_key=True)
+    humidity = Column('humidity', Float)
+    temperature = Column('temperature', Float)
+    pressure = Column('pressure', Float)
+    pm1_0_atm_a = Column('pm1.0_atm_a', Float)
+    pm1_0_atm_b = Column('pm1.0_atm_b', Float)
+    pm1_0_cf_1_a = Column('pm1.0_cf_1_a', Float)
+    pm1_0_cf_1_b = Column('pm1.0_cf_1_b', Float)
+    pm2_5_alt_a = Column('pm2.5_alt_a', Float)
+    pm2_5_alt_b = Column('pm2.5_alt_b', Float)
+    pm2_5_atm_a = Column('pm2.5_atm_a', Float)
+    pm2_5_atm_b = Column('pm2.5_atm_b', Float)
+    pm2_5_cf_1_a = Column('pm2.5_cf_1_a', Float)
+    pm2_5_cf_1_b = Column('pm2.5_cf_1_b', Float)
+    pm10_0_atm_a = Column('pm10.0_atm_a', Float)
+    pm10_0_atm_b = Column('pm10.0_atm_b', Float)
+    pm10_0_cf_1_a = Column('pm10.0_cf_1_a', Float)
+    pm10_0_cf_1_b = Column('pm10.0_cf_1_b', Float)
+    um_count_0_3 = Column('0.3_um_count', Float)
+    um_count_0_5 = Column('0.5_um_count', Float)
+    um_count_1_0 = Column('1.0_um_count', Float)
+    um_count_2_5 = Column('2.5_um_count', Float)
+    um_count_5_0 = Column('5.0_um_count', Float)
+    um_count_10_0 = Column('10.0_um_count', Float)
+
+    # Where the reading was loaded from and the priority of that source. See SOURCE_PRIORITIES.
+    source = Column(String)
+    source_priority = Column(Integer)
+
+    def __rep__(self):
+        return f"reading {self.sensor_index}, average {self.average}: {self.time_stamp}"
+
+READING_KEYS = ['sensor_index', 'time_stamp', 'average']
+READING_SOURCE = ['source', 'source_priority']
+READING_FIELDS = [x.name for x in Reading.__table__.columns if x.name not in READING_KEYS + READING_SOURCE]
+
+class SensorHealth(Base):
+    __tablename__ = 'sensor_health'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # Scored health checks as returned by purpleair.get_members_health, one row per sensor and check.
+    # See output_data/morpc-purpleair-sensor-health.schema.yaml. Times are stored as UNIX time stamps (UTC).
+    sensor_index = Column(Integer, primary_key=True)
+    datetime_check = Column(Integer, primary_key=True)
+    last_seen = Column(Integer)
+    last_modified = Column(Integer)
+    firmware_version = Column(String)
+    firmware_upgrade = Column(String)
+    rssi = Column(Integer)
+    uptime = Column(Integer)
+    pa_latency = Column(Integer)
+    memory = Column(Integer)
+    channel_state = Column(Integer)
+    ab_difference = Column(Float)
+    status = Column(String)
+    issues = Column(String)
+
+    def __rep__(self):
+        return f"health {self.sensor_index}, {self.datetime_check}: {self.status}"
+
+HEALTH_KEYS = ['sensor_index', 'datetime_check']
+HEALTH_TIMES = ['datetime_check', 'last_seen', 'last_modified']
+
+class SensorMetadata(Base):
+    __tablename__ = 'sensor_metadata'
+
+    # Latest metadata of each sensor as returned by purpleair.get_members_metadata.
+    # See output_data/morpc-purpleair-sensor-metadata.schema.yaml. date_created is stored as a UNIX time stamp (UTC).
+    # spatial.init_spatial indexes latitude and longitude.
+    sensor_index = Column(Integer, primary_key=True)
+    name = Column(String)
+    model = Column(String)
+    hardware = Column(String)
+    date_created = Column(Integer)
+    location_type = Column(Integer)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    altitude = Column(Float)
+    updated = Column(Integer)
+
+    def __rep__(self):
+        return f"sensor {self.sensor_index}: {self.name}, {self.latitude}, {self.longitude}"
+
+class RollupQueue(Base):
+    __tablename__ = 'rollup_queue'
+
+    # Ranges of real-time readings loaded since the rollups were last refreshed, see rollup.refresh_rollups.
+    # Time stamps are stored as UNIX time stamps (UTC).
+    id = Column(Integer, primary_key=True)
+    sensor_index = Column(Integer)
+    start = Column(Integer)
+    end = Column(Integer)
+
+    def __rep__(self):
+        return f"rollup queue {self.id}: {self.sensor_index}, {self.start}-{self.end}"
+
+ROLLUP_INTERVALS = {
+    '10min': 600,
+    'hourly': 3600,
+    'daily': 86400,
+    'monthly': None, # Calendar months
+}
+ROLLUP_STATS = ['mean', 'min', 'max', 'count']
+
+def _rollup_table(interval):
+    # One row per sensor and bucket, bucket is the UNIX time stamp (UTC) of the start of the bucket
+    columns = [Column('sensor_index', Integer, primary_key=True), Column('bucket', Integer, primary_key=True)]
+    for x in READING_FIELDS:
+        columns += [Column(f"{x}_{y}", Integer if y == 'count' else Float) for y in ROLLUP_STATS]
+
+    return Table(f"rollup_{interval}", Base.metadata, *columns, sqlite_with_rowid=False)
+
+ROLLUP_TABLES = {x: _rollup_table(x) for x in ROLLUP_INTERVALS}
+
 class Contact(Base):
     __tablename__ = 'contacts'
 
     id = Column(Integer, primary_key=True)
-    deployments = relationship('Deployments', back_populates='contact_fullname')
+    deployments = relationship('Deployment', back_populates='contact_fullname')
     firstname = Column(String)
     lastname = Column(String)
     fullname = column_property(firstname + " " + lastname)
@@ -141,4 +408,478 @@ class Contact(Base):
         return f"contact {self.id}: {self.fullname}, {self.email} {self.phone}"
 
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+def get_high_water_marks(sensor_index, average):
+    """
+    Returns the last ingested time stamp for each sensor.
+
+    Parameters:
+    -----------
+    sensor_index : list
+        The sensor indexes to look up.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+
+    Returns:
+    --------
+    dict
+        A dict of sensor index to UNIX time stamp. Sensors that have never been ingested are not included.
+    """
+    from sqlalchemy import select
+
+    table = FetchState.__table__
+    query = select(table.c.sensor_index, table.c.last_time_stamp).where(
+        table.c.average == average,
+        table.c.sensor_index.in_([int(x) for x in sensor_index])
+    )
+    with get_engine().connect() as conn:
+        marks = {x: y for x, y in conn.execute(query)}
+
+    return marks
+
+def update_high_water_marks(marks, average):
+    """
+    Records the last ingested time stamp for each sensor. A mark only ever moves forward.
+
+    Parameters:
+    -----------
+    marks : dict
+        A dict of sensor index to UNIX time stamp of the last reading ingested.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+    """
+    import time
+    from sqlalchemy import func
+    from sqlalchemy.dialects.sqlite import insert
+
+    if len(marks) == 0:
+        return
+
+    table = FetchState.__table__
+    updated = int(time.time())
+    query = insert(table).values([
+        {'sensor_index': int(x), 'average': average, 'last_time_stamp': int(y), 'updated': updated} for x, y in marks.items()
+    ])
+    query = query.on_conflict_do_update(
+        index_elements=['sensor_index', 'average'],
+        set_={
+            'last_time_stamp': func.max(table.c.last_time_stamp, query.excluded.last_time_stamp),
+            'updated': query.excluded.updated
+        }
+    )
+    with get_engine().begin() as conn:
+        conn.execute(query)
+
+def to_unix(time_stamp):
+    """
+    Converts a series of datetimes to integer UNIX time stamps. Naive datetimes are treated as UTC.
+    """
+    import pandas as pd
+
+    return (pd.to_datetime(time_stamp, utc=True) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+def load_readings(df, average=0, chunksize=LOAD_CHUNKSIZE, source='api', priority=None):
+    """
+    Bulk loads sensor readings into the readings table.
+
+    Rows are written with executemany in batches of chunksize using INSERT ... ON CONFLICT DO UPDATE, so reloading
+    a period replaces the stored values rather than failing or duplicating rows. A stored reading from a source of
+    higher priority is kept, so the same reading from several sources is stored once, from the best source. The whole
+    load is one transaction.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Readings with sensor_index and time_stamp columns and any of READING_FIELDS, ie. the return of
+        purpleair.get_member_history, get_members_history or get_members_data. Fields not in the dataframe are left
+        unchanged on existing rows.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS. Ignored if df has an average column.
+
+    chunksize : int
+        The number of rows per executemany batch.
+
+    source : str
+        The source of the readings, ie. 'api' or 'download_tool'. See ingest.py.
+
+    priority : int
+        The priority of the source. Defaults to SOURCE_PRIORITIES or DEFAULT_SOURCE_PRIORITY.
+
+    Returns:
+    --------
+    int
+        The number of rows loaded, including rows that did not replace a reading of a higher priority source.
+    """
+    import pandas as pd
+
+    if len(df) == 0:
+        return 0
+    if priority == None:
+        priority = SOURCE_PRIORITIES.get(source, DEFAULT_SOURCE_PRIORITY)
+
+    if 'sensor_index' not in df.columns:
+        raise KeyError("Readings must have a sensor_index column. See purpleair.get_member_history(by_sensor_index=True).")
+
+    fields = [x for x in READING_FIELDS if x in df.columns]
+    columns = READING_KEYS + fields + READING_SOURCE
+    values = {
+        'sensor_index': df['sensor_index'].astype('int64').tolist(),
+        'time_stamp': to_unix(df['time_stamp']).tolist(),
+        'average': df['average'].astype('int64').tolist() if 'average' in df.columns else [int(average)] * len(df),
+        'source': [source] * len(df),
+        'source_priority': [int(priority)] * len(df),
+    }
+    for x in fields:
+        if df[x].dtype == 'float32':
+            # Round away float32 representation error, the API returns at most LOAD_PRECISION decimals
+            values[x] = df[x].astype('float64').round(LOAD_PRECISION).tolist()
+        else:
+            values[x] = df[x].astype('float64').tolist()
+    rows = list(zip(*[values[x] for x in columns]))
+
+    names = ", ".join(['"%s"' % x for x in columns])
+    placeholders = ", ".join(["?"] * len(columns))
+    keys = ", ".join(READING_KEYS)
+    update = ", ".join(['"%s"=excluded."%s"' % (x, x) for x in fields + READING_SOURCE])
+    table = Reading.__tablename__
+    sql = f"INSERT INTO {table} ({names}) VALUES ({placeholders}) ON CONFLICT({keys}) "
+    if len(fields) > 0:
+        sql += f"DO UPDATE SET {update} WHERE excluded.source_priority >= COALESCE({table}.source_priority, excluded.source_priority)"
+    else:
+        sql += "DO NOTHING"
+
+    # Record the range of real-time readings loaded for each sensor so only those rollup buckets are recomputed
+    dirty = pd.DataFrame({'sensor_index': values['sensor_index'], 'time_stamp': values['time_stamp'], 'average': values['average']})
+    dirty = dirty.loc[dirty['average'] == 0].groupby('sensor_index')['time_stamp'].agg(['min', 'max'])
+    queue = [{'sensor_index': int(x), 'start': int(y), 'end': int(z)} for x, y, z in zip(dirty.index, dirty['min'], dirty['max'])]
+
+    logger.info("Loading %s readings from %s into %s in batches of %s.", len(rows), source, Reading.__tablename__, chunksize)
+    with get_engine().begin() as conn:
+        for i in range(0, len(rows), chunksize):
+            conn.exec_driver_sql(sql, rows[i:i + chunksize])
+        if len(queue) > 0:
+            conn.execute(RollupQueue.__table__.insert(), queue)
+
+    return len(rows)
+
+def read_readings(sensor_index=None, start=None, end=None, average=0, columns=None):
+    """
+    Reads stored sensor readings, scanning only the requested range of the primary key.
+
+    Parameters:
+    -----------
+    sensor_index : list
+        The sensors to read. Defaults to all sensors.
+
+    start, end : date-like
+        Optional bounds on time_stamp, inclusive. Naive values are treated as UTC.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+
+    columns : list
+        The fields to read. Defaults to READING_FIELDS.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, time_stamp (UTC datetimes) and the fields as float32, sorted by sensor_index and time_stamp, ie.
+        the columns of purpleair.get_members_history.
+    """
+    import pandas as pd
+
+    if columns == None:
+        columns = READING_FIELDS
+    unknown = [x for x in columns if x not in READING_FIELDS]
+    if len(unknown) > 0:
+        raise KeyError(f"Unknown reading fields: {', '.join(unknown)}")
+
+    where = ["average = ?"]
+    params = [int(average)]
+    if sensor_index is not None:
+        sensor_index = [int(x) for x in sensor_index]
+        where.append(f"sensor_index IN ({', '.join(['?'] * len(sensor_index))})")
+        params += sensor_index
+    if start != None:
+        where.append("time_stamp >= ?")
+        params.append(int(to_unix(pd.Series([start])).iloc[0]))
+    if end != None:
+        where.append("time_stamp <= ?")
+        params.append(int(to_unix(pd.Series([end])).iloc[0]))
+
+    names = ", ".join(['"%s"' % x for x in ['sensor_index', 'time_stamp'] + list(columns)])
+    sql = f"SELECT {names} FROM {Reading.__tablename__} WHERE {' AND '.join(where)} ORDER BY sensor_index, time_stamp"
+
+    with get_engine().connect() as conn:
+        rows = conn.exec_driver_sql(sql, tuple(params)).fetchall()
+    df = pd.DataFrame(rows, columns=['sensor_index', 'time_stamp'] + list(columns))
+    df['sensor_index'] = df['sensor_index'].astype('int64')
+    # Converted like purpleair.decode_data so the resolution is the same under any pandas version
+    df['time_stamp'] = pd.to_datetime(df['time_stamp'].to_numpy(dtype='float64'), unit='s', utc=True)
+    for x in columns:
+        df[x] = df[x].astype('float32')
+
+    return df
+
+def load_health(df):
+    """
+    Stores scored health checks in the sensor_health table, replacing any earlier copy of the same check.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        The return of purpleair.get_members_health. Columns that are not in the table, ie. name, are ignored.
+
+    Returns:
+    --------
+    int
+        The number of rows written.
+    """
+    from sqlalchemy.dialects.sqlite import insert
+
+    if len(df) == 0:
+        return 0
+
+    table = SensorHealth.__table__
+    columns = [x.name for x in table.columns if x.name in df.columns]
+    df = df[columns].copy()
+    for x in HEALTH_TIMES:
+        if x in df.columns:
+            df[x] = to_unix(df[x]).astype('Int64')
+    rows = df.astype(object).where(df.notna(), None).to_dict('records')
+
+    query = insert(table)
+    query = query.on_conflict_do_update(
+        index_elements=HEALTH_KEYS,
+        set_={x: query.excluded[x] for x in columns if x not in HEALTH_KEYS}
+    )
+    logger.info("Loading %s health checks into %s.", len(rows), table.name)
+    with get_engine().begin() as conn:
+        conn.execute(query, rows)
+
+    return len(rows)
+
+def get_health(sensor_index=None, start=None, end=None, latest=False):
+    """
+    Returns stored health checks, ie. to follow the trend of a sensor's status.
+
+    Parameters:
+    -----------
+    sensor_index : list
+        The sensors to return. Defaults to all sensors.
+
+    start, end : date-like
+        Optional bounds on datetime_check, inclusive. Naive values are treated as UTC.
+
+    latest : bool
+        If True, returns only the most recent check of each sensor.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Health checks sorted by sensor_index and datetime_check, with times as UTC datetimes.
+    """
+    import pandas as pd
+    from sqlalchemy import select, func
+
+    table = SensorHealth.__table__
+    query = select(table)
+    if sensor_index is not None:
+        query = query.where(table.c.sensor_index.in_([int(x) for x in sensor_index]))
+    if start != None:
+        query = query.where(table.c.datetime_check >= int(to_unix(pd.Series([start])).iloc[0]))
+    if end != None:
+        query = query.where(table.c.datetime_check <= int(to_unix(pd.Series([end])).iloc[0]))
+    if latest:
+        last = select(table.c.sensor_index, func.max(table.c.datetime_check).label('datetime_check')).group_by(table.c.sensor_index).subquery()
+        query = query.join(last, (table.c.sensor_index == last.c.sensor_index) & (table.c.datetime_check == last.c.datetime_check))
+    query = query.order_by(table.c.sensor_index, table.c.datetime_check)
+
+    with get_engine().connect() as conn:
+        df = pd.DataFrame(conn.execute(query).fetchall(), columns=[x.name for x in table.columns])
+    for x in HEALTH_TIMES:
+        df[x] = pd.to_datetime(df[x], unit='s', utc=True)
+
+    return df
+
+def load_metadata(df):
+    """
+    Stores the latest metadata of each sensor in the sensor_metadata table, replacing what was stored before.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        The return of purpleair.get_members_metadata.
+
+    Returns:
+    --------
+    int
+        The number of rows written.
+    """
+    import time
+    from sqlalchemy.dialects.sqlite import insert
+
+    if len(df) == 0:
+        return 0
+
+    table = SensorMetadata.__table__
+    columns = [x.name for x in table.columns if x.name in df.columns]
+    df = df[columns].copy()
+    if 'date_created' in df.columns:
+        df['date_created'] = to_unix(df['date_created']).astype('Int64')
+    df['updated'] = int(time.time())
+    rows = df.astype(object).where(df.notna(), None).to_dict('records')
+
+    query = insert(table)
+    query = query.on_conflict_do_update(
+        index_elements=['sensor_index'],
+        set_={x: query.excluded[x] for x in list(df.columns) if x != 'sensor_index'}
+    )
+    logger.info("Loading metadata for %s sensors into %s.", len(rows), table.name)
+    with get_engine().begin() as conn:
+        conn.execute(query, rows)
+
+    return len(rows)
+
+def _file_sha256(path, chunk_size=1048576):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def get_deployment_log(log_path, sheet_name=None):
+    """
+    Returns the parsed Deployment Log, re-reading the workbook only when it has changed.
+
+    The deployments are cached in the deployments and locations tables. A call compares the modification time and
+    size of the workbook to the ones recorded in deployment_log_source and, if they differ, its SHA-256 hash, so a
+    workbook that was only touched or copied is not parsed again. The tables hold one workbook at a time. Locations
+    are matched by name and kept between loads so other tables can refer to them.
+
+    Parameters:
+    -----------
+    log_path : path_like
+        The path of the Deployment Log workbook.
+
+    sheet_name : str
+        The sheet that contains the deployment log. Defaults to purpleair.DEPLOYMENT_SHEET.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The deployment id, sensor index, start, end and location columns of purpleair.read_deployment_log(). The end
+        is missing while a sensor is still deployed.
+    """
+    import os
+    import time
+    import pandas as pd
+    from sqlalchemy import select, update, delete
+    import purpleair
+
+    if sheet_name == None:
+        sheet_name = purpleair.DEPLOYMENT_SHEET
+
+    path = os.path.abspath(log_path)
+    stat = os.stat(path)
+    table = DeploymentLogSource.__table__
+
+    with get_engine().connect() as conn:
+        source = conn.execute(select(table)).mappings().first()
+
+    current = source != None and source['path'] == path and source['sheet_name'] == sheet_name
+    if current:
+        # Deployments cached before start_time and end_time were added have no time of day, parse the log again
+        with get_engine().connect() as conn:
+            current = conn.exec_driver_sql(f"SELECT 1 FROM {Deployment.__tablename__} WHERE start_date IS NOT NULL AND start_time IS NULL LIMIT 1").first() == None
+    if current and source['mtime'] == stat.st_mtime and source['size'] == stat.st_size:
+        logger.debug("Deployment log %s is unchanged, using cached deployments.", path)
+    else:
+        digest = _file_sha256(path)
+        if current and source['sha256'] == digest:
+            logger.debug("Deployment log %s was modified but its content is unchanged, using cached deployments.", path)
+            with get_engine().begin() as conn:
+                conn.execute(update(table).where(table.c.path == path, table.c.sheet_name == sheet_name).values(mtime=stat.st_mtime, size=stat.st_size))
+        else:
+            logger.info("Deployment log %s has changed, parsing sheet %s.", path, sheet_name)
+            deployments = purpleair._parse_deployment_log(path, sheet_name=sheet_name)
+            with get_engine().begin() as conn:
+                _store_deployments(conn, deployments)
+                conn.execute(delete(table))
+                conn.execute(table.insert().values(path=path, sheet_name=sheet_name, mtime=stat.st_mtime, size=stat.st_size, sha256=digest, loaded=int(time.time())))
+
+    deployment = Deployment.__table__
+    location = Location.__table__
+    query = select(
+        deployment.c.deployment_id.label(purpleair.DEPLOYMENT_ID_COL),
+        deployment.c.index.label(purpleair.DEPLOYMENT_SENSOR_COL),
+        deployment.c.start_time.label(purpleair.DEPLOYMENT_START_COL),
+        deployment.c.end_time.label(purpleair.DEPLOYMENT_END_COL),
+        location.c.location_name.label(purpleair.DEPLOYMENT_LOCATION_COL),
+    ).select_from(deployment.outerjoin(location, deployment.c.location_id == location.c.id)).order_by(deployment.c.id)
+    with get_engine().connect() as conn:
+        df = pd.DataFrame(conn.execute(query).fetchall(), columns=list(query.selected_columns.keys()))
+
+    df[purpleair.DEPLOYMENT_SENSOR_COL] = df[purpleair.DEPLOYMENT_SENSOR_COL].astype('float64')
+    for x in [purpleair.DEPLOYMENT_START_COL, purpleair.DEPLOYMENT_END_COL]:
+        df[x] = pd.to_datetime(df[x])
+
+    return df
+
+def _store_deployments(conn, deployments):
+    """
+    Replaces the deployments table with a parsed Deployment Log and adds any new locations.
+    """
+    import pandas as pd
+    from sqlalchemy import select, delete
+    import purpleair
+
+    location = Location.__table__
+    location_ids = {}
+    if purpleair.DEPLOYMENT_LOCATION_COL in deployments.columns:
+        names = deployments[purpleair.DEPLOYMENT_LOCATION_COL].dropna().astype(str).unique().tolist()
+        location_ids = {x: y for x, y in conn.execute(select(location.c.location_name, location.c.id))}
+        new = [{'location_name': x} for x in names if x not in location_ids]
+        if len(new) > 0:
+            conn.execute(location.insert(), new)
+            location_ids = {x: y for x, y in conn.execute(select(location.c.location_name, location.c.id))}
+        locations = [location_ids.get(str(x)) if not pd.isnull(x) else None for x in deployments[purpleair.DEPLOYMENT_LOCATION_COL]]
+    else:
+        logger.warning("Deployment log has no %s column, deployments are stored without locations.", purpleair.DEPLOYMENT_LOCATION_COL)
+        locations = [None] * len(deployments)
+
+    def times(x):
+        return [None if pd.isnull(y) else pd.Timestamp(y).to_pydatetime() for y in deployments[x]]
+
+    rows = [
+        {'deployment_id': None if pd.isnull(a) else str(a), 'index': None if pd.isnull(b) else int(b), 'start_date': None if c == None else c.date(),
+            'end_date': None if d == None else d.date(), 'start_time': c, 'end_time': d, 'location_id': e}
+        for a, b, c, d, e in zip(deployments[purpleair.DEPLOYMENT_ID_COL], deployments[purpleair.DEPLOYMENT_SENSOR_COL],
+            times(purpleair.DEPLOYMENT_START_COL), times(purpleair.DEPLOYMENT_END_COL), locations)
+    ]
+
+    logger.info("Storing %s deployments and %s locations.", len(rows), len(location_ids))
+    conn.execute(delete(Deployment.__table__))
+    if len(rows) > 0:
+        conn.execute(Deployment.__table__.insert(), rows)
+
+def _add_missing_columns(engine):
+    """
+    Adds columns that were added to the models after a table was created. create_all only creates missing tables.
+    """
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = [x['name'] for x in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing:
+                    logger.info("Adding column %s to table %s.", column.name, table.name)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=engine.dialect)}")
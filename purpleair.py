@@ -1,29 +1,85 @@
-# Get API keys from .env file
 from datetime import date
 import logging
+import os
+import threading
+from collections import OrderedDict
+import requests
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
-with open('.env') as env:
-    lines = env.readlines()
+DEFAULT_API_URL = 'https://api.purpleair.com/v1'
+
+def read_env(path='.env'):
+    """
+    Reads API keys from a .env file. Environment variables READ_KEY, WRITE_KEY and PURPLEAIR_API_URL override the file.
+
+    A missing file is not an error so the module can be imported without keys, ie. against mockapi.
+    """
     env = {}
-    for line in lines:
-        k, v = line.split('=')
-        env[k] = v.strip()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f.readlines():
+                if '=' not in line:
+                    continue
+                k, v = line.split('=', 1)
+                env[k.strip()] = v.strip()
+    else:
+        logger.warning("No %s file found. API keys must be set as environment variables.", path)
 
-# Construct headers
-read_header = {
-'X-API-Key': env['READ_KEY']
-}
+    for k in ['READ_KEY', 'WRITE_KEY', 'PURPLEAIR_API_URL']:
+        if k in os.environ:
+            env[k] = os.environ[k]
+
+    return env
 
-write_header = {
-'X-API-Key': env['WRITE_KEY']
+# Endpoints relative to the API url, also available as module attributes, ie. purpleair.GROUPS_URL
+API_PATHS = {
+    'GROUPS_URL': 'groups',
+    'SENSORS_URL': 'sensors',
+    'ORG_URL': 'organization',
 }
 
-# Store URLS
-GROUPS_URL = 'https://api.purpleair.com/v1/groups'
-SENSORS_URL = 'https://api.purpleair.com/v1/sensors'
-ORG_URL = 'https://api.purpleair.com/v1/organization'
+_config = None
+_config_lock = threading.Lock()
+
+def get_config():
+    """
+    Returns the API keys, headers and url, reading .env and the environment on first use. See read_env().
+
+    Importing this module does not read any files, so short-lived processes that never call the API pay nothing for it.
+
+    Returns:
+    --------
+    dict
+        'env', the values read, 'api_url', 'read_header' and 'write_header'.
+    """
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                env = read_env()
+                _config = {
+                    'env': env,
+                    'api_url': env.get('PURPLEAIR_API_URL', DEFAULT_API_URL).rstrip('/'),
+                    'read_header': {'X-API-Key': env.get('READ_KEY', '')},
+                    'write_header': {'X-API-Key': env.get('WRITE_KEY', '')},
+                }
+    return _config
+
+def _url(path):
+    return f"{get_config()['api_url']}/{path}"
+
+def __getattr__(name):
+    # env, read_header, write_header and the url constants used to be read from .env at import
+    if name in ['env', 'read_header', 'write_header']:
+        return get_config()[name]
+    if name == 'API_URL':
+        return get_config()['api_url']
+    if name in API_PATHS:
+        return _url(API_PATHS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 DATA_FIELDS = [
         'humidity',
@@ -37,6 +93,38 @@ DATA_FIELDS = [
 
 DATA_FIELDS_QUERY = [f"{x}|d3" for x in DATA_FIELDS] # Assign the number of decimals to return for pm data
 
+FIELD_PRECISION = {x: 3 for x in DATA_FIELDS} # Decimals requested for each field, None for the API default. See resolve_fields
+
+# Named subsets of DATA_FIELDS for the fields argument of get_members_data and the history functions. Each field is
+# charged points per row, so requesting only what a job needs cuts both the payload and the points cost.
+FIELD_PROFILES = {
+    'all': DATA_FIELDS,
+    'aqi': ['humidity', 'pm2.5_cf_1_a', 'pm2.5_cf_1_b'], # A/B QA and EPA correction, see quality.process
+    'pm2.5': [x for x in DATA_FIELDS if x.startswith('pm2.5_')],
+    'pm': [x for x in DATA_FIELDS if x.startswith('pm')],
+    'counts': [x for x in DATA_FIELDS if x.endswith('_um_count')],
+    'environment': ['humidity', 'temperature', 'pressure'],
+}
+
+# Column types for decoded API responses. See decode_data. Fields not listed are kept as returned.
+FIELD_DTYPES = {
+    'sensor_index': 'int64',
+    'time_stamp': 'datetime',
+    'last_seen': 'datetime',
+    'last_modified': 'datetime',
+    'date_created': 'datetime',
+    'location_type': 'Int64',
+    'rssi': 'Int64',
+    'uptime': 'Int64',
+    'pa_latency': 'Int64',
+    'memory': 'Int64',
+    'channel_state': 'Int64',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'altitude': 'float64',
+}
+FIELD_DTYPES.update({x: 'float32' for x in DATA_FIELDS})
+
 AVERAGE_LIMITS = {
     0: [30, 'days'],
     10:	[60, 'days'],
@@ -49,118 +137,788 @@ AVERAGE_LIMITS = {
     525600:	[100, 'years'],
 }
 
-def get_json_safely(url, headers, params=None):
-    import requests
+MAX_RETRIES = 5 # Number of times to retry a request that failed with a retryable status or connection error
+BACKOFF_FACTOR = 0.5 # Seconds, doubled on each retry
+BACKOFF_MAX = 60 # Seconds, upper bound on any single wait including Retry-After
+RETRY_STATUS = [429, 500, 502, 503, 504]
+POOL_SIZE = 16 # Keep-alive connections kept open to the API, should be at least the number of fetch workers
+TIMEOUT = (10, 120) # Seconds to connect and to read
+STREAM_CHUNK_SIZE = 1048576 # Bytes read from the response at a time when streaming
+STREAM_BATCH_SIZE = 50000 # Rows per batch yielded by iter_member_history
+
+GROUP_CACHE_TTL = 300 # Seconds before cached group details are fetched again
+GROUP_CACHE_SIZE = 32 # Maximum number of groups kept in the group details cache
+
+RATE_LIMIT = 5 # Requests per second sent to the API, see PointsScheduler
+RATE_BURST = 10 # Requests that can be sent at once after an idle period
+DAILY_POINTS_BUDGET = None # Maximum estimated API points spent per UTC day, None for no limit
+CALL_POINTS = 1 # Estimated points for a request that returns no sensor fields
+FIELD_POINTS = {} # Estimated points per row for each field, fields not listed cost DEFAULT_FIELD_POINTS
+DEFAULT_FIELD_POINTS = 1
+
+# Request priorities, lower values are sent first when requests are queued
+PRIORITY_LIVE = 0
+PRIORITY_HEALTH = 1
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKFILL = 10
+
+DEPLOYMENT_SHEET = 'Deployment Log'
+DEPLOYMENT_ID_COL = 'Sensor ID Deployment' # Ids ending in 00 are not field deployments
+DEPLOYMENT_SENSOR_COL = 'Sensor_Index_ID'
+DEPLOYMENT_START_COL = 'Deployment_Start'
+DEPLOYMENT_END_COL = 'Deployment_End' # Empty while the sensor is still deployed
+DEPLOYMENT_LOCATION_COL = 'Location_Name'
+DEPLOYMENT_TZ = 'America/New_York' # Time zone of the dates in the Deployment Log
+
+# Health check thresholds, see score_health
+HEALTH_STATUSES = ['healthy', 'degraded', 'stale', 'offline'] # In order of severity
+HEALTH_STALE_AGE = 600 # Seconds since last_seen before a sensor is stale, sensors report every 120 s
+HEALTH_OFFLINE_AGE = 3600 # Seconds since last_seen before a sensor is offline
+HEALTH_MIN_RSSI = -80 # WiFi signal strength in dBm below which a sensor is degraded
+HEALTH_MAX_LATENCY = 5000 # pa_latency in milliseconds above which a sensor is degraded
+HEALTH_MIN_MEMORY = 5000 # Free heap memory below which a sensor is degraded
+HEALTH_MIN_UPTIME = 10 # Uptime in minutes below which a sensor has recently restarted
+HEALTH_AB_ABS = 5 # Absolute difference between the A and B channel PM2.5 in ug/m3 ...
+HEALTH_AB_RPD = 0.7 # ... and relative percent difference above which the channels disagree
+
+class PurpleAirError(requests.HTTPError):
+    """
+    Raised when the PurpleAir API returns an unexpected status code.
+
+    Subclass of requests.HTTPError so existing handlers continue to work. Carries the status code, response body and url.
+    """
+    def __init__(self, status_code, body, url, response=None):
+        self.status_code = status_code
+        self.body = body
+        self.url = url
+        super().__init__(f"{status_code} error from {url}: {body}", response=response)
+
+class PurpleAirRateLimitError(PurpleAirError):
+    """Raised when the API is still returning 429 after all retries."""
 
-    logger.info(f"Getting data from {url} with parameters {params}.")
-    r = requests.get(url, headers=headers, params=params)
-    if r.status_code != 200:
-        logger.error(f"Request content: {r.content}")
-        raise requests.HTTPError
-    else:
-        logger.debug(f"Request successful. Decoding return JSON.")
+class PurpleAirServerError(PurpleAirError):
+    """Raised when the API is still returning a 5xx status after all retries."""
+
+class PurpleAirBudgetError(RuntimeError):
+    """Raised when a request would exceed the daily points budget. See PointsScheduler."""
+
+class PointsScheduler:
+    """
+    Client-side rate limiter and API points budget shared by every request. See request_safely.
+
+    Requests take a token from a bucket refilled at rate per second, up to burst. Requests waiting for a token are
+    released in priority order, then in the order they arrived, so live data is not stuck behind a backfill. The estimated
+    points of each request are reserved against daily_budget before it is queued and a request that would exceed the
+    budget raises PurpleAirBudgetError instead of being sent.
+
+    Parameters:
+    -----------
+    rate : float
+        Requests per second.
+
+    burst : int
+        The size of the token bucket.
+
+    daily_budget : int
+        Maximum estimated points per UTC day. None for no limit.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, daily_budget=DAILY_POINTS_BUDGET):
+        import time
+
+        self.rate = rate
+        self.burst = burst
+        self.daily_budget = daily_budget
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+        self.queue = []
+        self.count = 0
+        self.day = None
+        self.points = 0
+
+    def _refill(self):
+        import time
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _reset_day(self):
+        import datetime
+
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if self.day != today:
+            self.day = today
+            self.points = 0
+
+    def spent_today(self):
+        """Returns the estimated points spent so far in the current UTC day."""
+        with self.condition:
+            self._reset_day()
+            return self.points
+
+    def acquire(self, points=0, priority=PRIORITY_DEFAULT):
+        """
+        Blocks until the request may be sent and charges its estimated points.
+
+        Raises:
+        -------
+        PurpleAirBudgetError
+            If the points would take the day over daily_budget.
+        """
+        import heapq
+
+        with self.condition:
+            self._reset_day()
+            if self.daily_budget != None and self.points + points > self.daily_budget:
+                raise PurpleAirBudgetError(f"Request estimated at {points} points would exceed the daily budget of {self.daily_budget}. {self.points} points already spent today.")
+            self.points += points
+
+            ticket = (priority, self.count)
+            self.count += 1
+            heapq.heappush(self.queue, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self.queue[0] == ticket and self.tokens >= 1:
+                        heapq.heappop(self.queue)
+                        self.tokens -= 1
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait(timeout=None if self.queue[0] != ticket else (1 - self.tokens) / self.rate)
+            except BaseException:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.points -= points
+                self.condition.notify_all()
+                raise
+
+_scheduler = None
+
+_session = None
+_session_lock = threading.Lock()
+
+_group_cache = OrderedDict()
+_group_cache_lock = threading.Lock()
+
+def set_api_url(url):
+    """
+    Points every endpoint at a different API root, ie. the url of a mockapi.MockPurpleAir server.
+    """
+    logger.info("Using API at %s", url)
+    get_config()['api_url'] = url.rstrip('/')
+    invalidate_group_cache()
+
+def get_scheduler():
+    """
+    Returns the PointsScheduler every request goes through, creating it from RATE_LIMIT, RATE_BURST and DAILY_POINTS_BUDGET on first use.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _session_lock:
+            if _scheduler is None:
+                _scheduler = PointsScheduler()
+    return _scheduler
+
+def set_scheduler(scheduler):
+    """
+    Replaces the shared PointsScheduler, ie. set_scheduler(PointsScheduler(rate=2, daily_budget=500000)). None restores the default.
+    """
+    global _scheduler
+    _scheduler = scheduler
+
+def estimate_points(fields=None, rows=1):
+    """
+    Estimates the API points a request will cost as points per field per row. See FIELD_POINTS.
+
+    Parameters:
+    -----------
+    fields : list
+        The fields requested, with or without precision suffixes. None for requests that return no sensor fields.
+
+    rows : int
+        The number of rows (sensors or readings) expected.
+    """
+    if fields == None or len(fields) == 0:
+        return CALL_POINTS
+
+    per_row = sum([FIELD_POINTS.get(x.split('|')[0], DEFAULT_FIELD_POINTS) for x in fields])
+
+    return CALL_POINTS + per_row * max(int(rows), 0)
+
+def estimate_history_rows(start, end, average):
+    """
+    Estimates the number of readings a history request returns from its UNIX time stamps. See cadence.
+    """
+    if start == None or end == None:
+        n, unit = AVERAGE_LIMITS[average]
+        days = n * 365 if unit.startswith('year') else n
+        return days * 86400 // cadence(average)
+
+    return max(int(end) - int(start), 0) // cadence(average) + 1
+
+def get_session():
+    """
+    Returns the shared requests.Session used for all calls to the API, creating it on first use.
+
+    The session keeps connections alive between requests so each call does not pay for a new TLS handshake.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                from requests.adapters import HTTPAdapter
+
+                logger.debug("Creating API session with a pool of %s connections.", POOL_SIZE)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+def close_session():
+    """Closes the shared session and its pooled connections."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def _retry_wait(attempt, response=None):
+    """
+    Returns the number of seconds to wait before retry number attempt.
+
+    Honors the Retry-After header when the response has one, otherwise uses exponential backoff with full jitter.
+    """
+    import random
+    from email.utils import parsedate_to_datetime
+    import datetime
+
+    if response is not None and response.headers.get('Retry-After') is not None:
+        retry_after = response.headers['Retry-After']
         try:
-            json = r.json()
-        except:
-            logger.error(f"JSONDecoderError. Check the url. {r.url}")
-            raise requests.JSONDecodeError
-    r.close()
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                wait = BACKOFF_FACTOR * 2 ** attempt
+        return min(max(wait, 0), BACKOFF_MAX)
 
-    return json
+    return random.uniform(0, min(BACKOFF_FACTOR * 2 ** attempt, BACKOFF_MAX))
 
-def post_safely(url, headers, params=None):
-    import requests
+def request_safely(method, url, headers, params=None, expected=200, stream=False, points=CALL_POINTS, priority=PRIORITY_DEFAULT):
+    """
+    Sends a request to the API through the shared session, retrying on 429, 5xx and connection errors.
 
-    logger.info(f"Posting data to {url} with parameters {params}.")
-    r = requests.post(url, headers=headers, params=params)
-    if r.status_code != 201:
-        logger.error(f"Request content: {r.content}")
-        raise requests.HTTPError
-    else:
-        logger.debug(f"Request successful. Decoding return JSON.")
+    Parameters:
+    -----------
+    method : str
+        The HTTP method, ie. 'GET', 'POST', 'DELETE'.
+
+    url : str
+        The url for the endpoint.
+
+    headers : dict
+        The headers for the request. See read_header and write_header.
+
+    params : dict
+        The query parameters for the request.
+
+    expected : int
+        The status code of a successful response.
+
+    stream : bool
+        If True, the body of a successful response is not downloaded until it is read. See iter_json_data.
+
+    points : int
+        The estimated points cost of the request, charged once against the daily budget. See estimate_points.
+
+    priority : int
+        The priority of the request when waiting for the rate limit, ie. PRIORITY_LIVE or PRIORITY_BACKFILL.
+
+    Returns:
+    --------
+    requests.Response
+        The successful response.
+
+    Raises:
+    -------
+    PurpleAirRateLimitError, PurpleAirServerError
+        If the API still returns 429 or 5xx after MAX_RETRIES retries.
+
+    PurpleAirError
+        For any other unexpected status code. These are not retried.
+
+    PurpleAirBudgetError
+        If the request would exceed the daily points budget.
+    """
+    import time
+
+    session = get_session()
+    scheduler = get_scheduler()
+    endpoint = metrics.endpoint(url)
+    attempt = 0
+    while True:
+        # Retries wait for the rate limit again but are not charged points again
+        start = time.perf_counter()
+        scheduler.acquire(points=points if attempt == 0 else 0, priority=priority)
+        metrics.observe('purpleair_rate_limit_wait_seconds', time.perf_counter() - start, priority=priority)
+        if attempt == 0:
+            metrics.increment('purpleair_points_total', points, endpoint=endpoint)
+
+        start = time.perf_counter()
         try:
-            json = r.json()
-        except:
-            logger.error(f"JSONDecoderError. Check the url. {r.url}")
-            raise requests.JSONDecodeError
-    r.close()
+            r = session.request(method, url, headers=headers, params=params, timeout=TIMEOUT, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe('purpleair_request_seconds', time.perf_counter() - start, endpoint=endpoint, method=method, status=type(e).__name__)
+            metrics.increment('purpleair_requests_total', endpoint=endpoint, method=method, status=type(e).__name__)
+            if attempt >= MAX_RETRIES:
+                logger.error("%s %s failed after %s retries: %s", method, url, attempt, e)
+                raise
+            wait = _retry_wait(attempt)
+            logger.warning("%s %s failed with %r. Retry %s of %s in %.1f seconds.", method, url, e, attempt + 1, MAX_RETRIES, wait)
+            metrics.increment('purpleair_retries_total', endpoint=endpoint, reason=type(e).__name__)
+            time.sleep(wait)
+            attempt += 1
+            continue
+        metrics.observe('purpleair_request_seconds', time.perf_counter() - start, endpoint=endpoint, method=method, status=r.status_code)
+        metrics.increment('purpleair_requests_total', endpoint=endpoint, method=method, status=r.status_code)
+
+        if r.status_code == expected:
+            return r
+
+        body = r.text
+        if r.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            wait = _retry_wait(attempt, r)
+            logger.warning("%s %s returned %s. Retry %s of %s in %.1f seconds.", method, url, r.status_code, attempt + 1, MAX_RETRIES, wait)
+            metrics.increment('purpleair_retries_total', endpoint=endpoint, reason=r.status_code)
+            r.close()
+            time.sleep(wait)
+            attempt += 1
+            continue
+
+        logger.error("Request content: %s", body)
+        r.close()
+        if r.status_code == 429:
+            raise PurpleAirRateLimitError(r.status_code, body, r.url, response=r)
+        elif r.status_code >= 500:
+            raise PurpleAirServerError(r.status_code, body, r.url, response=r)
+        else:
+            raise PurpleAirError(r.status_code, body, r.url, response=r)
+
+def _decode_json(r):
+    import time
+
+    logger.debug("Request successful. Decoding return JSON.")
+    endpoint = metrics.endpoint(r.url)
+    start = time.perf_counter()
+    try:
+        metrics.increment('purpleair_response_bytes_total', len(r.content), endpoint=endpoint)
+        json = r.json()
+    except requests.JSONDecodeError:
+        logger.error("JSONDecoderError. Check the url. %s", r.url)
+        raise
+    finally:
+        r.close()
+    metrics.observe('purpleair_json_decode_seconds', time.perf_counter() - start, endpoint=endpoint)
 
     return json
 
-def delete_safely(url, headers, params=None):
-    import requests
+def get_json_safely(url, headers, params=None, points=CALL_POINTS, priority=PRIORITY_DEFAULT):
+    # Lazy arguments, the parameters include every field name and are only formatted if INFO is enabled
+    logger.info("Getting data from %s with parameters %s.", url, params)
+    r = request_safely('GET', url, headers=headers, params=params, expected=200, points=points, priority=priority)
 
-    logger.info(f"Deleting data at {url} with parameters {params}.")
-    r = requests.post(url, headers=headers, params=params)
-    if r.status_code != 204:
-        logger.error(f"Request content: {r.content}")
-        raise requests.HTTPError
-    else:
-        logger.debug(f"Delete successful.")
+    return _decode_json(r)
+
+def post_safely(url, headers, params=None):
+    logger.info("Posting data to %s with parameters %s.", url, params)
+    r = request_safely('POST', url, headers=headers, params=params, expected=201)
+
+    return _decode_json(r)
+
+def delete_safely(url, headers, params=None):
+    logger.info("Deleting data at %s with parameters %s.", url, params)
+    r = request_safely('DELETE', url, headers=headers, params=params, expected=204)
+    logger.debug("Delete successful.")
     r.close()
 
+def iter_json_data(r, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Incrementally parses a streamed API response with 'fields' and 'data'.
+
+    Only the unparsed tail of the body is held in memory. The API returns 'fields' ahead of 'data'.
+
+    Parameters:
+    -----------
+    r : requests.Response
+        A response requested with stream=True. See request_safely.
+
+    chunk_size : int
+        The number of bytes to read from the response at a time.
+
+    Yields:
+    -------
+    list
+        The list of fields first, then each row of data in order.
+    """
+    import codecs
+    import json
+
+    endpoint = metrics.endpoint(r.url)
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = r.iter_content(chunk_size=chunk_size)
+    buffer = ''
+    pos = 0
+
+    def more():
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        metrics.increment('purpleair_response_bytes_total', len(chunk), endpoint=endpoint)
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = 0
+        return True
+
+    def seek(token):
+        nonlocal pos
+        while True:
+            i = buffer.find(token, pos)
+            if i >= 0:
+                pos = i + len(token)
+                return
+            pos = max(pos, len(buffer) - len(token))
+            if not more():
+                raise requests.JSONDecodeError(f"Expected {token} in response from {r.url}", buffer, pos)
+
+    def skip(characters):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in characters:
+                pos += 1
+            if pos < len(buffer) or not more():
+                return
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                x, pos = decoder.raw_decode(buffer, pos)
+                return x
+            except json.JSONDecodeError:
+                # Incomplete value at the end of the buffer
+                if not more():
+                    raise
+
+    seek('"fields"')
+    seek(':')
+    skip(' \t\r\n')
+    yield value()
+
+    seek('"data"')
+    seek(':')
+    seek('[')
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buffer) or buffer[pos] == ']':
+            return
+        yield value()
+
 def verify_interval(start, end = None):
     import pandas as pd
     import datetime
-    today = pd.to_datetime(datetime.datetime.today())
-    
+    today = pd.Timestamp(datetime.datetime.now(datetime.timezone.utc))
 
     if not isinstance(start, date):
-        logger.debug(f"Converting {start} to date.")
+        logger.debug("Converting %s to date.", start)
         try:
             start = pd.to_datetime(start, yearfirst=True)
         except Exception as e:
-            logger.error(f'Start parameter must be a date or convertible by pd.to_datetime: {e}')
+            logger.error("Start parameter must be a date or convertible by pd.to_datetime: %s", e)
             raise pd.errors.ParserError
 
     if end != None:
         if not isinstance(end, date):
-            logger.debug(f"Converting {end} to date.")
+            logger.debug("Converting %s to date.", end)
             try:
                 end = pd.to_datetime(end, yearfirst=True)
             except Exception as e:
-                logger.error(f'Start parameter must be a date or convertible by pd.to_datetime: {e}')
+                logger.error("Start parameter must be a date or convertible by pd.to_datetime: %s", e)
                 raise pd.errors.ParserError
 
     elif end == None:
-        logger.debug(f"No end date provided. Using {today}")
-        end = today
+        # Naive times are UTC, see to_timestamp
+        end = today if pd.Timestamp(start).tzinfo != None else today.tz_localize(None)
+        logger.debug("No end date provided. Using %s", end)
 
-    logger.info(f'Creating interval for filtering deployments from {start} to {end}')
+    logger.info("Creating interval for filtering deployments from %s to %s", start, end)
     interval = pd.Interval(start, end)
 
     return interval
 
-def check_interval(interval, average):
+def limit_offset(average):
+    """
+    Returns the maximum length of a single history request for an average as a pandas.DateOffset. See AVERAGE_LIMITS.
+    """
     import pandas as pd
 
-    logger.debug(f"Checking if {interval} is longer than allowable length.")
-    freq = pd.Timedelta(value=AVERAGE_LIMITS[average][0], unit=AVERAGE_LIMITS[average][1])
+    n, unit = AVERAGE_LIMITS[average]
+    if not unit.endswith('s'):
+        unit = f"{unit}s"
+
+    return pd.DateOffset(**{unit: n})
+
+def check_interval(interval, average):
+    """
+    Splits an interval into intervals that are within the API limit for the average. See AVERAGE_LIMITS.
+
+    Returns:
+    --------
+    list
+        A list of pandas.Interval. Contains only the original interval if it is within the limit.
+    """
+    logger.debug("Checking if %s is longer than allowable length.", interval)
+    freq = limit_offset(average)
 
-    if interval.length > freq:
-        interval_list = split_interval(interval=interval, average=freq)
-        logger.info(f"{interval} is longer than allowable {freq} returning list of {len(interval_list)} intervals")
+    if interval.left + freq < interval.right:
+        interval_list = split_interval(interval=interval, freq=freq)
+        logger.info("%s is longer than allowable %s returning list of %s intervals", interval, freq, len(interval_list))
         return interval_list
     else:
-        logger.info(f"{interval} is within the allowable {freq} returning freq.")
-        return interval
+        logger.info("%s is within the allowable %s returning interval.", interval, freq)
+        return [interval]
 
 def split_interval(interval, freq):
+    """
+    Splits an interval into consecutive intervals of length freq. The last interval is shortened to end at interval.right.
+    """
     import pandas as pd
 
-    logger.info(f"Splitting {interval} by {freq}")
-    range = pd.interval_range(interval.left, interval.right, freq=freq).to_list()
+    logger.info("Splitting %s by %s", interval, freq)
+    bounds = pd.date_range(interval.left, interval.right, freq=freq).to_list()
+    if bounds[-1] < interval.right:
+        bounds.append(interval.right)
+    range = [pd.Interval(x, y) for x, y in zip(bounds[:-1], bounds[1:])]
 
     return range
 
+def resolve_fields(fields=None, precision=None):
+    """
+    Returns the data fields to request and their query strings with precision suffixes.
+
+    Parameters:
+    -----------
+    fields : str or list
+        The name of one of FIELD_PROFILES or a list of DATA_FIELDS. Defaults to all DATA_FIELDS.
+
+    precision : int or dict
+        The decimals to request for every field, or a dict of field to decimals overriding FIELD_PRECISION. None
+        requests the API's default precision.
+
+    Returns:
+    --------
+    tuple
+        The fields in DATA_FIELDS order, so the columns of the result do not depend on the order they were asked for,
+        and the list of fields for the query, ie. ['humidity|d0', 'pm2.5_cf_1_a|d3'].
+    """
+    if fields == None:
+        fields = DATA_FIELDS
+    elif isinstance(fields, str):
+        if fields not in FIELD_PROFILES:
+            raise KeyError(f"Unknown field profile {fields}. Use one of {', '.join(FIELD_PROFILES)}.")
+        fields = FIELD_PROFILES[fields]
+
+    unknown = [x for x in fields if x not in DATA_FIELDS]
+    if len(unknown) > 0:
+        raise KeyError(f"Unknown data fields: {', '.join(unknown)}. See DATA_FIELDS.")
+    if len(fields) == 0:
+        raise ValueError("At least one data field must be requested.")
+    fields = [x for x in DATA_FIELDS if x in fields]
+
+    decimals = dict(FIELD_PRECISION)
+    if isinstance(precision, dict):
+        decimals.update(precision)
+    elif precision != None:
+        decimals = {x: precision for x in fields}
+    query = [x if decimals.get(x) == None else f"{x}|d{int(decimals[x])}" for x in fields]
+
+    return fields, query
+
+def decode_data(json, columns=None):
+    """
+    Decodes the fields and data of an API response into a typed dataframe.
+
+    Precision suffixes such as |d3 are stripped from the field names. Columns are typed by FIELD_DTYPES: UNIX time stamps
+    are converted to UTC datetimes and readings to float32, each as one vectorized conversion per column.
+
+    Parameters:
+    -----------
+    json : dict
+        The decoded JSON response with 'fields' and 'data'.
+
+    columns : list
+        The columns of the returned dataframe in order. Columns missing from the response are filled with nulls of
+        the column's type. Defaults to the fields of the response.
+
+    Returns:
+    --------
+    pandas.DataFrame
+    """
+    import time
+    import numpy as np
+    import pandas as pd
+
+    start = time.perf_counter()
+    fields = [x.split('|')[0] for x in json['fields']]
+    data = json['data']
+    columns = fields if columns is None else columns
+
+    values = None
+    if len(data) > 0 and all([FIELD_DTYPES.get(x) not in [None, 'object'] for x in fields]):
+        # All fields are numeric, convert the whole payload in one pass. None becomes nan.
+        try:
+            values = np.array(data, dtype='float64')
+        except (TypeError, ValueError):
+            values = None
+
+    if values is None:
+        values = list(zip(*data)) if len(data) > 0 else [[] for x in fields]
+    else:
+        values = values.T
+    values = dict(zip(fields, values))
+
+    df = {}
+    for x in columns:
+        dtype = FIELD_DTYPES.get(x, 'object')
+        column = values.get(x, np.full(len(data), np.nan))
+        if dtype == 'datetime':
+            df[x] = pd.to_datetime(np.asarray(column, dtype='float64'), unit='s', utc=True)
+        elif dtype == 'object':
+            df[x] = pd.Series(column, dtype='object')
+        else:
+            df[x] = pd.Series(np.asarray(column, dtype='float64')).astype(dtype)
+    df = pd.DataFrame(df, columns=columns)
+
+    function = metrics.current_function()
+    metrics.observe('purpleair_dataframe_build_seconds', time.perf_counter() - start, function=function)
+    metrics.increment('purpleair_rows_decoded_total', len(df), function=function)
+
+    return df
+
+@metrics.instrument('get_organization')
 def get_organization():
-    logger.info(f"Getting organization data form PurpleAir API.")
+    logger.info("Getting organization data form PurpleAir API.")
 
-    json = get_json_safely(ORG_URL, read_header)
+    json = get_json_safely(_url('organization'), get_config()['read_header'])
 
     return json
 
-def get_deployed_sensors(log_path, start = None, end = None, sheet_name = "Deployment Log"):
+def _parse_deployment_log(log_path, sheet_name = DEPLOYMENT_SHEET):
+    import pandas as pd
+
+    logger.debug("Reading deployment log from %s, sheet_name %s", log_path, sheet_name)
+
+    deployments = pd.read_excel(log_path, sheet_name=sheet_name).drop(0)
+    deployments[DEPLOYMENT_START_COL] = pd.to_datetime(deployments[DEPLOYMENT_START_COL])
+    deployments[DEPLOYMENT_END_COL] = pd.to_datetime(deployments[DEPLOYMENT_END_COL])
+    deployments = deployments.loc[~deployments[DEPLOYMENT_ID_COL].astype(str).str.endswith('00')]
+
+    return deployments.reset_index(drop=True)
+
+def read_deployment_log(log_path, sheet_name = DEPLOYMENT_SHEET, use_cache = True):
+    """
+    Reads the field deployments from the Deployment Log workbook.
+
+    Parameters:
+    -----------
+    log_path : path_like
+        A string of path of deployment log
+
+    sheet_name : str
+        The sheet name that contains the deployment log
+
+    use_cache : bool
+        If True, reads the deployments cached in the database by model.get_deployment_log(), which parses the
+        workbook again only when it has changed. Only the DEPLOYMENT_*_COL columns are cached. If False, parses
+        the workbook and returns every column.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per deployment with DEPLOYMENT_START_COL and DEPLOYMENT_END_COL parsed as datetimes. Deployments
+        without an end date are still deployed and end today.
+    """
+    import pandas as pd
+
+    if use_cache:
+        import model
+        deployments = model.get_deployment_log(log_path, sheet_name=sheet_name)
+    else:
+        deployments = _parse_deployment_log(log_path, sheet_name=sheet_name)
+    deployments[DEPLOYMENT_END_COL] = deployments[DEPLOYMENT_END_COL].fillna(pd.Timestamp.today())
+
+    return deployments
+
+def filter_deployments(deployments, start = None, end = None):
+    """
+    Returns the deployments that overlap start through end.
+
+    Compares the start and end columns as arrays, so it is fast for any number of deployments.
+
+    Parameters:
+    -----------
+    deployments : pandas.DataFrame
+        The return of read_deployment_log().
+
+    start, end : date-like
+        The bounds of the period. If both are None, returns the deployments that are still deployed. If only end is
+        None, the period ends today.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The matching rows of deployments.
+    """
+    import pandas as pd
+
+    if (start == None) & (end == None):
+        current = deployments[DEPLOYMENT_END_COL] >= pd.Timestamp.today().normalize()
+        logger.info("Getting all currently deployed sensors, %s of %s deployments.", current.sum(), len(deployments))
+        return deployments.loc[current]
+
+    bounds = []
+    for x in [start, end]:
+        if x != None and not isinstance(x, date):
+            logger.debug("Converting %s to date.", x)
+            try:
+                x = pd.to_datetime(x, yearfirst=True)
+            except Exception as e:
+                logger.error("Start and end parameters must be dates or convertible by pd.to_datetime: %s", e)
+                raise pd.errors.ParserError
+        bounds.append(pd.Timestamp(x) if x != None else None)
+    start, end = bounds
+
+    if end == None:
+        end = pd.Timestamp.today()
+        logger.info("No end date provided. Using %s", end)
+
+    logger.info("Getting all sensors deployed from %s to %s", start, end)
+    overlaps = deployments[DEPLOYMENT_START_COL].lt(end).to_numpy()
+    if start != None:
+        overlaps = overlaps & deployments[DEPLOYMENT_END_COL].gt(start).to_numpy()
+    deployed = deployments.loc[overlaps]
+
+    if len(deployed) == 0:
+        logger.warning("Dates %s through %s return zero sensors. Check dates.", start, end)
+
+    return deployed
+
+@metrics.instrument('get_deployed_sensors')
+def get_deployed_sensors(log_path, start = None, end = None, sheet_name = DEPLOYMENT_SHEET, use_cache = True):
     """
     Fetch list of sensor indexes.
 
@@ -169,170 +927,327 @@ def get_deployed_sensors(log_path, start = None, end = None, sheet_name = "Deplo
     log_path : path_like
         A string of path of deployment log
 
+    start, end : date-like
+        Return sensors deployed at any time from start to end. If both are None, returns the sensors that are
+        currently deployed. See filter_deployments().
+
     sheet_name : str
         The sheet name that contains the deployment log
 
+    use_cache : bool
+        If True, uses the deployments cached in the database. See read_deployment_log().
+
     Return:
     -------
     list
         A list of sensor indexes of deployed sensors
     """
-    import pandas as pd
-    import math
-    import datetime
+    deployments = read_deployment_log(log_path, sheet_name=sheet_name, use_cache=use_cache)
+    deployed = filter_deployments(deployments, start=start, end=end)
 
-    logger.debug(f"Reading deployment log from {log_path}, sheet_name {sheet_name}")
-    today = pd.to_datetime(datetime.datetime.today())
+    sensor_index = [int(x) for x in deployed[DEPLOYMENT_SENSOR_COL].dropna()]
+    logger.info("%s Sensors: %s", len(sensor_index), sensor_index)
 
-    deployments = pd.read_excel(log_path, sheet_name=sheet_name).drop(0)
-    deployments['Deployment_Start'] = [pd.to_datetime(x) for x in deployments['Deployment_Start']]
-    deployments['Deployment_End'] = [today if pd.isnull(x) else x for x in deployments['Deployment_End']]
-    deployments = deployments.loc[(~deployments['Sensor ID Deployment'].str.endswith('00'))]
+    return sensor_index
 
-    logger.debug(f"converting deployment {start} and {end} to interval.")
+def deployed_at(deployments, location, time_stamp, location_col = DEPLOYMENT_LOCATION_COL):
+    """
+    Returns the sensor index deployed at each location at each time.
 
-    deployments['Deployment_Period'] = [pd.Interval(x, y) for x, y in zip(deployments['Deployment_Start'], deployments['Deployment_End'])]
+    Looks up every (location, time_stamp) pair at once with a sorted as-of join on the deployment start, so it
+    can label millions of readings. Where deployments at a location overlap, the one that started last wins.
 
-    if (start == None) & (end == None):
-        logger.info(f"Getting all currently deployed sensors as of {today}.")
-        deployed = deployments.loc[(deployments['Deployment_End'] == today)]
-    
-    else:
-        if start != None:
-            if not isinstance(start, date):
-                logger.debug(f"Converting {start} to date.")
-                try:
-                    start = pd.to_datetime(start, yearfirst=True)
-                except Exception as e:
-                    logger.error(f'Start parameter must be a date or convertible by pd.to_datetime: {e}')
-                    raise pd.errors.ParserError
-            else:
-                logger.debug(f'Start date: {start}')
-
-        if end != None:
-            if not isinstance(end, date):
-                logger.debug(f"Converting {end} to date.")
-                try:
-                    end = pd.to_datetime(end, yearfirst=True)
-                except Exception as e:
-                    logger.error(f'Start parameter must be a date or convertible by pd.to_datetime: {e}')
-                    raise pd.errors.ParserError
-            else:
-                logger.debug(f"End date: {end}")
-
-        elif end == None:
-            logger.info(f"No end date provided. Using {today}")
-            end = today
-
-        logger.debug(f'Creating interval for filtering deployments from {start} to {end}')
-        interval = pd.Interval(start, end)
-            
-        logger.info(f'Getting all sensors deployed during {interval}')
-        deployed = []
-        for i, row in deployments.iterrows():
-            if row.Deployment_Period.overlaps(interval):
-                deployed.append(row)
-        deployed = pd.concat(deployed)
-        
-        if len(deployed) == 0:
-            logger.warning(f"Dates {start.strftime('%Y-%m-%d')} through {end.strftime('%Y-%m-%d')} return zero sensors. Check dates.")
-        
-    sensor_index = [int(x) for x in deployed.Sensor_Index_ID if not math.isnan(x)]
-    logger.info(f"{len(sensor_index)} Sensors: {", ".join([str(x) for x in sensor_index])}")
+    Parameters:
+    -----------
+    deployments : pandas.DataFrame
+        The return of read_deployment_log().
 
-    return sensor_index
+    location : array-like or scalar
+        The location of each time stamp, matched against location_col.
+
+    time_stamp : array-like
+        The times to look up. Time zone aware times are converted to DEPLOYMENT_TZ.
+
+    location_col : str
+        The column of deployments that names the location.
+
+    Returns:
+    --------
+    pandas.Series
+        The sensor index (Int64, missing where no sensor was deployed) in the order of time_stamp.
+    """
+    import pandas as pd
+
+    times = pd.Series(pd.to_datetime(time_stamp))
+    if times.dt.tz != None:
+        times = times.dt.tz_convert(DEPLOYMENT_TZ).dt.tz_localize(None)
+    left = pd.DataFrame({'location': location, 'time_stamp': times.to_numpy(), 'order': range(len(times))})
+
+    right = deployments[[location_col, DEPLOYMENT_START_COL, DEPLOYMENT_END_COL, DEPLOYMENT_SENSOR_COL]].rename(columns={location_col: 'location'})
+    right = right.dropna(subset=[DEPLOYMENT_START_COL]).astype({DEPLOYMENT_START_COL: left['time_stamp'].dtype})
+    right['location'] = right['location'].astype(left['location'].dtype)
+
+    merged = pd.merge_asof(left.sort_values('time_stamp'), right.sort_values(DEPLOYMENT_START_COL),
+        left_on='time_stamp', right_on=DEPLOYMENT_START_COL, by='location', direction='backward')
+    merged.loc[~(merged['time_stamp'] <= merged[DEPLOYMENT_END_COL]), DEPLOYMENT_SENSOR_COL] = None
+
+    merged = merged.sort_values('order')
+    return pd.Series(merged[DEPLOYMENT_SENSOR_COL].to_numpy(), index=times.index, name='sensor_index').astype('Int64')
 
 def post_group(group_name):
-    logger.info(f"Creating new group with name {group_name}. See get_group for all current groups.")
+    logger.info("Creating new group with name %s. See get_group for all current groups.", group_name)
 
     params = {
         'name': group_name
     }
 
-    json = post_safely(GROUPS_URL, write_header, params)
+    json = post_safely(_url('groups'), get_config()['write_header'], params)
 
     return json
 
+@metrics.instrument('get_groups')
 def get_groups():
-    logger.info(f"Getting list of all groups in PurpleAir API.")
-    json = get_json_safely(GROUPS_URL, read_header)
+    logger.info("Getting list of all groups in PurpleAir API.")
+    json = get_json_safely(_url('groups'), get_config()['read_header'])
 
     return json
 
-def get_group_details(group_id):
-    logger.info(f"Getting group details for group id: {group_id}")
+@metrics.instrument('get_group_details')
+def get_group_details(group_id, use_cache=True):
+    """
+    Returns the details and members of a group.
+
+    Details are cached for GROUP_CACHE_TTL seconds for up to GROUP_CACHE_SIZE groups. The cache is invalidated when
+    members are added or removed through this module. See invalidate_group_cache().
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See get_groups().
 
-    json = get_json_safely(f"{GROUPS_URL}/{group_id}", headers=read_header)
+    use_cache : bool
+        If False, always fetches from the API and refreshes the cache.
+
+    Returns:
+    --------
+    dict
+        The group details as returned by the API. Shared with the cache, do not modify.
+    """
+    import time
+
+    key = str(group_id)
+    if use_cache:
+        with _group_cache_lock:
+            cached = _group_cache.get(key)
+            if cached != None and cached['expires'] > time.monotonic():
+                _group_cache.move_to_end(key)
+                logger.debug("Using cached group details for group id: %s", group_id)
+                return cached['details']
+
+    logger.info("Getting group details for group id: %s", group_id)
+
+    json = get_json_safely(f"{_url('groups')}/{group_id}", headers=get_config()['read_header'])
+
+    with _group_cache_lock:
+        _group_cache[key] = {
+            'expires': time.monotonic() + GROUP_CACHE_TTL,
+            'details': json,
+            'member_map': {x['id']: x['sensor_index'] for x in json['members']},
+            'sensor_map': {x['sensor_index']: x['id'] for x in json['members']},
+        }
+        _group_cache.move_to_end(key)
+        while len(_group_cache) > GROUP_CACHE_SIZE:
+            _group_cache.popitem(last=False)
 
     return json
 
+def _group_cache_entry(group_id):
+    get_group_details(group_id)
+    with _group_cache_lock:
+        return _group_cache[str(group_id)]
+
+def get_member_map(group_id):
+    """
+    Returns a dict of member id to sensor index for a group. Uses the group details cache.
+    """
+    return _group_cache_entry(group_id)['member_map']
+
+def get_sensor_map(group_id):
+    """
+    Returns a dict of sensor index to member id for a group. Uses the group details cache.
+    """
+    return _group_cache_entry(group_id)['sensor_map']
+
+def invalidate_group_cache(group_id=None):
+    """
+    Removes a group from the group details cache, or every group if group_id is None.
+    """
+    with _group_cache_lock:
+        if group_id == None:
+            logger.debug("Clearing group details cache.")
+            _group_cache.clear()
+        else:
+            logger.debug("Clearing cached group details for group id: %s", group_id)
+            _group_cache.pop(str(group_id), None)
+
 def delete_group(group_id):
-    logger.info(f"Deleting group {group_id} from PurpleAir API.")
+    logger.info("Deleting group %s from PurpleAir API.", group_id)
 
-    delete_safely(f"{GROUPS_URL}/{group_id}", headers=write_header)
+    delete_safely(f"{_url('groups')}/{group_id}", headers=get_config()['write_header'])
+    invalidate_group_cache(group_id)
 
 def post_member(group_id, sensor_index):
-    logger.info(f"Adding member to group with sensor index {sensor_index} to group {group_id}")
+    """
+    Adds a sensor to a group. Adding a sensor that is already a member is treated as done.
+    """
+    logger.info("Adding member to group with sensor index %s to group %s", sensor_index, group_id)
 
     params = {
         'group_id': group_id,
         'sensor_index': sensor_index
     }
 
-    post_safely(f"{GROUPS_URL}/{group_id}/members", headers=write_header, params=params)
+    try:
+        post_safely(f"{_url('groups')}/{group_id}/members", headers=get_config()['write_header'], params=params)
+    except PurpleAirError as e:
+        if e.status_code != 409:
+            raise
+        logger.info("Sensor %s is already a member of group %s.", sensor_index, group_id)
+    invalidate_group_cache(group_id)
 
-def delete_member(group_id, sensor_index):
-    logger.info(f"Delete member {sensor_index} from group {group_id}")
+def delete_member(group_id, sensor_index, member_id=None):
+    """
+    Removes a sensor from a group.
 
-    delete_safely(f"{GROUPS_URL}/{group_id}/members/{sensor_index}", headers=write_header)
+    The API deletes members by member id, so the sensor index is looked up in the group unless member_id is passed.
+    Removing a sensor that is not a member is treated as done.
+    """
+    if member_id == None:
+        member_id = get_sensor_map(group_id).get(sensor_index)
+        if member_id == None:
+            logger.info("Sensor %s is not a member of group %s.", sensor_index, group_id)
+            return
+    logger.info("Delete member %s (sensor %s) from group %s", member_id, sensor_index, group_id)
+
+    try:
+        delete_safely(f"{_url('groups')}/{group_id}/members/{member_id}", headers=get_config()['write_header'])
+    except PurpleAirError as e:
+        if e.status_code != 404:
+            raise
+        logger.info("Member %s was already removed from group %s.", member_id, group_id)
+    invalidate_group_cache(group_id)
 
 def check_group_members(sensor_index, group_id):
+    """
+    Compares a list of sensor indexes to the current members of a group.
 
-    details = get_group_details(group_id=group_id)
-    in_group = [x['sensor_index'] for x in details['members']]
-
-    logger.info(f"Comparing {len(sensor_index)} sensors and in PurpleAir API group {group_id}")
+    Returns:
+    --------
+    dict
+        'to_add': sorted sensor indexes not in the group, 'to_remove': sorted sensor indexes in the group but not in sensor_index.
+    """
+    details = get_group_details(group_id=group_id, use_cache=False)
+    in_group = set(x['sensor_index'] for x in details['members'])
+    wanted = set(sensor_index)
 
-    to_add = []
-    for x in sensor_index:
-        if x not in in_group:
-            to_add.append(x)
+    logger.info("Comparing %s sensors and in PurpleAir API group %s", len(wanted), group_id)
 
-    to_remove = []
-    for x in in_group:
-        if x not in sensor_index:
-            to_remove.append(x)
+    to_add = sorted(wanted - in_group)
+    to_remove = sorted(in_group - wanted)
 
-    logger.info(f"{len(to_add)} sensor to add and {len(to_remove)} to remove.")
+    logger.info("%s sensor to add and %s to remove.", len(to_add), len(to_remove))
 
     return {'to_add': to_add, 'to_remove': to_remove}
 
+def update_group_members(update, group_id, max_workers=8, dry_run=False):
+    """
+    Applies the additions and removals from check_group_members() to a group concurrently.
+
+    The update is checked against the live membership of the group first, so sensors that were already added or
+    removed, eg. by an earlier run that was interrupted, are skipped and the same update can be applied again safely.
+    Requests are retried by request_safely(). A change that still fails is reported and does not stop the others.
+
+    Parameters:
+    -----------
+    update : dict
+        'to_add' and 'to_remove' lists of sensor indexes. See check_group_members().
 
-def update_group_members(update, group_id):
+    group_id : str
+        The id number for the group. See get_groups().
+
+    max_workers : int
+        The number of changes applied at once.
+
+    dry_run : bool
+        If True, logs and returns the plan without changing the group.
+
+    Returns:
+    --------
+    dict
+        'added', 'removed' and 'skipped' lists of sensor indexes and 'failed', a dict of sensor index to error message.
+        With dry_run, 'added' and 'removed' are the planned changes.
+    """
     import datetime
-    logger.info(f"Updating sensor group {group_id}")
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    logger.info("Updating sensor group %s", group_id)
 
-    if len(update['to_add']) > 0:
-        logger.debug(f'Adding sensor {', '.join([str(x) for x in update['to_add']])} to {group_id}')
-        for sensor in update['to_add']:
-            post_member(group_id, sensor)
+    get_group_details(group_id, use_cache=False)
+    sensor_map = get_sensor_map(group_id)
+    to_add = sorted(x for x in set(update['to_add']) if x not in sensor_map)
+    to_remove = sorted(x for x in set(update['to_remove']) if x in sensor_map)
+    skipped = sorted((set(update['to_add']) - set(to_add)) | (set(update['to_remove']) - set(to_remove)))
+    result = {'added': to_add, 'removed': to_remove, 'skipped': skipped, 'failed': {}}
+
+    if len(skipped) > 0:
+        logger.info("Skipping %s sensors already up to date in group %s.", len(skipped), group_id)
+    if len(to_add) > 0:
+        logger.debug("%s sensors %s to %s", 'Planned: adding' if dry_run else 'Adding', to_add, group_id)
     else:
         logger.debug('No sensors to add.')
-
-    if len(update['to_remove']) > 0:
-        logger.debug(f'Removing sensors {', '.join({[str(x) for x in update['to_remove']]})} from {group_id}')
-        for sensor in update['to_remove']:
-            delete_member(group_id, sensor)
+    if len(to_remove) > 0:
+        logger.debug("%s sensors %s from %s", 'Planned: removing' if dry_run else 'Removing', to_remove, group_id)
     else:
         logger.debug('No sensors to remove.')
 
-    logger.info(f'Group {group_id} is up to date as of {datetime.datetime.today()}.')
+    if dry_run:
+        logger.info("Dry run: would add %s and remove %s sensors in group %s.", len(to_add), len(to_remove), group_id)
+        return result
+
+    if len(to_add) + len(to_remove) > 0:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(post_member, group_id, x): ('added', x) for x in to_add}
+            futures.update({executor.submit(delete_member, group_id, x, sensor_map[x]): ('removed', x) for x in to_remove})
+            for future in as_completed(futures):
+                action, sensor = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Failed to update sensor %s in group %s: %r", sensor, group_id, e)
+                    result['failed'][sensor] = repr(e)
+
+        result['added'] = [x for x in to_add if x not in result['failed']]
+        result['removed'] = [x for x in to_remove if x not in result['failed']]
+
+    invalidate_group_cache(group_id)
+    if len(result['failed']) > 0:
+        logger.warning("Group %s update incomplete, %s changes failed. Run again to retry them.", group_id, len(result['failed']))
+    else:
+        logger.info("Group %s is up to date as of %s.", group_id, datetime.datetime.today())
 
+    return result
+
+def sync_group_members(sensor_index, group_id, max_workers=8, dry_run=False):
+    """
+    Makes the members of a group exactly the sensors in sensor_index. See check_group_members() and update_group_members().
+    """
+    update = check_group_members(sensor_index=sensor_index, group_id=group_id)
+
+    return update_group_members(update=update, group_id=group_id, max_workers=max_workers, dry_run=dry_run)
+
+@metrics.instrument('get_members_metadata')
 def get_members_metadata(group_id):
-    import requests
-    import pandas as pd
-    import datetime
-    logger.info(f"Getting sensor metadata for group {group_id}")
+    logger.info("Getting sensor metadata for group %s", group_id)
 
     fields=['name', 'model', 'hardware', 'date_created', 'location_type', 'latitude', 'longitude', 'altitude']
 
@@ -340,18 +1255,36 @@ def get_members_metadata(group_id):
         'fields': ",".join(fields)
     }
 
-    json = get_json_safely(f"{GROUPS_URL}/{group_id}/members", headers=read_header, params=params)
+    points = estimate_points(fields, rows=len(get_member_map(group_id)))
+    json = get_json_safely(f"{_url('groups')}/{group_id}/members", headers=get_config()['read_header'], params=params, points=points, priority=PRIORITY_DEFAULT)
 
-    df = pd.DataFrame([x for x in json['data']], columns=json['fields'])
-    df['date_created'] = [datetime.datetime.fromtimestamp(x, datetime.timezone.utc) for x in df['date_created']]
+    df = decode_data(json)
 
     return df
 
-def get_members_health(group_id):
-    import requests
+@metrics.instrument('get_members_health')
+def get_members_health(group_id, previous=None, readings=None):
+    """
+    Retrieves the health check fields for every member of a group and scores them. See score_health().
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See get_groups().
+
+    previous : pandas.DataFrame
+        Optional earlier health check for the group, used to detect restarts from uptime going backwards.
+
+    readings : pandas.DataFrame
+        Optional latest readings from get_members_data(), used to check A/B channel agreement.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per sensor with the fields in output_data/morpc-purpleair-sensor-health.schema.yaml.
+    """
     import pandas as pd
-    import datetime
-    logger.info(f"Getting health check data for sensors in group {group_id}")
+    logger.info("Getting health check data for sensors in group %s", group_id)
 
     fields=['name', 'rssi', 'firmware_version', 'firmware_upgrade', 'uptime', 'pa_latency', 'memory', 'last_seen', 'last_modified', 'channel_state']
 
@@ -359,36 +1292,175 @@ def get_members_health(group_id):
         'fields': ",".join(fields)
     }
 
-    json = get_json_safely(f"{GROUPS_URL}/{group_id}/members", headers=read_header, params=params)
+    points = estimate_points(fields, rows=len(get_member_map(group_id)))
+    json = get_json_safely(f"{_url('groups')}/{group_id}/members", headers=get_config()['read_header'], params=params, points=points, priority=PRIORITY_HEALTH)
 
-    df = pd.DataFrame([x for x in json['data']], columns=json['fields'])
-    df['last_seen'] = [datetime.datetime.fromtimestamp(x, datetime.timezone.utc) for x in df['last_seen']]
-    df['last_modified'] = [datetime.datetime.fromtimestamp(x, datetime.timezone.utc) for x in df['last_modified']]
-    df['datetime_check'] = datetime.datetime.fromtimestamp(json['data_time_stamp'], datetime.timezone.utc)
+    df = decode_data(json)
+    df['datetime_check'] = pd.to_datetime(json['data_time_stamp'], unit='s', utc=True)
 
-    df['status'] = None ## add calculation for status. 
+    df = score_health(df, previous=previous, readings=readings)
 
     return df
 
-def get_members_data(group_id):
+def channel_disagreement(readings, field='pm2.5_cf_1'):
+    """
+    Compares the A and B channels of each reading.
+
+    Parameters:
+    -----------
+    readings : pandas.DataFrame
+        Readings with <field>_a and <field>_b columns, ie. the return of get_members_data().
+
+    field : str
+        The measurement to compare.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        ab_difference, the absolute difference, ab_rpd, the difference relative to the mean of the channels, and
+        ab_disagree, True where both exceed HEALTH_AB_ABS and HEALTH_AB_RPD. Indexed like readings.
+    """
+    import numpy as np
     import pandas as pd
-    import datetime
-    logger.info(f"Getting most recent data reading for all members in group {group_id}")
 
+    a = readings[f"{field}_a"].to_numpy(dtype='float64')
+    b = readings[f"{field}_b"].to_numpy(dtype='float64')
+    difference = np.abs(a - b)
+    mean = (a + b) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rpd = np.where(mean > 0, difference / mean, np.nan)
+
+    return pd.DataFrame({
+        'ab_difference': difference,
+        'ab_rpd': rpd,
+        'ab_disagree': (difference > HEALTH_AB_ABS) & (rpd > HEALTH_AB_RPD),
+    }, index=readings.index)
+
+def score_health(df, now=None, previous=None, readings=None):
+    """
+    Classifies each sensor of a health check as healthy, degraded, stale or offline.
+
+    Every sensor is scored at once with array comparisons:
+
+        offline   last_seen is missing or more than HEALTH_OFFLINE_AGE seconds before the check
+        stale     last_seen is more than HEALTH_STALE_AGE seconds before the check
+        degraded  any of the issues below
+        healthy   none of the above
+
+    Issues are weak_signal (rssi < HEALTH_MIN_RSSI), high_latency (pa_latency > HEALTH_MAX_LATENCY), low_memory
+    (memory < HEALTH_MIN_MEMORY), restarted (uptime < HEALTH_MIN_UPTIME or lower than in previous), channel_fault
+    (channel_state is not 3, ie. A and B) and ab_disagreement (see channel_disagreement).
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        A health check, ie. the fields fetched by get_members_health().
+
+    now : datetime-like
+        The time of the check. Defaults to the datetime_check column, else the current time.
+
+    previous : pandas.DataFrame
+        Optional earlier health check with sensor_index and uptime columns.
+
+    readings : pandas.DataFrame
+        Optional readings with sensor_index and A and B channel columns. See channel_disagreement().
+
+    Returns:
+    --------
+    pandas.DataFrame
+        df with status, issues (';' separated) and, if readings were given, ab_difference columns.
+    """
+    import numpy as np
+    import pandas as pd
+
+    df = df.copy()
+    n = len(df)
+
+    if now != None:
+        now = pd.Timestamp(now)
+        now = now.tz_localize('UTC') if now.tzinfo == None else now
+    elif 'datetime_check' in df.columns:
+        now = pd.to_datetime(df['datetime_check'], utc=True)
+    else:
+        now = pd.Timestamp.now(tz='UTC')
+    age = (now - pd.to_datetime(df['last_seen'], utc=True)).dt.total_seconds().to_numpy(dtype='float64', na_value=np.nan)
+
+    def values(x):
+        if x not in df.columns:
+            return np.full(n, np.nan)
+        return df[x].to_numpy(dtype='float64', na_value=np.nan)
+
+    uptime = values('uptime')
+    restarted = uptime < HEALTH_MIN_UPTIME
+    if previous is not None and len(previous) > 0:
+        before = previous.drop_duplicates('sensor_index', keep='last').set_index('sensor_index')['uptime']
+        before = df['sensor_index'].map(before).to_numpy(dtype='float64', na_value=np.nan)
+        restarted |= uptime < before
+
+    issues = {
+        'weak_signal': values('rssi') < HEALTH_MIN_RSSI,
+        'high_latency': values('pa_latency') > HEALTH_MAX_LATENCY,
+        'low_memory': values('memory') < HEALTH_MIN_MEMORY,
+        'restarted': restarted,
+        'channel_fault': ~np.isnan(values('channel_state')) & (values('channel_state') != 3),
+    }
+
+    if readings is not None and len(readings) > 0:
+        latest = readings.drop_duplicates('sensor_index', keep='last').set_index('sensor_index')
+        disagreement = channel_disagreement(latest)
+        df['ab_difference'] = df['sensor_index'].map(disagreement['ab_difference']).astype('float32')
+        issues['ab_disagreement'] = df['sensor_index'].map(disagreement['ab_disagree']).fillna(False).to_numpy(dtype=bool)
+
+    degraded = np.zeros(n, dtype=bool)
+    text = pd.Series('', index=df.index)
+    for name, mask in issues.items():
+        degraded |= mask
+        text = text + np.where(mask, f"{name};", '')
+
+    offline = np.isnan(age) | (age > HEALTH_OFFLINE_AGE)
+    stale = age > HEALTH_STALE_AGE
+    df['status'] = np.select([offline, stale, degraded], ['offline', 'stale', 'degraded'], default='healthy')
+    df['issues'] = text.str.rstrip(';')
+
+    logger.info("Scored %s sensors: %s.", n, df['status'].value_counts().to_dict())
+
+    return df
+
+@metrics.instrument('get_members_data')
+def get_members_data(group_id, fields=None, precision=None):
+    """
+    Retrieves the latest reading of every member of a group.
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See get_groups().
+
+    fields, precision :
+        The data fields to request, ie. 'aqi', and their decimals. Defaults to all DATA_FIELDS. See resolve_fields().
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, time_stamp (last_seen) and the requested fields, typed by FIELD_DTYPES.
+    """
+    logger.info("Getting most recent data reading for all members in group %s", group_id)
+
+    fields, query = resolve_fields(fields, precision)
     params = {
-        'fields': ",".join(DATA_FIELDS_QUERY + ['last_seen'])
+        'fields': ",".join(query + ['last_seen'])
     }
 
-    json = get_json_safely(f"{GROUPS_URL}/{group_id}/members", headers=read_header, params=params)
+    points = estimate_points(query + ['last_seen'], rows=len(get_member_map(group_id)))
+    json = get_json_safely(f"{_url('groups')}/{group_id}/members", headers=get_config()['read_header'], params=params, points=points, priority=PRIORITY_LIVE)
 
-    df = pd.DataFrame([x for x in json['data']], columns=json['fields'])
-    df.columns = [x.replace('|d3','') if x.endswith('|d3') else x for x in df.columns]
-    df['time_stamp'] = [datetime.datetime.fromtimestamp(x, datetime.timezone.utc) for x in df['last_seen']]
-    df = df[['sensor_index', 'time_stamp'] + [col for col in DATA_FIELDS if col not in ['time_stamp', 'sensor_index']]]
+    json['fields'] = ['time_stamp' if x == 'last_seen' else x for x in json['fields']]
+    df = decode_data(json, columns=['sensor_index', 'time_stamp'] + fields)
 
     return df
 
-def get_member_history(group_id, member_id, start=None, end=None, average=0, by_sensor_index=True):
+@metrics.instrument('get_member_history')
+def get_member_history(group_id, member_id, start=None, end=None, average=0, by_sensor_index=True, max_workers=4, incremental=False, fields=None, precision=None):
     """
     Retrieves historical data from the purple API for a given member of a group. 
 
@@ -396,6 +1468,9 @@ def get_member_history(group_id, member_id, start=None, end=None, average=0, by_
     returned based on the average reading that is set. If neither is set the readings will contain the max number of readings for the
     most recent period. 
 
+    If start is designated and the period is longer than the maximum for the average (see AVERAGE_LIMITS) the period is split into
+    chunks that are fetched in parallel and combined. Readings duplicated at chunk boundaries are dropped.
+
     Parameters:
     -----------
     group_id : str
@@ -428,85 +1503,409 @@ def get_member_history(group_id, member_id, start=None, end=None, average=0, by_
         If True, converts the memeber id to a sensor id and drop member id and group columns. 
         If False, maintains member and group ids to convert later. See get_members_history.
 
+    max_workers : int
+        The maximum number of chunks to fetch at the same time.
+
+    incremental : bool
+        If True, only readings after the last time stamp ingested for the sensor and average are requested and the stored
+        high-water mark is advanced to the newest reading returned. See get_members_history.
+
+    fields : str or list
+        The data fields to request, the name of one of FIELD_PROFILES or a list of DATA_FIELDS. Defaults to all
+        DATA_FIELDS. See resolve_fields().
+
+    precision : int or dict
+        The decimals to request, for every field or by field. Defaults to FIELD_PRECISION.
+
     Returns:
     --------
     pandas.Dataframe
-        A pandas dataframe with all the sensor readings for the sensor by member_id
+        A pandas dataframe with all the sensor readings for the sensor by member_id. Only the requested fields are
+        included, always in DATA_FIELDS order and with the types in FIELD_DTYPES.
     """
 
+    logger.info("Getting data for sensor with member id %s between %s and %s, readings averaged every %s minutes.", member_id, start, end, average)
+
+    fields, query = resolve_fields(fields, precision)
+    _check_incremental_fields(incremental, fields)
+
+    since = None
+    if incremental:
+        id_map = {member_id: get_member_map(group_id)[member_id]}
+        since = _read_high_water_marks(id_map, average)
+
+    frames, failed = fetch_history(group_id, [member_id], start=start, end=end, average=average, max_workers=max_workers, since=since, fields=fields, precision=precision)
+    if member_id in failed:
+        raise failed[member_id]
+    df = frames[member_id]
+
+    if incremental:
+        report = _record_high_water_marks(frames, id_map, since, start, average)
+
+    if by_sensor_index:
+        df['sensor_index'] = sensorid_from_memberid(group_id=group_id, member_ids=df['member_id'])
+        df = df[['sensor_index', 'time_stamp'] + fields]
+
+    else: 
+        df = df[['member_id', 'group_id', 'time_stamp'] + fields]
+
+    if incremental:
+        df.attrs['incremental'] = report
+
+    return df
+
+def cadence(average):
+    """
+    Returns the expected number of seconds between readings for an average. Real-time history is reported every 2 minutes.
+    """
+    if average == 0:
+        return 120
+    return average * 60
+
+def _check_incremental_fields(incremental, fields):
+    """
+    Raises ValueError for an incremental fetch of only some fields. High-water marks are kept per sensor and average,
+    so advancing one after a partial fetch would skip the other fields of those readings on the next full fetch.
+    """
+    if incremental and len(fields) < len(DATA_FIELDS):
+        raise ValueError("Incremental fetches must request every field in DATA_FIELDS. See model.FetchState.")
+
+def _read_high_water_marks(id_map, average):
+    """
+    Returns a dict of member id to the UNIX time stamp of the last reading ingested for that member's sensor. See model.FetchState.
+    """
+    import model
+
+    marks = model.get_high_water_marks(list(id_map.values()), average)
+
+    return {member: marks[sensor] for member, sensor in id_map.items() if sensor in marks}
+
+def _record_high_water_marks(frames, id_map, since, start, average):
+    """
+    Advances the high-water mark for every member with new readings and reports the number of rows fetched and skipped.
+
+    Skipped rows are estimated from the part of the requested period that was already ingested and the cadence of the average.
+    """
+    import model
+
+    marks = {}
+    new_rows = 0
+    skipped_rows = 0
+    for member, df in frames.items():
+        new_rows += len(df)
+        if len(df) > 0:
+            marks[id_map[member]] = int(df['time_stamp'].max().timestamp())
+        if member in since and start != None:
+            skipped_rows += max(since[member] - to_timestamp(start, 'Start'), 0) // cadence(average)
+
+    model.update_high_water_marks(marks, average)
+    logger.info("Incremental fetch: %s new rows, skipped about %s rows already ingested. Advanced %s high-water marks.", new_rows, skipped_rows, len(marks))
+
+    return {'new_rows': new_rows, 'skipped_rows': skipped_rows}
+
+def to_timestamp(value, name='Time'):
+    """
+    Converts a date-like value to an integer UNIX time stamp, ie. the start_timestamp and end_timestamp of the history
+    endpoint. Naive values are treated as UTC, like model.to_unix, and time zone aware values are converted to UTC.
+    """
     import pandas as pd
-    import datetime
-    logger.info(f"Getting data for sensor with member id {member_id} between {start} and {end}, readings averaged every {average} minutes.")
 
+    if not isinstance(value, date):
+        logger.debug("Converting %s to date.", value)
+    try:
+        value = pd.Timestamp(pd.to_datetime(value, yearfirst=True))
+    except Exception as e:
+        logger.error("%s parameter must be a date or convertible by pd.to_datetime: %s", name, e)
+        raise pd.errors.ParserError from e
+    if value.tzinfo == None:
+        value = value.tz_localize('UTC')
+
+    return int(value.timestamp())
+
+@metrics.instrument('get_history_chunk')
+def get_history_chunk(group_id, member_id, start=None, end=None, average=0, fields=None, precision=None):
+    """
+    Makes a single request to the history endpoint, ie. to refetch one gap. start and end must be within the limit
+    for the average, see check_interval. The parameters are those of get_member_history.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        time_stamp, the fields, member_id and group_id.
+    """
+    fields, query = resolve_fields(fields, precision)
     params = {
-        'fields': ",".join(DATA_FIELDS_QUERY),
+        'fields': ",".join(query),
         'average': average
     }
 
     if start != None:
-        if not isinstance(start, date):
-            logger.debug(f"Converting {start} to date.")
-            try:
-                start = pd.to_datetime(start, yearfirst=True).strftime('%s')
-            except Exception as e:
-                logger.error(f'Start parameter must be a date or convertible by pd.to_datetime: {e}')
-                raise pd.errors.ParserError
-        else:
-            start = start.strftime('%s')
-        params.update({'start_timestamp': start})
+        params.update({'start_timestamp': to_timestamp(start, 'Start')})
 
     if end != None:
-        if not isinstance(end, date):
-            logger.debug(f"Converting {end} to date.")
-            try:
-                end = pd.to_datetime(end, yearfirst=True).strftime('%s')
-            except Exception as e:
-                logger.error(f'End parameter must be a date or convertible by pd.to_datetime: {e}')
-                raise pd.errors.ParserError
-        else:
-            end = end.strftime('%s')
-        params.update({'end_timestamp': end})
+        params.update({'end_timestamp': to_timestamp(end, 'End')})
 
-    json = get_json_safely(f"{GROUPS_URL}/{group_id}/members/{member_id}/history", headers=read_header, params=params)
+    points = estimate_points(query, rows=estimate_history_rows(params.get('start_timestamp'), params.get('end_timestamp'), average))
+    json = get_json_safely(f"{_url('groups')}/{group_id}/members/{member_id}/history", headers=get_config()['read_header'], params=params, points=points, priority=PRIORITY_BACKFILL)
 
-    df = pd.DataFrame([x for x in json['data']], columns=json['fields'])
-    df.columns = [x.replace('|d3','') if x.endswith('|d3') else x for x in df.columns]
+    df = decode_data(json, columns=['time_stamp'] + fields)
     df['member_id'] = member_id
     df['group_id'] = group_id
-    df['time_stamp'] = [datetime.datetime.fromtimestamp(x, datetime.timezone.utc) for x in df['time_stamp']]
 
-    if by_sensor_index:
-        df['sensor_index'] = sensorid_from_memberid(group_id=group_id, member_ids=df['member_id'])
-        df = df[['sensor_index', 'time_stamp'] + [col for col in DATA_FIELDS if col not in ['time_stamp', 'sensor_index']]]
+    return df
 
-    else: 
-        df = df[['member_id', 'group_id', 'time_stamp'] + [col for col in DATA_FIELDS if col not in ['member_id', 'group_id', 'time_stamp']]]
+@metrics.instrument('fetch_history')
+def fetch_history(group_id, members, start=None, end=None, average=0, max_workers=8, since=None, fields=None, precision=None):
+    """
+    Fetches history for members of a group on a bounded thread pool, splitting long periods into chunks.
 
-    return df
+    Every (member, chunk) pair is a separate task on the same pool so a few long members do not hold up
+    the rest. Chunks for a member are combined in time order and readings duplicated at chunk boundaries are dropped.
 
-def get_members_history(group_id, start, end, average=0):
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See get_groups().
+
+    members : list
+        The member ids to fetch.
+
+    start, end, average :
+        See get_member_history().
+
+    max_workers : int
+        The maximum number of requests to make at the same time.
+
+    since : dict
+        Optional map of member id to the UNIX time stamp of the last reading already ingested for that member. The member is only
+        requested from after that reading, and any readings at or before it are dropped. See get_members_history(incremental=True).
+
+    fields, precision :
+        The data fields to request and their decimals. See resolve_fields().
+
+    Returns:
+    --------
+    tuple
+        A dict of member id to pandas.DataFrame with member_id, group_id, time_stamp and the requested fields for each member
+        that succeeded, and a dict of member id to the exception raised for each member that failed.
+    """
     import pandas as pd
-    
-    details = get_group_details(group_id)
-    members = [x['id'] for x in details['members']]
-    id_map = {}
-    [id_map.update({x: y}) for x,y,z in [sensor.values() for sensor in details['members']]]
-    logger.info(f"Getting data between {start} and {end} for all {len(members)} members of group {group_id}.")
+    from concurrent.futures import ThreadPoolExecutor
 
-    df = []
+    fields, query = resolve_fields(fields, precision)
+    since = {} if since is None else since
+    tasks = {}
     for member in members:
-        member_data = get_member_history(member, sensor_index=False, average=average)
-        df.append(member_data)
+        member_start = start
+        member_end = end
+        if member in since:
+            # Compared as UNIX time stamps and passed on as UTC, see to_timestamp
+            first = since[member] + 1
+            if start != None:
+                first = max(first, to_timestamp(start, 'Start'))
+            if end != None:
+                member_end = pd.Timestamp(to_timestamp(end, 'End'), unit='s', tz='UTC')
+                if first >= member_end.timestamp():
+                    logger.debug("Member %s is up to date through %s. Skipping.", member, member_end)
+                    tasks[member] = []
+                    continue
+            member_start = pd.Timestamp(first, unit='s', tz='UTC')
+
+        if member_start != None:
+            tasks[member] = [(x.left, x.right) for x in check_interval(verify_interval(member_start, member_end), average)]
+        else:
+            tasks[member] = [(member_start, member_end)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {member: [pool.submit(get_history_chunk, group_id, member, start=x, end=y, average=average, fields=fields, precision=precision) for x, y in chunks] for member, chunks in tasks.items()}
+
+    frames = {}
+    failed = {}
+    for member, member_futures in futures.items():
+        try:
+            df = [future.result() for future in member_futures]
+        except Exception as e:
+            logger.error("Failed to get data for member %s of group %s: %r", member, group_id, e)
+            failed[member] = e
+            continue
+
+        if len(df) > 1:
+            df = pd.concat(df, ignore_index=True)
+            df = df.drop_duplicates(subset=['member_id', 'time_stamp']).sort_values('time_stamp', ignore_index=True)
+            logger.debug("Combined %s chunks into %s readings for member %s.", len(member_futures), len(df), member)
+        elif len(df) == 1:
+            df = df[0]
+        else:
+            df = decode_data({'fields': [], 'data': []}, columns=['time_stamp'] + fields)
+            df['member_id'] = member
+            df['group_id'] = group_id
+
+        if member in since:
+            mark = pd.Timestamp(since[member], unit='s', tz='UTC')
+            df = df.loc[df['time_stamp'] > mark].reset_index(drop=True)
+        frames[member] = df
+
+    return frames, failed
+
+@metrics.instrument('iter_member_history')
+def iter_member_history(group_id, member_id, start=None, end=None, average=0, batch_size=STREAM_BATCH_SIZE, as_arrow=False, fields=None, precision=None):
+    """
+    Streams historical data for a member of a group in batches of rows.
+
+    Unlike get_member_history, the response is parsed as it is downloaded and chunks of long periods are fetched one
+    after another, so peak memory is bounded by batch_size rather than the length of the period. Batches can be written
+    straight to storage, ie.
+
+        for batch in iter_member_history(group_id, member_id, start, end):
+            model.load_readings(batch, average=0)
+
+    Parameters:
+    -----------
+    group_id, member_id, start, end, average, fields, precision :
+        See get_member_history().
+
+    batch_size : int
+        The maximum number of rows per batch.
+
+    as_arrow : bool
+        If True, yields pyarrow.RecordBatch instead of pandas.DataFrame.
+
+    Yields:
+    -------
+    pandas.DataFrame or pyarrow.RecordBatch
+        Readings with the same columns as get_member_history(by_sensor_index=True).
+    """
+    import pandas as pd
+
+    logger.info("Streaming data for sensor with member id %s between %s and %s, readings averaged every %s minutes.", member_id, start, end, average)
+
+    sensor_index = get_member_map(group_id)[member_id]
+    fields, query = resolve_fields(fields, precision)
+
+    if start != None:
+        chunks = [(x.left, x.right) for x in check_interval(verify_interval(start, end), average)]
+    else:
+        chunks = [(start, end)]
+
+    def batch(returned, rows, after):
+        df = decode_data({'fields': returned, 'data': rows}, columns=['time_stamp'] + fields)
+        df.insert(0, 'sensor_index', sensor_index)
+        if after != None:
+            # The first reading of a chunk was the last reading of the previous chunk
+            df = df.loc[df['time_stamp'] > after].reset_index(drop=True)
+        if as_arrow:
+            import pyarrow as pa
+            return pa.RecordBatch.from_pandas(df, preserve_index=False)
+        return df
+
+    for i, (x, y) in enumerate(chunks):
+        params = {
+            'fields': ",".join(query),
+            'average': average
+        }
+        if x != None:
+            params.update({'start_timestamp': to_timestamp(x, 'Start')})
+        if y != None:
+            params.update({'end_timestamp': to_timestamp(y, 'End')})
+        after = pd.Timestamp(int(params['start_timestamp']), unit='s', tz='UTC') if i > 0 else None
+
+        logger.info("Streaming data from %s/%s/members/%s/history with parameters %s.", _url('groups'), group_id, member_id, params)
+        points = estimate_points(query, rows=estimate_history_rows(params.get('start_timestamp'), params.get('end_timestamp'), average))
+        r = request_safely('GET', f"{_url('groups')}/{group_id}/members/{member_id}/history", headers=get_config()['read_header'], params=params, stream=True, points=points, priority=PRIORITY_BACKFILL)
+        try:
+            data = iter_json_data(r)
+            returned = next(data)
+            rows = []
+            for row in data:
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    yield batch(returned, rows, after)
+                    rows = []
+            if len(rows) > 0:
+                yield batch(returned, rows, after)
+        finally:
+            r.close()
+
+@metrics.instrument('get_members_history')
+def get_members_history(group_id, start, end, average=0, max_workers=8, incremental=False, fields=None, precision=None):
+    """
+    Retrieves historical data from the purple API for all members of a group.
+
+    Members are fetched concurrently on a bounded thread pool and periods longer than the API limit for the average
+    are split into chunks, see fetch_history(). A member that fails is logged and recorded in the returned dataframe's
+    attrs['failed'] rather than aborting the rest of the group.
+
+    Parameters:
+    -----------
+    group_id : str
+        The id number for the group. See get_groups().
+
+    start : date-like
+        The beginning date for the data.
+
+    end : date-like
+        The end date for the data.
+
+    average : int
+        default to 0 or realtime data. See get_member_history() for options and query limits.
+
+    max_workers : int
+        The maximum number of requests to make at the same time. Set to 1 to fetch one at a time.
 
-    df = pd.concat(df)
-    df['sensor_id'] = sensorid_from_memberid(group_id, df['member_id'])
-    df = df[['sensor_index', 'time_stamp'] + [col for col in DATA_FIELDS if col not in ['time_stamp', 'sensor_index']]]
+    incremental : bool
+        If True, each member is only requested from after the last time stamp ingested for its sensor and average, see
+        model.FetchState. The high-water marks are advanced to the newest reading returned, so only set this when the result
+        is being stored. attrs['incremental'] reports the number of new rows and the estimated number of rows skipped.
+        Requires every field.
+
+    fields, precision :
+        The data fields to request, ie. 'aqi' for the fields quality.process needs, and their decimals. Defaults to
+        all DATA_FIELDS. See resolve_fields().
+
+    Returns:
+    --------
+    pandas.Dataframe
+        A pandas dataframe with the sensor readings for all members of the group, with sensor_index, time_stamp and the
+        requested fields in DATA_FIELDS order. attrs['failed'] maps the member
+        id of any member that could not be fetched to the exception that was raised.
+    """
+    import pandas as pd
+
+    fields, query = resolve_fields(fields, precision)
+    _check_incremental_fields(incremental, fields)
+
+    id_map = get_member_map(group_id)
+    members = list(id_map)
+    logger.info("Getting data between %s and %s for all %s members of group %s using %s workers.", start, end, len(members), group_id, max_workers)
+
+    since = None
+    if incremental:
+        since = _read_high_water_marks(id_map, average)
+        logger.info("%s of %s members have been ingested before. Fetching only newer readings.", len(since), len(members))
+
+    frames, failed = fetch_history(group_id, members, start=start, end=end, average=average, max_workers=max_workers, since=since, fields=fields, precision=precision)
+    df = [frames[member] for member in members if member in frames]
+
+    if incremental:
+        report = _record_high_water_marks(frames, id_map, since, start, average)
+
+    if len(failed) > 0:
+        logger.warning("%s of %s members failed: %s", len(failed), len(members), list(failed))
+
+    columns = ['sensor_index', 'time_stamp'] + fields
+    if len(df) == 0:
+        df = decode_data({'fields': [], 'data': []}, columns=columns)
+    else:
+        df = pd.concat(df, ignore_index=True)
+        df['sensor_index'] = df['member_id'].map(id_map)
+        df = df[columns]
+    df.attrs['failed'] = failed
+    if incremental:
+        df.attrs['incremental'] = report
 
     return df
     
 def sensorid_from_memberid(group_id, member_ids):
-    details = get_group_details(group_id)
-    id_map = {}
-    [id_map.update({x: y}) for x,y,z in [sensor.values() for sensor in details['members']]]
+    id_map = get_member_map(group_id)
     
     return member_ids.map(id_map)
\ No newline at end of file
@@ -0,0 +1,301 @@
+"""
+Quality assurance and AQI for PurpleAir PM2.5 readings.
+
+Runs on the frames returned by purpleair.get_member_history, get_members_history or model.read_readings:
+
+    df = purpleair.get_members_history(group_id, start, end, fields='aqi')  # Only the fields used here
+    result = quality.process(df)
+    result['readings']  # A/B flags and EPA corrected PM2.5 for every reading
+    result['hourly']    # Hourly means, NowCast and NowCast AQI for every sensor
+    result['daily']     # Daily means and AQI for every sensor
+
+Every step is vectorized over all sensors at once. For more readings than fit in memory, iter_process_readings
+processes the readings table a few sensors at a time.
+"""
+import logging
+
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+PM_FIELD = 'pm2.5_cf_1' # EPA corrections are fit to the cf_1 channels
+CORRECTED_FIELD = 'pm2.5_epa'
+
+AQI_TZ = 'America/New_York' # Time zone of the days that daily AQI is averaged over
+DAILY_MIN_HOURS = 18 # Hours with data needed for a daily average, ie. 75 percent
+NOWCAST_HOURS = 12 # Hours in the NowCast window
+NOWCAST_MIN_RECENT = 2 # Of the 3 most recent hours, the number that must have data
+CHUNK_SENSORS = 25 # Sensors per chunk in iter_process_readings
+
+# PM2.5 AQI breakpoints as revised by the US EPA in February 2024: concentration low, high, AQI low, high
+AQI_BREAKPOINTS = [
+    (0.0, 9.0, 0, 50),
+    (9.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 125.4, 151, 200),
+    (125.5, 225.4, 201, 300),
+    (225.5, 325.4, 301, 500),
+]
+
+def qa_channels(df, field=PM_FIELD):
+    """
+    Flags readings where the A and B channels disagree and averages the channels.
+
+    Uses the PurpleAir/US EPA criteria, a difference of more than purpleair.HEALTH_AB_ABS ug/m3 and a relative
+    percent difference of more than purpleair.HEALTH_AB_RPD. See purpleair.channel_disagreement.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        df with ab_difference, ab_rpd, ab_flag (True where the channels disagree or one is missing) and field, the
+        mean of the A and B channels, missing where ab_flag is True.
+    """
+    import numpy as np
+
+    df = df.copy()
+    disagreement = purpleair.channel_disagreement(df, field=field)
+    a = df[f"{field}_a"].to_numpy(dtype='float64')
+    b = df[f"{field}_b"].to_numpy(dtype='float64')
+
+    flag = disagreement['ab_disagree'].to_numpy() | np.isnan(a) | np.isnan(b)
+    df['ab_difference'] = disagreement['ab_difference'].astype('float32')
+    df['ab_rpd'] = disagreement['ab_rpd'].astype('float32')
+    df['ab_flag'] = flag
+    df[field] = np.where(flag, np.nan, (a + b) / 2).astype('float32')
+
+    return df
+
+def epa_correction(pm, humidity):
+    """
+    Applies the US EPA correction for PurpleAir PM2.5 to arrays of cf_1 PM2.5 and relative humidity.
+
+    Uses the nationwide correction of Barkjohn et al. (2021), PM2.5 = 0.524 PA - 0.0862 RH + 5.75, with the 2023
+    extension for smoke that blends to a quadratic fit above 50 ug/m3:
+
+        PA < 30          0.524 PA - 0.0862 RH + 5.75
+        30 <= PA < 50    blend of the 0.524 and 0.786 slopes
+        50 <= PA < 210   0.786 PA - 0.0862 RH + 5.75
+        210 <= PA < 260  blend to the quadratic fit
+        260 <= PA        2.966 + 0.69 PA + 8.84e-4 PA^2
+
+    Negative results are set to 0. Missing inputs give missing results.
+    """
+    import numpy as np
+
+    pa = np.asarray(pm, dtype='float64')
+    rh = np.asarray(humidity, dtype='float64')
+
+    low = 0.524 * pa - 0.0862 * rh + 5.75
+    w = pa / 20 - 3 / 2
+    low_blend = (0.786 * w + 0.524 * (1 - w)) * pa - 0.0862 * rh + 5.75
+    mid = 0.786 * pa - 0.0862 * rh + 5.75
+    w = pa / 50 - 21 / 5
+    high_blend = (0.69 * w + 0.786 * (1 - w)) * pa - 0.0862 * rh * (1 - w) + 2.966 * w + 5.75 * (1 - w) + 8.84e-4 * pa ** 2 * w
+    high = 2.966 + 0.69 * pa + 8.84e-4 * pa ** 2
+
+    corrected = np.select([pa < 30, pa < 50, pa < 210, pa < 260], [low, low_blend, mid, high_blend], default=high)
+    corrected = np.where(np.isnan(pa) | (np.isnan(rh) & (pa < 260)), np.nan, corrected)
+
+    return np.maximum(corrected, 0)
+
+def correct(df, field=PM_FIELD):
+    """
+    Runs qa_channels and adds CORRECTED_FIELD, the EPA corrected PM2.5 of the readings that pass.
+    """
+    df = qa_channels(df, field=field)
+    df[CORRECTED_FIELD] = epa_correction(df[field], df['humidity']).astype('float32')
+
+    return df
+
+def aqi(concentration):
+    """
+    Returns the PM2.5 AQI for an array of concentrations using AQI_BREAKPOINTS.
+
+    Concentrations are truncated to 0.1 ug/m3 first. Concentrations above the last breakpoint are reported as 500.
+    """
+    import numpy as np
+
+    c = np.floor(np.asarray(concentration, dtype='float64') * 10 + 1e-9) / 10
+    c_low = np.array([x[0] for x in AQI_BREAKPOINTS])
+    c_high = np.array([x[1] for x in AQI_BREAKPOINTS])
+    i_low = np.array([x[2] for x in AQI_BREAKPOINTS])
+    i_high = np.array([x[3] for x in AQI_BREAKPOINTS])
+
+    segment = np.clip(np.searchsorted(c_low, c, side='right') - 1, 0, len(AQI_BREAKPOINTS) - 1)
+    index = (i_high[segment] - i_low[segment]) / (c_high[segment] - c_low[segment]) * (c - c_low[segment]) + i_low[segment]
+    index = np.where(c > c_high[-1], 500, np.round(index))
+
+    return np.where(np.isnan(c) | (c < 0), np.nan, index)
+
+def hourly(df, field=CORRECTED_FIELD):
+    """
+    Averages readings by sensor and hour.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, time_stamp (start of the hour), field (the mean) and count, the number of readings, for every hour
+        from the first to the last reading of each sensor. Hours without valid readings are missing.
+    """
+    import numpy as np
+    import pandas as pd
+
+    hours = df['time_stamp'].dt.floor('h')
+    grouped = df.groupby([df['sensor_index'], hours], sort=True)[field]
+    means = pd.DataFrame({field: grouped.mean(), 'count': grouped.count()}).reset_index()
+
+    # Fill in missing hours so windows are counted in hours rather than rows
+    epoch = pd.Timestamp(0, tz='UTC')
+    bounds = means.groupby('sensor_index')['time_stamp'].agg(['min', 'max'])
+    first = ((bounds['min'] - epoch) // pd.Timedelta(hours=1)).to_numpy()
+    lengths = ((bounds['max'] - bounds['min']) // pd.Timedelta(hours=1) + 1).to_numpy()
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    grid = pd.DataFrame({
+        'sensor_index': np.repeat(bounds.index.to_numpy(), lengths),
+        'time_stamp': pd.to_datetime((np.repeat(first, lengths) + offsets) * 3600, unit='s', utc=True),
+    })
+    grid['time_stamp'] = grid['time_stamp'].astype(means['time_stamp'].dtype)
+    means = grid.merge(means, on=['sensor_index', 'time_stamp'], how='left')
+    means['count'] = means['count'].fillna(0).astype('int64')
+    means[field] = means[field].astype('float32')
+
+    return means
+
+def nowcast(hours, field=CORRECTED_FIELD):
+    """
+    Computes the PM2.5 NowCast and NowCast AQI for each hour of each sensor.
+
+    The NowCast weights the last NOWCAST_HOURS hourly means by w ** age, where w is the ratio of the minimum to the
+    maximum of the window but at least 0.5. It is missing unless NOWCAST_MIN_RECENT of the 3 most recent hours have data.
+
+    Parameters:
+    -----------
+    hours : pandas.DataFrame
+        The return of hourly(), with every hour of each sensor.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        hours with nowcast, truncated to 0.1 ug/m3, and nowcast_aqi columns.
+    """
+    import warnings
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    hours = hours.sort_values(['sensor_index', 'time_stamp'], ignore_index=True)
+    values = hours[field].to_numpy(dtype='float64')
+    sensors = hours['sensor_index'].to_numpy()
+
+    # Pad the front of each sensor's hours so windows never reach into the previous sensor
+    padded = np.concatenate([np.full(NOWCAST_HOURS - 1, np.nan), values])
+    windows = sliding_window_view(padded, NOWCAST_HOURS)[:, ::-1].copy() # Column 0 is the most recent hour
+    position = np.arange(len(hours)) - np.searchsorted(sensors, sensors, side='left')
+    windows[np.arange(NOWCAST_HOURS)[None, :] > position[:, None]] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        high = np.nanmax(windows, axis=1)
+        low = np.nanmin(windows, axis=1)
+        w = np.where(high > 0, low / high, 1)
+    w = np.clip(w, 0.5, 1)
+
+    present = ~np.isnan(windows)
+    weights = np.where(present, w[:, None] ** np.arange(NOWCAST_HOURS)[None, :], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = (weights * np.where(present, windows, 0)).sum(axis=1) / weights.sum(axis=1)
+    valid = present[:, :3].sum(axis=1) >= NOWCAST_MIN_RECENT
+    value = np.where(valid, np.floor(value * 10 + 1e-9) / 10, np.nan)
+
+    hours['nowcast'] = value.astype('float32')
+    hours['nowcast_aqi'] = aqi(value)
+
+    return hours
+
+def daily(df, field=CORRECTED_FIELD, tz=AQI_TZ, hours=None):
+    """
+    Averages readings by sensor and local day and computes the daily AQI.
+
+    Days are midnight to midnight in tz. A day needs hourly means for at least DAILY_MIN_HOURS hours, otherwise its
+    mean and AQI are missing. Pass hours, the return of hourly(df), if it has already been computed.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, date, field (the mean of the hourly means), hours, the number of hours with data, and aqi.
+    """
+    import pandas as pd
+
+    if hours is None:
+        hours = hourly(df, field=field)
+    hours = hours.loc[hours['count'] > 0]
+    dates = hours['time_stamp'].dt.tz_convert(tz).dt.date
+    grouped = hours.groupby([hours['sensor_index'], dates.rename('date')], sort=True)[field]
+    days = pd.DataFrame({field: grouped.mean(), 'hours': grouped.count()}).reset_index()
+
+    days[field] = days[field].where(days['hours'] >= DAILY_MIN_HOURS).astype('float32')
+    days['aqi'] = aqi(days[field])
+
+    return days
+
+def process(df, field=PM_FIELD, tz=AQI_TZ):
+    """
+    Runs the whole quality stage on a frame of readings.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Readings with sensor_index, time_stamp, humidity and the A and B channels of field, ie. the return of
+        purpleair.get_members_history or model.read_readings.
+
+    Returns:
+    --------
+    dict
+        'readings', see correct(), 'hourly', see hourly() and nowcast(), and 'daily', see daily().
+    """
+    import time
+
+    start = time.perf_counter()
+    readings = correct(df, field=field)
+    hours = nowcast(hourly(readings))
+    days = daily(readings, tz=tz, hours=hours)
+    logger.info("Processed %s readings from %s sensors in %.2f s, %s flagged.", len(readings), readings['sensor_index'].nunique(), time.perf_counter() - start, readings['ab_flag'].sum())
+
+    return {'readings': readings, 'hourly': hours, 'daily': days}
+
+def iter_process_readings(sensor_index=None, start=None, end=None, average=0, chunk_sensors=CHUNK_SENSORS):
+    """
+    Runs process() over stored readings a few sensors at a time, so memory stays bounded by the chunk size.
+
+    Each chunk holds every reading of its sensors, so NowCast windows and daily averages are never split.
+
+    Parameters:
+    -----------
+    sensor_index : list
+        The sensors to process. Defaults to every sensor with readings.
+
+    start, end : date-like
+        Optional bounds on time_stamp. See model.read_readings.
+
+    average : int
+        The average of the readings. See purpleair.AVERAGE_LIMITS.
+
+    chunk_sensors : int
+        The number of sensors per chunk.
+
+    Yields:
+    -------
+    dict
+        The return of process() for each chunk.
+    """
+    import model
+
+    fields = ['humidity', f"{PM_FIELD}_a", f"{PM_FIELD}_b"]
+    if sensor_index is None:
+        with model.get_engine().connect() as conn:
+            sensor_index = [x for x, in conn.exec_driver_sql(f"SELECT DISTINCT sensor_index FROM {model.Reading.__tablename__} WHERE average = ? ORDER BY sensor_index", (int(average),))]
+
+    for i in range(0, len(sensor_index), chunk_sensors):
+        df = model.read_readings(sensor_index=sensor_index[i:i + chunk_sensors], start=start, end=end, average=average, columns=fields)
+        if len(df) == 0:
+            continue
+        yield process(df)
@@ -0,0 +1,349 @@
+"""
+Queries the local readings store, the SQLite readings table or a Parquet archive, with the same arguments and result as
+purpleair.get_members_history:
+
+    df = query.query(sensor_index=sensors, start=now - pd.Timedelta(days=7), end=now, fields='pm2.5')
+    hourly = query.query(sensor_index=sensors, start='2025-06-01', end='2025-07-01', fields='aqi', resample='1h')
+    table = query.query(store='./output_data/archive', start='2025-01-01', as_arrow=True)
+
+    for batch in query.iter_query(start='2020-01-01', batch_size=500000):  # Bounded memory for any size of result
+        ...
+
+Sensor and time filters use the primary key of the readings table or the sensor and month partitions of the archive,
+and only the requested fields are read. Resampling is done by SQLite, from the rollup tables when the interval has one
+and they hold every reading of the queried sensors and range. Readings loaded before the rollup tables existed are not
+rolled up until rollup.rebuild_rollups() is run once, and resampling reads the readings table until then.
+"""
+import logging
+
+import model
+import purpleair
+
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH_SIZE = 100000 # Rows per batch yielded by iter_query
+MONTHLY = ['monthly', 'month', 'MS', '1MS', 'M', 'ME'] # Names of a calendar month resample interval
+
+def resample_seconds(resample):
+    """
+    Returns the length of a resample interval in seconds, None for calendar months.
+
+    resample is one of model.ROLLUP_INTERVALS, ie. 'hourly', one of MONTHLY, or a fixed length pandas.Timedelta can
+    parse, ie. '10min', '1h' or '1D'.
+    """
+    import pandas as pd
+
+    if resample in model.ROLLUP_INTERVALS:
+        return model.ROLLUP_INTERVALS[resample]
+    if resample in MONTHLY:
+        return None
+    try:
+        seconds = int(pd.Timedelta(resample).total_seconds())
+    except ValueError:
+        # A unit without a number, ie. 'h'
+        seconds = int(pd.Timedelta(pd.tseries.frequencies.to_offset(resample)).total_seconds())
+    if seconds <= 0:
+        raise ValueError(f"Resample interval {resample} must be positive.")
+
+    return seconds
+
+def _bucket_sql(seconds, column='time_stamp'):
+    if seconds == None:
+        return f"CAST(strftime('%s', {column}, 'unixepoch', 'start of month') AS INTEGER)"
+    return f"({column} / {seconds}) * {seconds}"
+
+def _bucket_bounds(seconds, start, end):
+    """
+    Returns the start of the bucket containing start and the end, exclusive, of the bucket containing end.
+    """
+    import pandas as pd
+
+    first = last = None
+    if seconds == None:
+        if start != None:
+            first = int(pd.Timestamp(start, unit='s').to_period('M').start_time.timestamp())
+        if end != None:
+            last = int((pd.Timestamp(end, unit='s').to_period('M') + 1).start_time.timestamp())
+        return first, last
+    if start != None:
+        first = (start // seconds) * seconds
+    if end != None:
+        last = (end // seconds + 1) * seconds
+
+    return first, last
+
+def _rollup_covers(conn, table, seconds, sensor_index, first, last):
+    """
+    Returns True if the rollup has the buckets of the first and last real-time reading of every sensor from first to
+    last. Readings loaded before the rollup tables existed were never queued, so they are missing from the rollups
+    until rollup.rebuild_rollups is run.
+    """
+    readings = model.Reading.__tablename__
+    if sensor_index is None:
+        sensor_index = [x for x, in conn.exec_driver_sql(f"SELECT DISTINCT sensor_index FROM {readings}")]
+
+    where = ""
+    params = []
+    if first != None:
+        where += " AND {0} >= ?"
+        params.append(first)
+    if last != None:
+        where += " AND {0} < ?"
+        params.append(last)
+    reading_where = where.format('time_stamp')
+    bucket_where = where.format('bucket')
+    # Each is a seek on a primary key
+    sql = (
+        f"SELECT (SELECT time_stamp FROM {readings} WHERE sensor_index = ? AND average = 0{reading_where} ORDER BY time_stamp LIMIT 1), "
+        f"(SELECT time_stamp FROM {readings} WHERE sensor_index = ? AND average = 0{reading_where} ORDER BY time_stamp DESC LIMIT 1), "
+        f"(SELECT MIN(bucket) FROM {table} WHERE sensor_index = ?{bucket_where}), "
+        f"(SELECT MAX(bucket) FROM {table} WHERE sensor_index = ?{bucket_where})"
+    )
+    for sensor in sensor_index:
+        low, high, first_bucket, last_bucket = conn.exec_driver_sql(sql, tuple([sensor] + params) * 4).first()
+        if low == None:
+            continue
+        if first_bucket == None or first_bucket > _bucket_bounds(seconds, low, None)[0] or last_bucket < _bucket_bounds(seconds, high, None)[0]:
+            logger.debug("Readings of sensor %s are missing from %s, resampling from the readings table.", sensor, table)
+            return False
+
+    return True
+
+def _rollup_interval(seconds, average, sensor_index=None, first=None, last=None):
+    """
+    Returns the rollup with buckets of this length if the readings are real-time and every loaded reading of the
+    sensors in the buckets from first to last is rolled up.
+    """
+    if average != 0:
+        return None
+    interval = [x for x, y in model.ROLLUP_INTERVALS.items() if y == seconds]
+    if len(interval) == 0:
+        return None
+    with model.get_engine().connect() as conn:
+        queued = conn.exec_driver_sql(f"SELECT 1 FROM {model.RollupQueue.__tablename__} LIMIT 1").first()
+        if queued != None:
+            logger.debug("Readings are queued for rollup, resampling from the readings table.")
+            return None
+        if not _rollup_covers(conn, model.ROLLUP_TABLES[interval[0]].name, seconds, sensor_index, first, last):
+            return None
+
+    return interval[0]
+
+def _sqlite_sql(sensor_index, start, end, fields, average, resample):
+    """
+    Returns the statement and parameters that read the readings or their resampled means, ordered by sensor and time.
+    """
+    where = []
+    params = []
+    if sensor_index is not None:
+        where.append(f"sensor_index IN ({', '.join(['?'] * len(sensor_index))})")
+        params += sensor_index
+
+    if resample == None:
+        where.insert(0, "average = ?")
+        params.insert(0, int(average))
+        if start != None:
+            where.append("time_stamp >= ?")
+            params.append(start)
+        if end != None:
+            where.append("time_stamp <= ?")
+            params.append(end)
+        names = ", ".join(['"%s"' % x for x in ['sensor_index', 'time_stamp'] + fields])
+        sql = f"SELECT {names} FROM {model.Reading.__tablename__} WHERE {' AND '.join(where)} ORDER BY sensor_index, time_stamp"
+        return sql, params
+
+    # Whole buckets, so a bucket is the same whether the range starts at its start or in the middle
+    seconds = resample_seconds(resample)
+    first, last = _bucket_bounds(seconds, start, end)
+    interval = _rollup_interval(seconds, average, sensor_index, first, last)
+    if interval != None:
+        if first != None:
+            where.append("bucket >= ?")
+            params.append(first)
+        if last != None:
+            where.append("bucket < ?")
+            params.append(last)
+        names = ", ".join(['"%s_mean"' % x for x in fields])
+        table = model.ROLLUP_TABLES[interval].name
+        sql = f"SELECT sensor_index, bucket, {names} FROM {table} WHERE {' AND '.join(where) or '1 = 1'} ORDER BY sensor_index, bucket"
+        return sql, params
+
+    where.insert(0, "average = ?")
+    params.insert(0, int(average))
+    if first != None:
+        where.append("time_stamp >= ?")
+        params.append(first)
+    if last != None:
+        where.append("time_stamp < ?")
+        params.append(last)
+    names = ", ".join(['AVG("%s")' % x for x in fields])
+    sql = (
+        f"SELECT sensor_index, {_bucket_sql(seconds)} AS bucket, {names} FROM {model.Reading.__tablename__} "
+        f"WHERE {' AND '.join(where)} GROUP BY sensor_index, bucket ORDER BY sensor_index, bucket"
+    )
+    return sql, params
+
+def _frame(rows, fields):
+    """
+    Builds a frame with the column types of purpleair.get_members_history from rows of sensor_index, UNIX time stamp
+    and fields.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # One conversion of the whole block, None becomes nan
+    values = np.array(rows, dtype='float64').reshape(-1, len(fields) + 2)
+    df = {
+        'sensor_index': values[:, 0].astype('int64'),
+        # Converted like purpleair.decode_data so the resolution is the same under any pandas version
+        'time_stamp': pd.to_datetime(values[:, 1], unit='s', utc=True),
+    }
+    for i, x in enumerate(fields):
+        df[x] = values[:, i + 2].astype('float32')
+
+    return pd.DataFrame(df, columns=['sensor_index', 'time_stamp'] + fields)
+
+def _iter_sqlite(sensor_index, start, end, fields, average, resample, batch_size):
+    sql, params = _sqlite_sql(sensor_index, start, end, fields, average, resample)
+    logger.debug("Querying readings: %s %s", sql, params)
+    # The DBAPI cursor returns plain tuples, which numpy converts many times faster than SQLAlchemy rows
+    conn = model.get_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, tuple(params))
+        if batch_size == None:
+            yield _frame(cursor.fetchall(), fields)
+            return
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                return
+            yield _frame(rows, fields)
+    finally:
+        conn.close()
+
+def _iter_parquet(store, sensor_index, start, end, fields, resample, batch_size):
+    """
+    Reads an archive one sensor at a time, so duplicates from repeated appends can be dropped and resampled buckets
+    can span partitions without holding more than one sensor in memory.
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow.dataset as ds
+    import archive
+
+    dataset = archive.open_archive(store)
+    seconds = None
+    if resample != None:
+        seconds = resample_seconds(resample)
+        start, end = _bucket_bounds(seconds, start, end)
+        end = end - 1 if end != None else None
+    bounds = [None if x == None else pd.Timestamp(x, unit='s', tz='UTC') for x in [start, end]]
+    expression = archive.archive_filter(sensor_index=sensor_index, start=bounds[0], end=bounds[1])
+
+    sensors = sorted(set(ds.get_partition_keys(x.partition_expression)['sensor_index'] for x in dataset.get_fragments(filter=expression)))
+    for sensor in sensors:
+        sensor_filter = ds.field('sensor_index') == sensor
+        table = dataset.to_table(columns=archive.ARCHIVE_KEYS + fields, filter=sensor_filter if expression is None else expression & sensor_filter)
+        df = table.to_pandas().drop_duplicates(subset=archive.ARCHIVE_KEYS, keep='last').sort_values('time_stamp', ignore_index=True)
+        times = model.to_unix(df['time_stamp']).to_numpy()
+
+        if resample != None:
+            if seconds == None:
+                buckets = model.to_unix(df['time_stamp'].dt.tz_localize(None).dt.to_period('M').dt.start_time).to_numpy()
+            else:
+                buckets = (times // seconds) * seconds
+            df = df[fields].astype('float64').groupby(buckets, sort=True).mean()
+            times = df.index.to_numpy()
+
+        rows = np.column_stack([np.full(len(df), sensor), times, df[fields].to_numpy(dtype='float64')])
+        step = len(rows) if batch_size == None else batch_size
+        for i in range(0, len(rows), max(step, 1)):
+            yield _frame(rows[i:i + step], fields)
+
+def iter_query(sensor_index=None, start=None, end=None, fields=None, average=0, resample=None, store=None, as_arrow=False, batch_size=QUERY_BATCH_SIZE):
+    """
+    Streams the result of query() in batches of at most batch_size rows, in sensor_index and time_stamp order.
+
+    Parameters:
+    -----------
+    batch_size : int
+        The maximum number of rows per batch. None reads the whole result at once.
+
+    sensor_index, start, end, fields, average, resample, store, as_arrow :
+        See query().
+
+    Yields:
+    -------
+    pandas.DataFrame or pyarrow.RecordBatch
+    """
+    fields, _ = purpleair.resolve_fields(fields)
+    if sensor_index is not None:
+        sensor_index = [int(x) for x in sensor_index]
+    start = None if start == None else purpleair.to_timestamp(start, 'Start')
+    end = None if end == None else purpleair.to_timestamp(end, 'End')
+
+    if store == None:
+        batches = _iter_sqlite(sensor_index, start, end, fields, average, resample, batch_size)
+    else:
+        batches = _iter_parquet(store, sensor_index, start, end, fields, resample, batch_size)
+
+    for df in batches:
+        if as_arrow:
+            import pyarrow as pa
+            yield pa.RecordBatch.from_pandas(df, preserve_index=False)
+        else:
+            yield df
+
+def query(sensor_index=None, start=None, end=None, fields=None, average=0, resample=None, store=None, as_arrow=False):
+    """
+    Reads readings from the local store with the same arguments and result as purpleair.get_members_history.
+
+    Parameters:
+    -----------
+    sensor_index : list
+        The sensors to read. Defaults to all sensors.
+
+    start, end : date-like
+        Optional bounds on time_stamp, inclusive, converted like the history request bounds. Naive values are treated
+        as UTC. See purpleair.to_timestamp.
+
+    fields : str or list
+        The name of one of purpleair.FIELD_PROFILES or a list of DATA_FIELDS. Defaults to all DATA_FIELDS.
+
+    average : int
+        The average of the stored readings to read. See purpleair.AVERAGE_LIMITS. Ignored for an archive, which holds
+        one average.
+
+    resample : str
+        Optional interval to average the readings over, ie. '10min', '1h', 'daily' or 'monthly'. Buckets are in UTC and
+        start at multiples of the interval since 1970. Every bucket that contains a time from start to end is returned
+        whole, with the mean of each field, and buckets without readings are left out.
+
+    store : path_like
+        The root directory of a Parquet archive, see archive.write_archive. Defaults to the readings table.
+
+    as_arrow : bool
+        If True, returns a pyarrow.Table.
+
+    Returns:
+    --------
+    pandas.DataFrame or pyarrow.Table
+        sensor_index (int64), time_stamp (UTC datetime, the start of the bucket when resampled) and the fields in
+        DATA_FIELDS order as float32, sorted by sensor_index and time_stamp.
+    """
+    import time
+    import pandas as pd
+
+    t = time.perf_counter()
+    frames = list(iter_query(sensor_index=sensor_index, start=start, end=end, fields=fields, average=average, resample=resample, store=store, batch_size=None))
+    if len(frames) == 0:
+        frames = [_frame([], purpleair.resolve_fields(fields)[0])]
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    logger.info("Queried %s rows from %s in %.2f s.", len(df), 'the readings table' if store == None else store, time.perf_counter() - t)
+
+    if as_arrow:
+        import pyarrow as pa
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    return df
@@ -0,0 +1,205 @@
+"""
+Time-bucket rollups of the stored real-time readings.
+
+model.load_readings records the range of real-time (average 0) readings it loads for each sensor in the rollup_queue
+table. refresh_rollups recomputes only the buckets those ranges touch, for each of model.ROLLUP_INTERVALS, with the
+mean, min, max and count of every field, so the rollups can be kept current after every load:
+
+    model.load_readings(df)
+    rollup.refresh_rollups()
+    hourly = rollup.read_rollup('hourly', sensor_index=[1234], start='2025-06-01')
+
+Buckets are in UTC. Daily and monthly buckets start at midnight UTC.
+"""
+import logging
+
+import model
+
+logger = logging.getLogger(__name__)
+
+def _bucket_sql(interval, column='time_stamp'):
+    seconds = model.ROLLUP_INTERVALS[interval]
+    if seconds == None:
+        return f"CAST(strftime('%s', {column}, 'unixepoch', 'start of month') AS INTEGER)"
+    return f"({column} / {seconds}) * {seconds}"
+
+def _bucket_bounds(interval, start, end):
+    """
+    Returns the start of the bucket containing start and the end of the bucket containing end as UNIX time stamps.
+    """
+    import pandas as pd
+
+    seconds = model.ROLLUP_INTERVALS[interval]
+    if seconds == None:
+        # Naive timestamps are UTC
+        first = pd.Timestamp(start, unit='s').to_period('M').start_time
+        last = (pd.Timestamp(end, unit='s').to_period('M') + 1).start_time
+        return int(first.timestamp()), int(last.timestamp())
+    return (start // seconds) * seconds, (end // seconds + 1) * seconds
+
+def _aggregate_sql(interval, table, source=None):
+    """
+    Returns the statement that recomputes the buckets of one sensor in a time range, from the readings or, if source is
+    given, from the buckets of a finer rollup that evenly divides them, which reads far fewer rows.
+    """
+    columns = []
+    names = ", ".join(['"%s"' % x.name for x in table.columns])
+    if source == None:
+        for x in model.READING_FIELDS:
+            columns += [f'AVG("{x}")', f'MIN("{x}")', f'MAX("{x}")', f'COUNT("{x}")']
+        return (
+            f"INSERT INTO {table.name} ({names}) "
+            f"SELECT sensor_index, {_bucket_sql(interval)} AS bucket, {', '.join(columns)} FROM {model.Reading.__tablename__} "
+            f"WHERE sensor_index = ? AND average = 0 AND time_stamp >= ? AND time_stamp < ? "
+            f"GROUP BY sensor_index, 2"
+        )
+
+    for x in model.READING_FIELDS:
+        columns += [f'SUM("{x}_mean" * "{x}_count") / SUM("{x}_count")', f'MIN("{x}_min")', f'MAX("{x}_max")', f'SUM("{x}_count")']
+    return (
+        f"INSERT INTO {table.name} ({names}) "
+        f"SELECT sensor_index, {_bucket_sql(interval, 'bucket')} AS new_bucket, {', '.join(columns)} FROM {source.name} "
+        f"WHERE sensor_index = ? AND bucket >= ? AND bucket < ? "
+        f"GROUP BY sensor_index, 2"
+    )
+
+def refresh_rollups(intervals=None):
+    """
+    Recomputes the rollup buckets touched by readings loaded since the last refresh.
+
+    Queued ranges are merged per sensor, the touched buckets are deleted and recomputed, and the queue entries are
+    removed, all in one transaction. The finest rollup is computed from the readings table and each coarser one from
+    the rollup before it. Ranges queued by loads that run during the refresh are left for the next one.
+
+    Parameters:
+    -----------
+    intervals : list
+        The rollups to refresh. Defaults to all of model.ROLLUP_INTERVALS. Queue entries are only removed when every
+        rollup is refreshed.
+
+    Returns:
+    --------
+    int
+        The number of sensors refreshed.
+    """
+    import time
+
+    full = intervals == None
+    if full:
+        intervals = list(model.ROLLUP_INTERVALS)
+    queue = model.RollupQueue.__table__
+
+    start = time.perf_counter()
+    with model.get_engine().begin() as conn:
+        last = conn.exec_driver_sql(f"SELECT MAX(id) FROM {queue.name}").scalar()
+        if last == None:
+            logger.debug("No readings queued for rollup.")
+            return 0
+        ranges = conn.exec_driver_sql(
+            f"SELECT sensor_index, MIN(start), MAX(\"end\") FROM {queue.name} WHERE id <= ? GROUP BY sensor_index", (last,)
+        ).fetchall()
+
+        source = None
+        for interval in model.ROLLUP_INTERVALS:
+            if interval not in intervals:
+                source = None
+                continue
+            table = model.ROLLUP_TABLES[interval]
+            insert = _aggregate_sql(interval, table, source=source)
+            source = table
+            for sensor_index, first, end in ranges:
+                low, high = _bucket_bounds(interval, first, end)
+                conn.exec_driver_sql(f"DELETE FROM {table.name} WHERE sensor_index = ? AND bucket >= ? AND bucket < ?", (sensor_index, low, high))
+                conn.exec_driver_sql(insert, (sensor_index, low, high))
+
+        if full:
+            conn.exec_driver_sql(f"DELETE FROM {queue.name} WHERE id <= ?", (last,))
+
+    logger.info("Refreshed %s rollups for %s sensors in %.2f s.", intervals, len(ranges), time.perf_counter() - start)
+
+    return len(ranges)
+
+def rebuild_rollups(sensor_index=None):
+    """
+    Queues every stored real-time reading, ie. readings loaded before the rollups existed, and refreshes the rollups.
+    """
+    queue = model.RollupQueue.__table__
+
+    where = ""
+    params = ()
+    if sensor_index is not None:
+        sensor_index = [int(x) for x in sensor_index]
+        where = f"AND sensor_index IN ({', '.join(['?'] * len(sensor_index))})"
+        params = tuple(sensor_index)
+
+    with model.get_engine().begin() as conn:
+        conn.exec_driver_sql(
+            f"INSERT INTO {queue.name} (sensor_index, start, \"end\") SELECT sensor_index, MIN(time_stamp), MAX(time_stamp) "
+            f"FROM {model.Reading.__tablename__} WHERE average = 0 {where} GROUP BY sensor_index", params
+        )
+
+    return refresh_rollups()
+
+def read_rollup(interval, sensor_index=None, start=None, end=None, fields=None, stats=None):
+    """
+    Reads a rollup table.
+
+    Parameters:
+    -----------
+    interval : str
+        One of model.ROLLUP_INTERVALS.
+
+    sensor_index : list
+        The sensors to read. Defaults to all sensors.
+
+    start, end : date-like
+        Optional bounds on the start of the buckets, inclusive. Naive values are treated as UTC.
+
+    fields : list
+        The reading fields to read. Defaults to model.READING_FIELDS.
+
+    stats : list
+        The statistics to read for each field. Defaults to model.ROLLUP_STATS.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        sensor_index, time_stamp (the start of the bucket as a UTC datetime) and <field>_<stat> columns, sorted by
+        sensor_index and time_stamp.
+    """
+    import pandas as pd
+
+    if interval not in model.ROLLUP_TABLES:
+        raise KeyError(f"Unknown rollup interval {interval}. Use one of {', '.join(model.ROLLUP_TABLES)}.")
+    table = model.ROLLUP_TABLES[interval]
+    fields = model.READING_FIELDS if fields == None else fields
+    stats = model.ROLLUP_STATS if stats == None else stats
+    columns = [f"{x}_{y}" for x in fields for y in stats]
+    unknown = [x for x in columns if x not in table.columns]
+    if len(unknown) > 0:
+        raise KeyError(f"Unknown rollup columns: {', '.join(unknown)}")
+
+    where = ["1 = 1"]
+    params = []
+    if sensor_index is not None:
+        sensor_index = [int(x) for x in sensor_index]
+        where.append(f"sensor_index IN ({', '.join(['?'] * len(sensor_index))})")
+        params += sensor_index
+    if start != None:
+        where.append("bucket >= ?")
+        params.append(int(model.to_unix(pd.Series([start])).iloc[0]))
+    if end != None:
+        where.append("bucket <= ?")
+        params.append(int(model.to_unix(pd.Series([end])).iloc[0]))
+
+    names = ", ".join(['"%s"' % x for x in ['sensor_index', 'bucket'] + columns])
+    sql = f"SELECT {names} FROM {table.name} WHERE {' AND '.join(where)} ORDER BY sensor_index, bucket"
+    with model.get_engine().connect() as conn:
+        rows = conn.exec_driver_sql(sql, tuple(params)).fetchall()
+
+    df = pd.DataFrame(rows, columns=['sensor_index', 'time_stamp'] + columns)
+    df['time_stamp'] = pd.to_datetime(df['time_stamp'].astype('int64'), unit='s', utc=True).astype('datetime64[s, UTC]')
+    for x in columns:
+        df[x] = df[x].astype('Int64' if x.endswith('_count') else 'float64')
+
+    return df
@@ -0,0 +1,302 @@
+"""
+Indexed spatial queries over sensor metadata and deployment locations.
+
+Points are indexed in an R-tree named idx_<table>_geom with columns pkid, xmin, xmax, ymin, ymax (longitude and
+latitude). If the SpatiaLite extension (model.SPATIALITE) can be loaded, each table gets a SpatiaLite POINT geometry
+column, geom, in EPSG:4326 and the R-tree is SpatiaLite's own spatial index, so GIS tools can use the database directly.
+Otherwise the same R-tree is created with SQLite's built-in rtree module and kept current by triggers. Either way the
+queries below only read the rows inside a bounding box and compute exact distances for those:
+
+    sensors = spatial.within_distance(39.96, -83.0, km=5)
+    sensors = spatial.within_polygon(county.geometry)  # GeoJSON-like dict or any object with __geo_interface__
+    sensors = spatial.nearest(39.96, -83.0, k=3)
+    df = spatial.join_readings(sensors, start='2025-06-01')
+"""
+import logging
+
+import model
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_TABLES = {
+    'sensor_metadata': 'sensor_index',
+    'locations': 'id',
+}
+SPATIAL_SRID = 4326
+GEOMETRY_COLUMN = 'geom'
+EARTH_RADIUS_KM = 6371.0088
+NEAREST_START_KM = 1 # Radius of the first search in nearest, grown 4 times until enough sensors are found
+
+_spatialite_failed = False
+
+def load_spatialite(dbapi_connection, connection_record):
+    """
+    Loads model.SPATIALITE into a new SQLite connection if the extension and Python's sqlite3 support it.
+    """
+    global _spatialite_failed
+    import sqlite3
+
+    if model.SPATIALITE == None or _spatialite_failed:
+        return
+    try:
+        dbapi_connection.enable_load_extension(True)
+        dbapi_connection.load_extension(model.SPATIALITE)
+        dbapi_connection.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        _spatialite_failed = True
+        logger.info("SpatiaLite is not available (%s), using SQLite R-tree indexes.", e)
+
+def has_spatialite(conn):
+    """
+    Returns True if SpatiaLite is loaded on a connection.
+    """
+    try:
+        conn.exec_driver_sql("SELECT spatialite_version()")
+    except Exception:
+        return False
+    return True
+
+def index_name(table):
+    return f"idx_{table}_{GEOMETRY_COLUMN}"
+
+def init_spatial(engine):
+    """
+    Creates the geometry columns, spatial indexes and triggers of SPATIAL_TABLES if missing and indexes existing rows.
+
+    Called by model.get_engine.
+    """
+    with engine.begin() as conn:
+        spatialite = has_spatialite(conn)
+        if spatialite:
+            if conn.exec_driver_sql("SELECT COUNT(*) FROM sqlite_master WHERE name = 'geometry_columns'").scalar() == 0:
+                conn.exec_driver_sql("SELECT InitSpatialMetadata(1)")
+
+        for table, key in SPATIAL_TABLES.items():
+            point = "NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL"
+            if spatialite:
+                registered = conn.exec_driver_sql(
+                    "SELECT COUNT(*) FROM geometry_columns WHERE f_table_name = ? AND f_geometry_column = ?", (table, GEOMETRY_COLUMN)
+                ).scalar()
+                if registered == 0:
+                    logger.info("Adding SpatiaLite geometry column %s to %s.", GEOMETRY_COLUMN, table)
+                    conn.exec_driver_sql(f"SELECT AddGeometryColumn('{table}', '{GEOMETRY_COLUMN}', {SPATIAL_SRID}, 'POINT', 'XY')")
+                    conn.exec_driver_sql(f"SELECT CreateSpatialIndex('{table}', '{GEOMETRY_COLUMN}')")
+                # SpatiaLite maintains the index from the geometry, keep the geometry in step with the coordinates
+                set_point = f"UPDATE {table} SET {GEOMETRY_COLUMN} = MakePoint(NEW.longitude, NEW.latitude, {SPATIAL_SRID}) WHERE {key} = NEW.{key};"
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {table}_geom_insert AFTER INSERT ON {table} BEGIN {set_point} END")
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {table}_geom_update AFTER UPDATE OF latitude, longitude ON {table} BEGIN {set_point} END")
+                conn.exec_driver_sql(
+                    f"UPDATE {table} SET {GEOMETRY_COLUMN} = MakePoint(longitude, latitude, {SPATIAL_SRID}) "
+                    f"WHERE {GEOMETRY_COLUMN} IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL"
+                )
+            else:
+                index = index_name(table)
+                insert = f"INSERT OR REPLACE INTO {index} SELECT NEW.{key}, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude WHERE {point};"
+                conn.exec_driver_sql(f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING rtree(pkid, xmin, xmax, ymin, ymax)")
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {table}_geom_insert AFTER INSERT ON {table} BEGIN {insert} END")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_geom_update AFTER UPDATE OF latitude, longitude ON {table} "
+                    f"BEGIN DELETE FROM {index} WHERE pkid = OLD.{key}; {insert} END"
+                )
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {table}_geom_delete AFTER DELETE ON {table} BEGIN DELETE FROM {index} WHERE pkid = OLD.{key}; END")
+                conn.exec_driver_sql(
+                    f"INSERT OR REPLACE INTO {index} SELECT {key}, longitude, longitude, latitude, latitude FROM {table} "
+                    f"WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND {key} NOT IN (SELECT pkid FROM {index})"
+                )
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle distance in km between points given in degrees. Arguments may be numpy arrays.
+    """
+    import numpy as np
+
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype='float64')) for x in [lat1, lon1, lat2, lon2]]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _in_box(table, xmin, xmax, ymin, ymax):
+    """
+    Returns the rows of table whose point is inside a longitude/latitude box, using the R-tree.
+    """
+    import pandas as pd
+
+    if table not in SPATIAL_TABLES:
+        raise KeyError(f"Table {table} is not spatially indexed. Use one of {', '.join(SPATIAL_TABLES)}.")
+    key = SPATIAL_TABLES[table]
+    columns = [x.name for x in model.Base.metadata.tables[table].columns]
+    names = ", ".join([f't."{x}"' for x in columns])
+    sql = (
+        f"SELECT {names} FROM {table} t WHERE t.{key} IN "
+        f"(SELECT pkid FROM {index_name(table)} WHERE xmax >= ? AND xmin <= ? AND ymax >= ? AND ymin <= ?)"
+    )
+    with model.get_engine().connect() as conn:
+        rows = conn.exec_driver_sql(sql, (float(xmin), float(xmax), float(ymin), float(ymax))).fetchall()
+
+    return pd.DataFrame(rows, columns=columns)
+
+def within_distance(latitude, longitude, km, table='sensor_metadata'):
+    """
+    Returns the rows of table within km of a point.
+
+    Parameters:
+    -----------
+    latitude, longitude : float
+        The point in degrees.
+
+    km : float
+        The search radius in kilometers.
+
+    table : str
+        One of SPATIAL_TABLES.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The matching rows with a distance_km column, nearest first.
+    """
+    import math
+
+    dlat = math.degrees(km / EARTH_RADIUS_KM)
+    cos = math.cos(math.radians(latitude))
+    dlon = 180 if cos < 1e-6 else min(dlat / cos, 180)
+
+    df = _in_box(table, longitude - dlon, longitude + dlon, latitude - dlat, latitude + dlat)
+    df['distance_km'] = haversine(latitude, longitude, df['latitude'], df['longitude'])
+    df = df.loc[df['distance_km'] <= km].sort_values('distance_km', ignore_index=True)
+    logger.debug("%s rows of %s within %s km of %s, %s.", len(df), table, km, latitude, longitude)
+
+    return df
+
+def nearest(latitude, longitude, k=1, table='sensor_metadata', max_km=None):
+    """
+    Returns the k rows of table nearest to a point, searching outward from NEAREST_START_KM.
+
+    Parameters:
+    -----------
+    latitude, longitude : float
+        The point in degrees.
+
+    k : int
+        The number of rows to return.
+
+    table : str
+        One of SPATIAL_TABLES.
+
+    max_km : float
+        Optional limit on the distance. Fewer than k rows are returned if fewer are that close.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Up to k rows with a distance_km column, nearest first.
+    """
+    import math
+
+    limit = math.pi * EARTH_RADIUS_KM # Half the circumference reaches every point
+    if max_km != None:
+        limit = min(max_km, limit)
+
+    km = min(NEAREST_START_KM, limit)
+    while True:
+        df = within_distance(latitude, longitude, km, table=table)
+        # Every row closer than the k-th row found is inside this radius, so the search is exact
+        if len(df) >= k or km >= limit:
+            return df.head(k)
+        km = min(km * 4, limit)
+
+def _polygons(geometry):
+    """
+    Returns a list of polygons, each a list of rings as (n, 2) arrays of longitude and latitude.
+    """
+    import numpy as np
+
+    if hasattr(geometry, '__geo_interface__'):
+        geometry = geometry.__geo_interface__
+    if geometry.get('type') == 'Feature':
+        geometry = geometry['geometry']
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError(f"Expected a Polygon or MultiPolygon, got {geometry['type']}.")
+
+    return [[np.asarray(ring, dtype='float64')[:, :2] for ring in polygon] for polygon in polygons]
+
+def _contains(rings, x, y):
+    """
+    Returns a boolean array, True for points inside a polygon with holes, using the even-odd rule.
+    """
+    import numpy as np
+
+    inside = np.zeros(len(x), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        # Points by edges, an edge counts if it straddles the point's latitude to the east of the point
+        crosses = (y1[None, :] > y[:, None]) != (y2[None, :] > y[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at = x1[None, :] + (y[:, None] - y1[None, :]) * (x2 - x1)[None, :] / (y2 - y1)[None, :]
+        inside ^= (crosses & (x[:, None] < at)).sum(axis=1) % 2 == 1
+
+    return inside
+
+def within_polygon(geometry, table='sensor_metadata'):
+    """
+    Returns the rows of table inside a polygon, ie. a county boundary.
+
+    Parameters:
+    -----------
+    geometry : dict or geometry
+        A GeoJSON Polygon, MultiPolygon or Feature in longitude and latitude (EPSG:4326), or an object with
+        __geo_interface__ such as a shapely geometry.
+
+    table : str
+        One of SPATIAL_TABLES.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The matching rows.
+    """
+    import numpy as np
+
+    polygons = _polygons(geometry)
+    points = np.concatenate([ring for polygon in polygons for ring in polygon])
+    df = _in_box(table, points[:, 0].min(), points[:, 0].max(), points[:, 1].min(), points[:, 1].max())
+
+    x = df['longitude'].to_numpy(dtype='float64')
+    y = df['latitude'].to_numpy(dtype='float64')
+    inside = np.zeros(len(df), dtype=bool)
+    for polygon in polygons:
+        inside |= _contains(polygon, x, y)
+    df = df.loc[inside].reset_index(drop=True)
+    logger.debug("%s rows of %s inside the polygon.", len(df), table)
+
+    return df
+
+def join_readings(sensors, start=None, end=None, average=0, columns=None):
+    """
+    Returns the stored readings of the sensors found by a query joined to their name and location.
+
+    Parameters:
+    -----------
+    sensors : pandas.DataFrame
+        Rows of sensor_metadata, ie. the return of within_distance, within_polygon or nearest.
+
+    start, end, average, columns :
+        See model.read_readings.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The readings with name, latitude, longitude and, if present in sensors, distance_km.
+    """
+    if 'sensor_index' not in sensors.columns:
+        raise KeyError("Sensors must have a sensor_index column, ie. come from the sensor_metadata table.")
+
+    readings = model.read_readings(sensor_index=sensors['sensor_index'].tolist(), start=start, end=end, average=average, columns=columns)
+    location = [x for x in ['sensor_index', 'name', 'latitude', 'longitude', 'distance_km'] if x in sensors.columns]
+
+    return readings.merge(sensors[location], on='sensor_index', how='left')